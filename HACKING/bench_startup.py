@@ -0,0 +1,48 @@
+"""Measures how long a fresh process takes to import proxstar.
+
+Run from the repository root: python HACKING/bench_startup.py [runs]
+
+Every RQ job, web worker, watcher and console proxy pays the import; only
+web workers also pay create_app(). Each run uses a new interpreter so
+nothing is already cached in sys.modules.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import proxstar
+imported = time.perf_counter()
+proxstar.create_app()
+print(json.dumps({'import': imported - start, 'create_app': time.perf_counter() - imported}))
+"""
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    env = dict(os.environ)
+    # Time what production pays, without needing a database or issuer
+    env.setdefault('PROXSTAR_TESTING', 'false')
+    env.setdefault('PROXSTAR_SECRET_KEY', 'bench')
+    env.setdefault('PROXSTAR_SQLALCHEMY_DATABASE_URI', 'sqlite://')
+    results = {'import': [], 'create_app': []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], env=env, check=True, capture_output=True, text=True
+        ).stdout
+        for phase, seconds in json.loads(output.splitlines()[-1]).items():
+            results[phase].append(seconds)
+    for phase, samples in results.items():
+        print(
+            f'{phase:<11} median {statistics.median(samples) * 1000:7.1f} ms  '
+            f'min {min(samples) * 1000:7.1f} ms  ({runs} runs)'
+        )
+
+
+if __name__ == '__main__':
+    main()
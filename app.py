@@ -1,4 +1,6 @@
-from proxstar import app
+from proxstar import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host=app.config['IP'], port=app.config['PORT'])
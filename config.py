@@ -2,10 +2,12 @@ from os import environ
 
 # Proxstar
 VM_EXPIRE_MONTHS = int(environ.get('PROXSTAR_VM_EXPIRE_MONTHS', '3'))
-VNC_CLEANUP_TOKEN = environ.get('PROXSTAR_VNC_CLEANUP_TOKEN', '')
 DEFAULT_CPU_LIMIT = int(environ.get('PROXSTAR_DEFAULT_CPU_LIMIT', '8'))
 DEFAULT_MEM_LIMIT = int(environ.get('PROXSTAR_DEFAULT_MEM_LIMIT', '8'))
 DEFAULT_DISK_LIMIT = int(environ.get('PROXSTAR_DEFAULT_DISK_LIMIT', '250'))
+SETTINGS_REFRESH_DEBOUNCE_SECONDS = int(
+    environ.get('PROXSTAR_SETTINGS_REFRESH_DEBOUNCE_SECONDS', '10')
+)
 
 # Development options
 # If you're an RTP and want to see a normal user's homepage view, set this to True.
@@ -26,6 +28,8 @@ TESTING = environ.get('PROXSTAR_TESTING', 'False').lower() in ('true', '1', 't')
 DISABLE_AUTH = environ.get('PROXSTAR_DISABLE_AUTH', 'False').lower() in ('true', '1', 't')
 LOCAL_USER = environ.get('PROXSTAR_LOCAL_USER', 'localuser')
 LOCAL_GROUPS = [g.strip() for g in environ.get('PROXSTAR_LOCAL_GROUPS', '').split(',') if g.strip()]
+# Shown in the footer; read from REVISION or .git when unset
+GIT_REVISION = environ.get('PROXSTAR_GIT_REVISION', '')
 
 # OIDC
 OIDC_ISSUER = environ.get('PROXSTAR_OIDC_ISSUER', 'https://example.com/oidc')
@@ -102,6 +106,31 @@ TEMPLATE_CLONE_FULL = environ.get('PROXSTAR_TEMPLATE_CLONE_FULL', 'True').lower(
     't',
 )
 TEMPLATE_POOL = environ.get('PROXSTAR_TEMPLATE_POOL', '')
+# New VMs get IDs from this range, reserved in Redis for VMID_RESERVATION_TTL seconds
+VMID_RANGE_START = int(environ.get('PROXSTAR_VMID_RANGE_START', '100'))
+VMID_RANGE_END = int(environ.get('PROXSTAR_VMID_RANGE_END', '999999'))
+VMID_RESERVATION_TTL = int(environ.get('PROXSTAR_VMID_RESERVATION_TTL', '600'))
+# The hostname index is rebuilt from the cluster after HOSTNAME_INDEX_TTL seconds
+HOSTNAME_INDEX_TTL = int(environ.get('PROXSTAR_HOSTNAME_INDEX_TTL', '60'))
+HOSTNAME_RESERVATION_TTL = int(environ.get('PROXSTAR_HOSTNAME_RESERVATION_TTL', '900'))
+# Resubmitting a create within this many seconds returns the existing job
+CREATE_REQUEST_TTL = int(environ.get('PROXSTAR_CREATE_REQUEST_TTL', '900'))
+# Template setup resumes from its last checkpoint on retry. Retries are
+# requeued at once: RQ only runs delayed retries on workers started with
+# --with-scheduler.
+TEMPLATE_SETUP_RETRIES = int(environ.get('PROXSTAR_TEMPLATE_SETUP_RETRIES', '2'))
+
+# Storage governor: clone and disk operations running at once, per node and per storage
+GOVERNOR_NODE_LIMIT = int(environ.get('PROXSTAR_GOVERNOR_NODE_LIMIT', '2'))
+GOVERNOR_STORAGE_LIMIT = int(environ.get('PROXSTAR_GOVERNOR_STORAGE_LIMIT', '4'))
+GOVERNOR_CLONE_LEASE = int(environ.get('PROXSTAR_GOVERNOR_CLONE_LEASE', '1800'))
+GOVERNOR_DISK_LEASE = int(environ.get('PROXSTAR_GOVERNOR_DISK_LEASE', '300'))
+GOVERNOR_TASK_WAIT = int(environ.get('PROXSTAR_GOVERNOR_TASK_WAIT', '300'))
+GOVERNOR_REQUEST_WAIT = int(environ.get('PROXSTAR_GOVERNOR_REQUEST_WAIT', '20'))
+
+# Class roster provisioning
+ROSTER_CLONE_TIMEOUT = int(environ.get('PROXSTAR_ROSTER_CLONE_TIMEOUT', '1800'))
+ROSTER_JOB_TIMEOUT = int(environ.get('PROXSTAR_ROSTER_JOB_TIMEOUT', '7200'))
 
 # LDAP
 LDAP_BIND_DN = environ.get('PROXSTAR_LDAP_BIND_DN', '')
@@ -118,11 +147,19 @@ RQ_DASHBOARD_REDIS_PORT = REDIS_PORT
 RQ_DASHBOARD_REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
 
 # VNC
-WEBSOCKIFY_PATH = environ.get('PROXSTAR_WEBSOCKIFY_PATH', '/usr/local/bin/websockify')
-WEBSOCKIFY_TARGET_FILE = environ.get('PROXSTAR_WEBSOCKIFY_TARGET_FILE', '/opt/proxstar/targets')
+# Console tokens live in Redis and stop resolving after this many seconds
+VNC_TOKEN_TTL = int(environ.get('PROXSTAR_VNC_TOKEN_TTL', '3600'))
+# How often expired tokens are trimmed from the token indexes
+VNC_TOKEN_SWEEP_INTERVAL = int(environ.get('PROXSTAR_VNC_TOKEN_SWEEP_INTERVAL', '300'))
+# How long an unused vncproxy is handed back to reconnects; Proxmox closes
+# an unclaimed vncproxy listener after a few seconds
+VNC_SESSION_REUSE_TTL = int(environ.get('PROXSTAR_VNC_SESSION_REUSE_TTL', '10'))
 VNC_HOST = environ.get('PROXSTAR_VNC_HOST', 'localhost')
 VNC_PORT = environ.get('PROXSTAR_VNC_PORT', '443')
-WEBSOCKIFY_PORT = environ.get('PROXSTAR_WEBSOCKIFY_PORT', '8081')
+# Console proxy (python -m proxstar.vncproxy)
+VNC_PROXY_BIND = environ.get('PROXSTAR_VNC_PROXY_BIND', '0.0.0.0')
+VNC_PROXY_PORT = int(environ.get('PROXSTAR_VNC_PROXY_PORT', '8081'))
+VNC_PROXY_USER_LIMIT = int(environ.get('PROXSTAR_VNC_PROXY_USER_LIMIT', '4'))
 
 # UI
 THEME_CSS_URL = environ.get('PROXSTAR_THEME_CSS_URL', 'https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css')
@@ -143,3 +180,37 @@ DD_APP_ID = environ.get('PROXSTAR_DD_APP_ID', '')
 # GUNICORN
 TIMEOUT = environ.get('PROXSTAR_TIMEOUT', 120)
 GUNICORN_WORKERS = int(environ.get('PROXSTAR_GUNICORN_WORKERS', '2'))
+# Each open /api/events stream holds a worker thread
+GUNICORN_THREADS = int(environ.get('PROXSTAR_GUNICORN_THREADS', '32'))
+
+# CLUSTER WATCHER (start_watcher.sh)
+WATCHER_INTERVAL = int(environ.get('PROXSTAR_WATCHER_INTERVAL', '5'))
+# Readers go back to Proxmox when the snapshot is older than this
+WATCHER_STALE_SECONDS = int(environ.get('PROXSTAR_WATCHER_STALE_SECONDS', '30'))
+WATCHER_EVENT_STREAM_LENGTH = int(environ.get('PROXSTAR_WATCHER_EVENT_STREAM_LENGTH', '10000'))
+
+# PROFILING
+# Server-Timing headers and a slow-request log with per-call breakdowns
+PROFILING_ENABLED = environ.get('PROXSTAR_PROFILING_ENABLED', 'False').lower() in (
+    'true',
+    '1',
+    't',
+)
+PROFILING_SLOW_SECONDS = float(environ.get('PROXSTAR_PROFILING_SLOW_SECONDS', '1'))
+# Fraction of slow requests that are logged
+PROFILING_SLOW_SAMPLE_RATE = float(environ.get('PROXSTAR_PROFILING_SLOW_SAMPLE_RATE', '1'))
+# How long a token from /admin/profile-token enables ?profile=
+PROFILING_TOKEN_TTL = int(environ.get('PROXSTAR_PROFILING_TOKEN_TTL', '600'))
+
+# EVENTS
+# Per-user VM lists are cached this long unless a change drops them sooner
+VM_LIST_CACHE_TTL = int(environ.get('PROXSTAR_VM_LIST_CACHE_TTL', '5'))
+# JSON API ETags change at least this often, even if nothing reported a change
+ETAG_MAX_AGE = int(environ.get('PROXSTAR_ETAG_MAX_AGE', '60'))
+# Streams are closed and reopened by the browser after this many seconds
+EVENTS_STREAM_SECONDS = int(environ.get('PROXSTAR_EVENTS_STREAM_SECONDS', '300'))
+EVENTS_KEEPALIVE_SECONDS = int(environ.get('PROXSTAR_EVENTS_KEEPALIVE_SECONDS', '15'))
+# Open streams per gunicorn worker; the rest of its threads serve requests
+EVENTS_MAX_STREAMS = int(
+    environ.get('PROXSTAR_EVENTS_MAX_STREAMS', str(max(1, GUNICORN_THREADS // 2)))
+)
@@ -3,6 +3,8 @@ CREATE TABLE IF NOT EXISTS vm_expiration (
     expire_date DATE NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS ix_vm_expiration_expire_date ON vm_expiration (expire_date);
+
 CREATE TABLE IF NOT EXISTS usage_limit (
     id VARCHAR(32) PRIMARY KEY,
     cpu INTEGER NOT NULL,
@@ -34,10 +36,17 @@ CREATE TABLE IF NOT EXISTS allowed_users (
 );
 
 CREATE TABLE IF NOT EXISTS shared_pools (
-    name VARCHAR(32) PRIMARY KEY,
-    members VARCHAR(32)[]
+    name VARCHAR(32) PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS shared_pool_member (
+    pool VARCHAR(32) NOT NULL REFERENCES shared_pools (name) ON DELETE CASCADE,
+    username VARCHAR(32) NOT NULL,
+    PRIMARY KEY (pool, username)
 );
 
+CREATE INDEX IF NOT EXISTS ix_shared_pool_member_username ON shared_pool_member (username, pool);
+
 CREATE TABLE IF NOT EXISTS student_network (
     id SERIAL PRIMARY KEY,
     username VARCHAR(32) NOT NULL UNIQUE,
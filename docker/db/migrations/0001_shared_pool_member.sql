@@ -0,0 +1,34 @@
+-- Move shared pool membership out of the shared_pools.members array column
+-- into the normalized shared_pool_member table.
+--
+-- Run once against an existing database:
+--   psql -U proxstar -d proxstar -f docker/db/migrations/0001_shared_pool_member.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS shared_pool_member (
+    pool VARCHAR(32) NOT NULL REFERENCES shared_pools (name) ON DELETE CASCADE,
+    username VARCHAR(32) NOT NULL,
+    PRIMARY KEY (pool, username)
+);
+
+CREATE INDEX IF NOT EXISTS ix_shared_pool_member_username ON shared_pool_member (username, pool);
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'shared_pools' AND column_name = 'members'
+    ) THEN
+        INSERT INTO shared_pool_member (pool, username)
+        SELECT DISTINCT sp.name, btrim(member)
+        FROM shared_pools sp, unnest(sp.members) AS member
+        WHERE btrim(member) <> ''
+        ON CONFLICT DO NOTHING;
+
+        ALTER TABLE shared_pools DROP COLUMN members;
+    END IF;
+END
+$$;
+
+COMMIT;
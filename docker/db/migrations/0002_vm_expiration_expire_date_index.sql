@@ -0,0 +1,7 @@
+-- Index vm_expiration by expire_date so the expiry sweep's range query
+-- doesn't scan the whole table.
+--
+-- Run once against an existing database:
+--   psql -U proxstar -d proxstar -f docker/db/migrations/0002_vm_expiration_expire_date_index.sql
+
+CREATE INDEX IF NOT EXISTS ix_vm_expiration_expire_date ON vm_expiration (expire_date);
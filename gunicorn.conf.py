@@ -1,5 +1,4 @@
 import os
-import subprocess
 
 from flask import Flask
 
@@ -12,29 +11,8 @@ app.config.from_pyfile(config)
 
 timeout = app.config['TIMEOUT']
 workers = app.config.get('GUNICORN_WORKERS', 2)
-
-
-def start_websockify(websockify_path, target_file):
-    result = subprocess.run(['pgrep', 'websockify'], stdout=subprocess.PIPE, check=False)
-    if not result.stdout:
-        print("Websockify is stopped. Starting websockify.")
-        proxstar_port = app.config.get('WEBSOCKIFY_PORT')
-        subprocess.call(
-            [
-                websockify_path,
-                proxstar_port,
-                '--token-plugin',
-                'TokenFile',
-                '--token-source',
-                target_file,
-                '-D',
-            ],
-            stdout=subprocess.PIPE,
-        )
-    else:
-        print("Websockify started.")
-
-
-def on_starting(server):  # pylint: disable=unused-argument
-    print("Booting Websockify server in daemon mode...")
-    start_websockify(app.config['WEBSOCKIFY_PATH'], app.config['WEBSOCKIFY_TARGET_FILE'])
+# Threads so open /api/events streams don't starve ordinary requests
+worker_class = 'gthread'
+threads = app.config.get('GUNICORN_THREADS', 32)
+# Static files are copied by the kernel rather than through the worker
+sendfile = True
@@ -1,22 +1,24 @@
 import os
+import re
 import json
 import time
-import atexit
 import logging
-import subprocess
+import threading
+import uuid
 import psutil
 
-# from gunicorn_conf import start_websockify
-import rq_dashboard
-from rq import Queue
 from redis import Redis
+from rq import Callback, Retry
+from rq.job import JobStatus
 from rq_scheduler import Scheduler
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from flask import (
     Flask,
+    get_template_attribute,
     render_template,
     request,
+    stream_template,
     redirect,
     session as flask_session,
     abort,
@@ -24,10 +26,6 @@ from flask import (
     jsonify,
     Response,
 )
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
-from sentry_sdk.integrations.rq import RqIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 from proxstar import util
 from proxstar.db import (
     Base,
@@ -46,25 +44,45 @@ from proxstar.db import (
     add_shared_pool,
     get_shared_pool,
     get_shared_pools,
+    is_shared_pool_member,
+    set_shared_pool_members,
+    delete_shared_pool as delete_shared_pool_entry,
 )
 from proxstar.ldapdb import is_rtp
 from proxstar.vnc import (
     add_vnc_target,
-    get_vnc_targets,
-    delete_vnc_target,
-    stop_websockify,
+    cache_console_session,
+    get_console_session,
+    revoke_vm_console,
     open_vnc_session,
 )
-from proxstar.auth import get_auth
+from proxstar.auth import DeferredAuth
 from proxstar.util import gen_password, sanitize_pool_name
 from proxstar.proxmox import (
     connect_proxmox,
     get_isos,
     get_pools,
     get_ignored_pools,
-    is_hostname_available,
     is_hostname_valid,
 )
+from proxstar.hostnames import is_hostname_taken, release_hostname, reserve_hostname
+from proxstar.events import (
+    RTP_EVENTS_CHANNEL,
+    RTP_GENERATION_KEY,
+    STREAM_LIMIT_RETRY_SECONDS,
+    StreamLimit,
+    bump_generations,
+    get_user_channel,
+    get_user_generation_key,
+    get_vm_generation_key,
+    publish_quietly,
+    stream_events,
+)
+from proxstar.watcher import CLUSTER_SNAPSHOT_FRESH_KEY, get_cluster_snapshot
+from proxstar.governor import GovernorTimeout, governed, slots_for
+from proxstar.assets import init_assets
+from proxstar.metrics import render_metrics
+from proxstar.profiling import get_profile, init_profiling, make_profile_token
 from proxstar.session import (
     clear_session,
     get_session_start,
@@ -73,33 +91,34 @@ from proxstar.session import (
     SESSION_SHUTDOWN_PREFIX,
 )
 from proxstar.sdn import ensure_student_network
+from proxstar.queues import (
+    CREATE_REQUEST_PREFIX,
+    INTERACTIVE_QUEUE,
+    MAINTENANCE_QUEUE,
+    PROVISIONING_QUEUE,
+    enqueue_debounced,
+    get_queue,
+)
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
 
 app = Flask(__name__)
-app.config.from_object(rq_dashboard.default_settings)
 if os.path.exists(os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')):
     config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')
 else:
     config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config.py')
 app.config.from_pyfile(config)
-app.config['GIT_REVISION'] = (
-    subprocess.check_output('git rev-parse --short HEAD', shell=True).decode('utf-8').rstrip()
-)
+if not app.config.get('GIT_REVISION'):
+    app.config['GIT_REVISION'] = util.read_git_revision(app.config.get('ROOT_DIR', os.getcwd()))
 
 testing = app.config.get('TESTING', False)
 disable_auth = app.config.get('DISABLE_AUTH', False)
 
-# Sentry setup
-if not testing:
-    sentry_sdk.init(
-        dsn=app.config['SENTRY_DSN'],
-        integrations=[FlaskIntegration(), RqIntegration(), SqlalchemyIntegration()],
-        environment=app.config['SENTRY_ENV'],
-    )
-
 
 class _DummyAuth:
+    def init_app(self, _app):
+        pass
+
     def oidc_auth(self, *args, **kwargs):
         def decorator(fn):
             return fn
@@ -150,10 +169,14 @@ if testing:
 elif disable_auth:
     auth = _LocalAuth(app)
 else:
-    auth = get_auth(app)
+    auth = DeferredAuth(app.config)
 
 redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
-q = Queue(connection=redis_conn, default_timeout=360)
+# Per process, i.e. per gunicorn worker
+event_streams = StreamLimit(app.config['EVENTS_MAX_STREAMS'])
+interactive_q = get_queue(redis_conn, INTERACTIVE_QUEUE)
+provisioning_q = get_queue(redis_conn, PROVISIONING_QUEUE)
+maintenance_q = get_queue(redis_conn, MAINTENANCE_QUEUE)
 scheduler = Scheduler(connection=redis_conn)
 
 engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
@@ -165,56 +188,16 @@ from proxstar.vm import VM
 from proxstar.user import User
 from proxstar.tasks import (
     generate_pool_cache_task,
-    process_expiring_vms_task,
-    cleanup_vnc_task,
     delete_vm_task,
     create_vm_task,
     setup_template_task,
+    provision_roster_task,
     enforce_session_timeouts_task,
     sync_templates_task,
+    job_succeeded,
+    job_failed,
 )
 
-if not testing:
-    if 'generate_pool_cache' not in scheduler:
-        logging.info('adding generate pool cache task to scheduler')
-        scheduler.schedule(
-            id='generate_pool_cache',
-            scheduled_time=datetime.datetime.utcnow(),
-            func=generate_pool_cache_task,
-            interval=90,
-        )
-
-    if app.config.get('ENABLE_VM_EXPIRATION') and 'process_expiring_vms' not in scheduler:
-        logging.info('adding process expiring VMs task to scheduler')
-        scheduler.cron('0 2 * * *', id='process_expiring_vms', func=process_expiring_vms_task)
-
-    if 'cleanup_vnc' not in scheduler:
-        logging.info('adding cleanup VNC task to scheduler')
-        scheduler.schedule(
-            id='cleanup_vnc',
-            scheduled_time=datetime.datetime.utcnow(),
-            func=cleanup_vnc_task,
-            interval=3600,
-        )
-
-    if app.config.get('TEMPLATE_POOL') and 'sync_templates' not in scheduler:
-        logging.info('adding template sync task to scheduler')
-        scheduler.schedule(
-            id='sync_templates',
-            scheduled_time=datetime.datetime.utcnow(),
-            func=sync_templates_task,
-            interval=300,
-        )
-
-    if 'enforce_session_timeouts' not in scheduler:
-        logging.info('adding session timeout enforcement task to scheduler')
-        scheduler.schedule(
-            id='enforce_session_timeouts',
-            scheduled_time=datetime.datetime.utcnow(),
-            func=enforce_session_timeouts_task,
-            interval=app.config['SESSION_CHECK_INTERVAL_SECONDS'],
-        )
-
 
 def add_rq_dashboard_auth(blueprint):
     @blueprint.before_request
@@ -225,21 +208,62 @@ def add_rq_dashboard_auth(blueprint):
             abort(403)
 
 
-if not testing:
-    rq_dashboard_blueprint = rq_dashboard.blueprint
-    add_rq_dashboard_auth(rq_dashboard_blueprint)
-    rq_dashboard.web.setup_rq_connection(app)
-    app.register_blueprint(rq_dashboard_blueprint, url_prefix='/rq')
+_app_lock = threading.Lock()
+_app_ready = False
+
+
+def create_app():
+    """Returns the web app with its process-wide side effects set up.
+
+    Importing proxstar is kept free of them, since RQ workers and the other
+    entry points import it too. Only web servers call this, e.g. gunicorn
+    loads 'proxstar:create_app()'. Periodic jobs are registered by the
+    scheduler process (proxstar.schedules).
+    """
+    # pylint: disable=global-statement,import-outside-toplevel
+    global _app_ready
+    with _app_lock:
+        if _app_ready:
+            return app
+        if not testing:
+            import sentry_sdk
+            from sentry_sdk.integrations.flask import FlaskIntegration
+            from sentry_sdk.integrations.rq import RqIntegration
+            from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+
+            sentry_sdk.init(
+                dsn=app.config['SENTRY_DSN'],
+                integrations=[FlaskIntegration(), RqIntegration(), SqlalchemyIntegration()],
+                environment=app.config['SENTRY_ENV'],
+            )
+        auth.init_app(app)
+        init_profiling(app, engine, redis_conn)
+        init_assets(app)
+        if not testing:
+            import rq_dashboard
+
+            rq_dashboard_blueprint = rq_dashboard.blueprint
+            add_rq_dashboard_auth(rq_dashboard_blueprint)
+            rq_dashboard.web.setup_rq_connection(app)
+            app.register_blueprint(rq_dashboard_blueprint, url_prefix='/rq')
+        _app_ready = True
+    return app
 
 
 def _get_running_vms(user):
+    # The watcher's snapshot saves one status call per VM while it is fresh
+    snapshot = get_cluster_snapshot(redis_conn) or {}
     running = []
     for vm in user.vms:
         if 'vmid' not in vm:
             continue
         vm_obj = VM(vm['vmid'])
         try:
-            if vm_obj.status in ('running', 'paused'):
+            if int(vm['vmid']) in snapshot:
+                status = snapshot[int(vm['vmid'])]['status']
+            else:
+                status = vm_obj.status
+            if status in ('running', 'paused'):
                 running.append(vm_obj)
         except Exception:  # pylint: disable=broad-except
             continue
@@ -301,6 +325,24 @@ def _shorten_all_sessions(minutes=3):
     return shortened
 
 
+def _can_access_vm(user, vmid):
+    """Whether vmid is in user's pool or one of their shared pools.
+
+    Answered from the watcher's cluster snapshot while it is fresh, so the
+    check makes no Proxmox calls. VMs the snapshot doesn't know yet fall
+    back to user.allowed_vms, which lists every pool from Proxmox.
+    """
+    if user.rtp:
+        return True
+    snapshot = get_cluster_snapshot(redis_conn)
+    vm = snapshot.get(int(vmid)) if snapshot is not None else None
+    if vm is None:
+        return int(vmid) in user.allowed_vms
+    pools = {user.pool_id}
+    pools.update(pool.name for pool in get_shared_pools(db, user.name, False))
+    return vm['pool'] in pools
+
+
 def _get_vm_or_404(vmid):
     vm = VM(vmid)
     try:
@@ -314,13 +356,17 @@ def _get_vm_or_404(vmid):
 
 
 def _enqueue_settings_refresh():
+    # A burst of settings edits collapses into one refresh per task.
+    delay = app.config.get('SETTINGS_REFRESH_DEBOUNCE_SECONDS', 10)
     try:
-        q.enqueue(generate_pool_cache_task, job_timeout=120)
+        enqueue_debounced(
+            scheduler, MAINTENANCE_QUEUE, generate_pool_cache_task, delay, timeout=120
+        )
     except Exception as e:  # pylint: disable=broad-except
         logging.warning('Failed to enqueue pool cache refresh: %s', e)
     if app.config.get('TEMPLATE_POOL'):
         try:
-            q.enqueue(sync_templates_task, job_timeout=120)
+            enqueue_debounced(scheduler, MAINTENANCE_QUEUE, sync_templates_task, delay, timeout=120)
         except Exception as e:  # pylint: disable=broad-except
             logging.warning('Failed to enqueue template sync: %s', e)
 
@@ -386,43 +432,52 @@ def forbidden(e):
         return render_template('403.html', user='chom', e=e), 403
 
 
+def _stream_page(template, **context):
+    """Sends template as it renders, so the layout reaches the browser
+    before slow context values (callables the template invokes) are loaded.
+    The status line is sent first, so those values can't fail the request
+    and have to report errors in the page instead."""
+    response = Response(stream_template(template, **context))
+    # Don't let nginx hold the page back until it's complete
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/')
 @app.route('/user/<string:user_view>')
 @auth.oidc_auth('default')
 def list_vms(user_view=None):
     user = User(flask_session['userinfo']['preferred_username'])
-    connect_proxmox()
     if app.config['FORCE_STANDARD_USER']:
         user.rtp = False
     if user_view:
         if not user.rtp:
             abort(403)
         user_view = User(user_view)
-        vms = user_view.vms
-        for pending_vm in user_view.pending_vms:
-            vm = next((vm for vm in vms if vm['name'] == pending_vm['name']), None)
-            if vm:
-                vms[vms.index(vm)]['status'] = pending_vm['status']
-                vms[vms.index(vm)]['pending'] = True
-            else:
-                vms.append(pending_vm)
-    else:
-        if user.active:
-            vms = user.vms
-            for pending_vm in user.pending_vms:
+    owner = user_view or user
+
+    def load_vms():
+        if not user_view and not user.active:
+            return 'INACTIVE'
+        try:
+            vms = owner.vms
+            for pending_vm in owner.pending_vms:
                 vm = next((vm for vm in vms if vm['name'] == pending_vm['name']), None)
                 if vm:
                     vms[vms.index(vm)]['status'] = pending_vm['status']
                     vms[vms.index(vm)]['pending'] = True
                 else:
                     vms.append(pending_vm)
-        else:
-            vms = 'INACTIVE'
-    return render_template(
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Could not list VMs for %s: %s', owner.name, e)
+            return 'ERROR'
+        return vms
+
+    return _stream_page(
         'list_vms.html',
         user=user,
         external_view=user_view,
-        vms=vms,
+        vms=load_vms,
         view_user=user_view.name if user_view else None,
     )
 
@@ -433,7 +488,7 @@ def list_shared_vms(name=None):
     user = User(flask_session['userinfo']['preferred_username'])
     pool = get_shared_pool(db, name)
     if pool:
-        if user.name in pool.members or user.rtp:
+        if user.rtp or is_shared_pool_member(db, pool.name, user.name):
             proxmox = connect_proxmox()
             vms = proxmox.pools(pool.name).get()['members']
         else:
@@ -451,29 +506,81 @@ def list_shared_vms(name=None):
     )
 
 
-@app.route('/api/pending-vms')
-@auth.oidc_auth('default')
-def pending_vms_api():
+def _version_tag(keys, needs_watcher=True):
+    """Tags a response with the generations of everything it is built from,
+    or returns None when they can't be trusted.
+
+    VM changes made outside Proxstar only bump generations through the
+    cluster watcher, so most tags need its snapshot to be fresh. Tags also
+    roll over every ETAG_MAX_AGE seconds, which bounds how long a change
+    nothing reports (e.g. a disk added in the Proxmox UI) stays hidden.
+    """
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.mget(keys)
+        pipe.exists(CLUSTER_SNAPSHOT_FRESH_KEY)
+        generations, watcher_fresh = pipe.execute()
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not read generations: %s', e)
+        return None
+    if needs_watcher and not watcher_fresh:
+        return None
+    epoch = int(time.time() // app.config['ETAG_MAX_AGE'])
+    parts = [app.config['GIT_REVISION'], str(epoch)]
+    parts.extend(str(int(generation or 0)) for generation in generations)
+    return '-'.join(parts)
+
+
+def _conditional_json(tag, build):
+    # build only runs when the client's copy is out of date
+    if tag is not None and request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    if tag is not None:
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.after_request
+def bump_generations_after_write(response):
+    # Any successful write may change what the JSON APIs return
+    if request.method != 'POST' or response.status_code >= 400:
+        return response
+    view_args = request.view_args or {}
+    users = [view_args['user']] if 'user' in view_args else []
+    acting_user = flask_session.get('userinfo', {}).get('preferred_username')
+    if acting_user:
+        users.append(acting_user)
+    vmids = [view_args['vmid']] if 'vmid' in view_args else []
+    try:
+        bump_generations(redis_conn, users, vmids)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not bump generations: %s', e)
+    return response
+
+
+def _api_target():
     user = User(flask_session['userinfo']['preferred_username'])
     view_user = request.args.get('user')
-    target = user
     if view_user and view_user != user.name:
         if not user.rtp:
             abort(403)
-        target = User(view_user)
-    return jsonify({'pending': target.pending_vms})
+        return User(view_user)
+    return user
 
 
-@app.route('/api/vms')
+@app.route('/api/pending-vms')
 @auth.oidc_auth('default')
-def vms_api():
-    user = User(flask_session['userinfo']['preferred_username'])
-    view_user = request.args.get('user')
-    target = user
-    if view_user and view_user != user.name:
-        if not user.rtp:
-            abort(403)
-        target = User(view_user)
+def pending_vms_api():
+    target = _api_target()
+    # Job progress is published by the workers themselves
+    tag = _version_tag([get_user_generation_key(target.name)], needs_watcher=False)
+    return _conditional_json(tag, lambda: {'pending': target.pending_vms})
+
+
+def _vms_with_pending(target):
     vms = target.vms if target.active or target.rtp else []
     for pending_vm in target.pending_vms:
         vm = next((vm for vm in vms if vm.get('name') == pending_vm.get('name')), None)
@@ -482,7 +589,67 @@ def vms_api():
             vm['pending'] = True
         else:
             vms.append(pending_vm)
-    return jsonify({'vms': vms})
+    return vms
+
+
+@app.route('/api/vms')
+@auth.oidc_auth('default')
+def vms_api():
+    target = _api_target()
+    return _conditional_json(
+        _version_tag([get_user_generation_key(target.name)]),
+        lambda: {'vms': _vms_with_pending(target)},
+    )
+
+
+@app.route('/api/vm-cards')
+@auth.oidc_auth('default')
+def vm_cards_api():
+    """Renders the list page's cards for the VMs named in ?name=, so the
+    page can swap in new or finished VMs without reloading."""
+    target = _api_target()
+    names = set(request.args.getlist('name'))
+
+    def build():
+        vm_card = get_template_attribute('vm_card.html', 'vm_card')
+        return {
+            'cards': {
+                vm['name']: str(vm_card(vm))
+                for vm in _vms_with_pending(target)
+                if vm.get('name') in names
+            }
+        }
+
+    return _conditional_json(_version_tag([get_user_generation_key(target.name)]), build)
+
+
+@app.route('/api/events')
+@auth.oidc_auth('default')
+def events_api():
+    user = User(flask_session['userinfo']['preferred_username'])
+    if not event_streams.acquire():
+        # The page falls back to polling and tries the stream again later
+        return Response(
+            'Too many open event streams',
+            status=503,
+            headers={'Retry-After': str(STREAM_LIMIT_RETRY_SECONDS)},
+        )
+    channels = [get_user_channel(user.name)]
+    if user.rtp:
+        channels.append(RTP_EVENTS_CHANNEL)
+    response = Response(
+        stream_events(
+            redis_conn,
+            channels,
+            app.config['EVENTS_STREAM_SECONDS'],
+            app.config['EVENTS_KEEPALIVE_SECONDS'],
+        ),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # Runs however the stream ends, including before it was ever read
+    response.call_on_close(event_streams.release)
+    return response
 
 
 @app.route('/api/running-vms')
@@ -491,22 +658,30 @@ def running_vms_api():
     user = User(flask_session['userinfo']['preferred_username'])
     if not user.rtp:
         abort(403)
-    proxmox = connect_proxmox()
-    running = []
-    for vm in proxmox.cluster.resources.get(type='vm'):
-        status = vm.get('status')
-        if status not in ('running', 'paused'):
-            continue
-        running.append(
-            {
-                'vmid': vm.get('vmid'),
-                'name': vm.get('name'),
-                'node': vm.get('node'),
-                'pool': vm.get('pool'),
-                'status': status,
-            }
-        )
-    return jsonify({'vms': running})
+
+    def build():
+        snapshot = get_cluster_snapshot(redis_conn)
+        if snapshot is not None:
+            vms = snapshot.values()
+        else:
+            vms = connect_proxmox().cluster.resources.get(type='vm')
+        running = []
+        for vm in vms:
+            status = vm.get('status')
+            if status not in ('running', 'paused'):
+                continue
+            running.append(
+                {
+                    'vmid': vm.get('vmid'),
+                    'name': vm.get('name'),
+                    'node': vm.get('node'),
+                    'pool': vm.get('pool'),
+                    'status': status,
+                }
+            )
+        return {'vms': running}
+
+    return _conditional_json(_version_tag([RTP_GENERATION_KEY]), build)
 
 
 @app.route('/pools')
@@ -514,21 +689,42 @@ def list_pools():
     user = User(flask_session['userinfo']['preferred_username'])
     if app.config['FORCE_STANDARD_USER']:
         user.rtp = False
-    proxmox = connect_proxmox()
-    user_pools = get_pool_cache(db) if user.rtp else []
-    if user.rtp:
-        for pool in user_pools:
-            pool['session_remaining'] = _get_session_remaining(pool['user'])
-    shared_pools = map(
-        lambda pool: {
-            'name': pool.name,
-            'members': pool.members,
-            'vms': proxmox.pools(pool.name).get()['members'],
-        },
-        get_shared_pools(db, user.name, user.rtp),
-    )
-    return render_template(
-        'list_pools.html', user=user, user_pools=user_pools, shared_pools=shared_pools
+
+    def load_user_pools():
+        if not user.rtp:
+            return []
+        try:
+            user_pools = get_pool_cache(db)
+            for pool in user_pools:
+                pool['session_remaining'] = _get_session_remaining(pool['user'])
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Could not list user pools: %s', e)
+            return 'ERROR'
+        return user_pools
+
+    def load_shared_pools():
+        try:
+            shared_pools = get_shared_pools(db, user.name, user.rtp)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Could not list shared pools for %s: %s', user.name, e)
+            return 'ERROR'
+        return shared_pool_cards(shared_pools)
+
+    def shared_pool_cards(shared_pools):
+        # A generator, so each shared pool's card is sent once its members
+        # are in rather than after every pool's
+        proxmox = None
+        for pool in shared_pools:
+            try:
+                proxmox = proxmox or connect_proxmox()
+                vms = proxmox.pools(pool.name).get()['members']
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Could not list shared pool %s: %s', pool.name, e)
+                vms = None
+            yield {'name': pool.name, 'members': pool.members, 'vms': vms}
+
+    return _stream_page(
+        'list_pools.html', user=user, user_pools=load_user_pools, shared_pools=load_shared_pools
     )
 
 
@@ -543,10 +739,9 @@ def isos():
 @app.route('/hostname/<string:name>')
 @auth.oidc_auth('default')
 def hostname(name):
-    proxmox = connect_proxmox()
     if not is_hostname_valid(name):
         return 'invalid'
-    if not is_hostname_available(proxmox, name):
+    if is_hostname_taken(redis_conn, name):
         return 'taken'
     return 'ok'
 
@@ -586,23 +781,25 @@ def vm_details(vmid):
 @auth.oidc_auth('default')
 def vm_hardware(vmid):
     user = User(flask_session['userinfo']['preferred_username'])
-    connect_proxmox()
-    if user.rtp or int(vmid) in user.allowed_vms:
-        vm = _get_vm_or_404(vmid)
-        interfaces = [
-            {'device': iface[0], 'mac': iface[1], 'ip': iface[2]} for iface in vm.interfaces
-        ]
-        disks = [{'device': disk[0], 'size_gb': disk[1]} for disk in vm.disks]
-        isos = [{'device': iso[0], 'iso': iso[1]} for iso in vm.isos]
-        return jsonify(
-            {
+    # A matching ETag is answered without calling Proxmox at all
+    if _can_access_vm(user, vmid):
+
+        def build():
+            vm = _get_vm_or_404(vmid)
+            interfaces = [
+                {'device': iface[0], 'mac': iface[1], 'ip': iface[2]} for iface in vm.interfaces
+            ]
+            disks = [{'device': disk[0], 'size_gb': disk[1]} for disk in vm.disks]
+            isos = [{'device': iso[0], 'iso': iso[1]} for iso in vm.isos]
+            return {
                 'interfaces': interfaces,
                 'disks': disks,
                 'isos': isos,
                 'boot_order': vm.boot_order,
                 'boot_order_json': vm.boot_order_json,
             }
-        )
+
+        return _conditional_json(_version_tag([get_vm_generation_key(vmid)]), build)
     return abort(403)
 
 
@@ -610,28 +807,29 @@ def vm_hardware(vmid):
 @auth.oidc_auth('default')
 def vm_summary(vmid):
     user = User(flask_session['userinfo']['preferred_username'])
-    connect_proxmox()
-    if user.rtp or int(vmid) in user.allowed_vms:
-        vm = _get_vm_or_404(vmid)
-        cpu = vm.cpu
-        mem = vm.mem
-        usage = user.usage
-        limits = user.limits
-        usage_check = None
-        if not user.rtp:
-            usage_check = user.check_usage(cpu, mem, 0)
-        return jsonify(
-            {
+    if _can_access_vm(user, vmid):
+
+        def build():
+            vm = _get_vm_or_404(vmid)
+            cpu = vm.cpu
+            mem = vm.mem
+            usage_check = None
+            if not user.rtp:
+                usage_check = user.check_usage(cpu, mem, 0)
+            return {
                 'name': vm.name,
                 'node': vm.node,
                 'qmpstatus': vm.qmpstatus,
                 'cpu': cpu,
                 'mem': mem,
-                'usage': usage,
-                'limits': limits,
+                'usage': user.usage,
+                'limits': user.limits,
                 'usage_check': usage_check,
             }
-        )
+
+        # Usage and limits change with the user's other VMs
+        tag = _version_tag([get_vm_generation_key(vmid), get_user_generation_key(user.name)])
+        return _conditional_json(tag, build)
     return abort(403)
 
 
@@ -657,6 +855,14 @@ def vm_label(vmid):
     return abort(403)
 
 
+def _revoke_console(vmid, action):
+    # A Redis hiccup must not block the power action itself
+    try:
+        revoke_vm_console(redis_conn, vmid)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not revoke VNC token during %s: %s', action, e)
+
+
 @app.route('/vm/<string:vmid>/power/<string:action>', methods=['POST'])
 @auth.oidc_auth('default')
 def vm_power(vmid, action):
@@ -664,19 +870,6 @@ def vm_power(vmid, action):
     connect_proxmox()
     if user.rtp or int(vmid) in user.allowed_vms:
         vm = _get_vm_or_404(vmid)
-        vnc_token_key = f'vnc_token|{vmid}'
-        # For deleting the token from redis later
-        vnc_token = None
-        try:
-            token_value = redis_conn.get(vnc_token_key)
-            if token_value is not None:
-                vnc_token = token_value.decode('utf-8')
-        except Exception as e:
-            logging.warning(
-                'Could not get vnc_token during %s: %s. Action is still being performed.',
-                action,
-                e,
-            )
         if action == 'start':
             vmconfig = vm.config
             if app.config.get('ENABLE_VM_EXPIRATION'):
@@ -690,41 +883,21 @@ def vm_power(vmid, action):
             _ensure_session_started(user)
         elif action == 'stop':
             vm.stop()
-            if vnc_token is not None:
-                try:
-                    delete_vnc_target(token=vnc_token)
-                except LookupError:
-                    logging.info('VNC token %s not found during stop; skipping cleanup.', vnc_token)
-                redis_conn.delete(vnc_token_key)
+            _revoke_console(vmid, 'stop')
             _clear_session_if_idle(user)
         elif action == 'shutdown':
             vm.shutdown()
-            if vnc_token is not None:
-                try:
-                    delete_vnc_target(token=vnc_token)
-                except LookupError:
-                    logging.info('VNC token %s not found during shutdown; skipping cleanup.', vnc_token)
-                redis_conn.delete(vnc_token_key)
+            _revoke_console(vmid, 'shutdown')
             _clear_session_if_idle(user)
         elif action == 'reset':
             vm.reset()
         elif action == 'suspend':
             vm.suspend(todisk=True)
-            if vnc_token is not None:
-                try:
-                    delete_vnc_target(token=vnc_token)
-                except LookupError:
-                    logging.info('VNC token %s not found during suspend; skipping cleanup.', vnc_token)
-                redis_conn.delete(vnc_token_key)
+            _revoke_console(vmid, 'suspend')
             _clear_session_if_idle(user)
         elif action == 'pause':
             vm.suspend()
-            if vnc_token is not None:
-                try:
-                    delete_vnc_target(token=vnc_token)
-                except LookupError:
-                    logging.info('VNC token %s not found during pause; skipping cleanup.', vnc_token)
-                redis_conn.delete(vnc_token_key)
+            _revoke_console(vmid, 'pause')
             _clear_session_if_idle(user)
         elif action == 'resume':
             if app.config.get('ENABLE_VM_EXPIRATION'):
@@ -744,19 +917,28 @@ def vm_console(vmid):
     user = User(flask_session['userinfo']['preferred_username'])
     proxmox = connect_proxmox()
     if user.rtp or int(vmid) in user.allowed_vms:
-        # import pdb; pdb.set_trace()
+        # Reconnects that arrive before the proxy used the last vncproxy get
+        # it back instead of starting another one on the node
+        session = get_console_session(redis_conn, vmid, user.name)
+        if session is not None:
+            return session, 200
         vm = _get_vm_or_404(vmid)
         node_host = _node_fqdn(vm.node)
         proxmox = connect_proxmox(node_host)
         vnc_ticket, vnc_port = open_vnc_session(vmid, vm.node, proxmox)
-        token = add_vnc_target(node_host, vnc_port)
-        redis_conn.set(f'vnc_token|{vmid}', str(token))  # Store the VNC token in Redis.
-        return {
+        token = add_vnc_target(
+            redis_conn, vmid, user.name, node_host, vnc_port, app.config['VNC_TOKEN_TTL']
+        )
+        session = {
             'host': app.config['VNC_HOST'],
             'port': app.config['VNC_PORT'],
             'token': token,
             'password': vnc_ticket,
-        }, 200
+        }
+        cache_console_session(
+            redis_conn, vmid, user.name, session, app.config['VNC_SESSION_REUSE_TTL']
+        )
+        return session, 200
 
     else:
         return '', 403
@@ -814,6 +996,16 @@ def vm_mem(vmid, mem):
         return '', 403
 
 
+def _disk_slot(vm, storage, operation):
+    return governed(
+        redis_conn,
+        slots_for(app.config, vm.node, storage),
+        app.config['GOVERNOR_DISK_LEASE'],
+        app.config['GOVERNOR_REQUEST_WAIT'],
+        operation,
+    )
+
+
 @app.route('/vm/<string:vmid>/disk/create/<int:size>', methods=['POST'])
 @auth.oidc_auth('default')
 def create_disk(vmid, size):
@@ -824,7 +1016,11 @@ def create_disk(vmid, size):
         usage_check = user.check_usage(0, 0, size)
         if usage_check:
             return usage_check
-        vm.create_disk(size)
+        try:
+            with _disk_slot(vm, app.config['PROXMOX_VM_STORAGE'], 'create_disk'):
+                vm.create_disk(size)
+        except GovernorTimeout:
+            return 'Storage is busy, try again shortly', 503
         return '', 200
     else:
         return '', 403
@@ -840,7 +1036,12 @@ def resize_disk(vmid, disk, size):
         usage_check = user.check_usage(0, 0, size)
         if usage_check:
             return usage_check
-        vm.resize_disk(disk, size)
+        storage = vm.config.get(disk, app.config['PROXMOX_VM_STORAGE']).split(':')[0]
+        try:
+            with _disk_slot(vm, storage, 'resize_disk'):
+                vm.resize_disk(disk, size)
+        except GovernorTimeout:
+            return 'Storage is busy, try again shortly', 503
         return '', 200
     else:
         return '', 403
@@ -947,7 +1148,15 @@ def delete(vmid):
     if user.rtp or int(vmid) in user.allowed_vms:
         # send_stop_ssh_tunnel(vmid)
         # Submit the delete VM task to RQ
-        q.enqueue(delete_vm_task, vmid)
+        # The owner's VM list is refreshed once the VM is actually gone
+        owners = [user.name] if any(vm['vmid'] == int(vmid) for vm in user.vms) else []
+        interactive_q.enqueue(
+            delete_vm_task,
+            vmid,
+            meta={'users': owners},
+            on_success=Callback(job_succeeded),
+            on_failure=Callback(job_failed),
+        )
         return '', 200
     else:
         return '', 403
@@ -969,6 +1178,108 @@ def set_boot_order(vmid):
         return '', 403
 
 
+# Deletes KEYS[1] only while it still holds ARGV[1]
+_RELEASE_CREATE_REQUEST_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+CREATE_CLAIM_PREFIX = 'claim|'
+# A create job in one of these blocks identical submissions
+CREATE_IN_FLIGHT = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+
+def _create_request_key(username, name):
+    return f'{CREATE_REQUEST_PREFIX}{username}|{name}'
+
+
+def _release_create_request(request_key, value):
+    script = redis_conn.register_script(_RELEASE_CREATE_REQUEST_SCRIPT)
+    script(keys=[request_key], args=[value])
+
+
+def _claim_create_request(request_key):
+    """Claims request_key for this submission.
+
+    Returns (claim, None) when this submission should enqueue the create,
+    and claim is its token for the key. Otherwise returns (None, job) with
+    the queued or running job of an identical submission, or (None, None)
+    while that submission is still enqueueing it.
+    """
+    claim = f'{CREATE_CLAIM_PREFIX}{uuid.uuid4().hex}'
+    while True:
+        if redis_conn.set(request_key, claim, nx=True, ex=app.config['CREATE_REQUEST_TTL']):
+            return claim, None
+        value = redis_conn.get(request_key)
+        if value is None:
+            continue
+        if value.decode('utf-8').startswith(CREATE_CLAIM_PREFIX):
+            return None, None
+        job = provisioning_q.fetch_job(value.decode('utf-8'))
+        if job is not None and job.get_status() in CREATE_IN_FLIGHT:
+            return None, job
+        # A finished, failed or expired job doesn't block a fresh create
+        _release_create_request(request_key, value)
+
+
+def _enqueue_create(proxmox, username, name, form):
+    """Enqueues the create for username's VM name and returns the response
+    for it, {'job_id': ...}.
+
+    Submitting the same VM again while its job is queued or running returns
+    that job instead, whatever page or tab it came from. While the first
+    submission is still enqueueing, job_id is None and pending is set; the
+    job shows up in the user's pending VMs once it is queued. Returns None
+    if the name is invalid or taken by another VM.
+    """
+    request_key = _create_request_key(username, name)
+    claim, job = _claim_create_request(request_key)
+    if claim is None:
+        if job is None:
+            return {'job_id': None, 'pending': True}
+        return {'job_id': job.id}
+    try:
+        if not is_hostname_valid(name) or not reserve_hostname(redis_conn, name, proxmox):
+            _release_create_request(request_key, claim)
+            return None
+        if form['template'] == 'none':
+            job = provisioning_q.enqueue(
+                create_vm_task,
+                username,
+                name,
+                form['cores'],
+                form['memory'],
+                form['disk'],
+                form['iso'],
+                job_timeout=300,
+                meta={'users': [username]},
+                on_success=Callback(job_succeeded),
+                on_failure=Callback(job_failed),
+            )
+        else:
+            job = provisioning_q.enqueue(
+                setup_template_task,
+                form['template'],
+                name,
+                username,
+                form['ssh_key'],
+                form['cores'],
+                form['memory'],
+                job_timeout=600,
+                retry=Retry(max=app.config['TEMPLATE_SETUP_RETRIES']),
+                meta={'users': [username]},
+                on_success=Callback(job_succeeded),
+                on_failure=Callback(job_failed),
+            )
+    except Exception:
+        _release_create_request(request_key, claim)
+        raise
+    redis_conn.set(request_key, job.id, ex=app.config['CREATE_REQUEST_TTL'])
+    publish_quietly(redis_conn, [username], 'job', {'id': job.id, 'status': None, 'final': False})
+    return {'job_id': job.id}
+
+
 @app.route('/vm/create', methods=['GET', 'POST'])
 @auth.oidc_auth('default')
 def create():
@@ -993,53 +1304,103 @@ def create():
             )
         elif request.method == 'POST':
             name = request.form['name'].lower()
-            cores = request.form['cores']
-            memory = request.form['mem']
-            template = request.form['template']
-            disk = request.form['disk']
-            iso = request.form['iso']
-            ssh_key = request.form['ssh_key']
-            if iso != 'none':
-                iso = '{}:iso/{}'.format(app.config['PROXMOX_ISO_STORAGE'], iso)
+            form = {
+                'cores': request.form['cores'],
+                'memory': request.form['mem'],
+                'template': request.form['template'],
+                'disk': request.form['disk'],
+                'iso': request.form['iso'],
+                'ssh_key': request.form['ssh_key'],
+            }
+            if form['iso'] != 'none':
+                form['iso'] = '{}:iso/{}'.format(app.config['PROXMOX_ISO_STORAGE'], form['iso'])
             if not user.rtp:
-                usage_check = user.check_usage(cores, memory, disk)
+                usage_check = user.check_usage(form['cores'], form['memory'], form['disk'])
                 username = user.name
             else:
                 usage_check = None
                 username = sanitize_pool_name(request.form['user'])
             if usage_check:
                 return usage_check
-            else:
-                if is_hostname_valid(name) and is_hostname_available(proxmox, name):
-                    if template == 'none':
-                        q.enqueue(
-                            create_vm_task,
-                            username,
-                            name,
-                            cores,
-                            memory,
-                            disk,
-                            iso,
-                            job_timeout=300,
-                        )
-                    else:
-                        q.enqueue(
-                            setup_template_task,
-                            template,
-                            name,
-                            username,
-                            ssh_key,
-                            cores,
-                            memory,
-                            job_timeout=600,
-                        )
-                        return '', 200
+            created = _enqueue_create(proxmox, username, name, form)
+            if created is not None:
+                return jsonify(created)
             return '', 200
         return None
     else:
         return '', 403
 
 
+def _roster_hostname(prefix, user):
+    return re.sub(r'[^a-z0-9-]', '-', f'{prefix}-{user}'.lower()).strip('-')
+
+
+@app.route('/roster/provision', methods=['POST'])
+@auth.oidc_auth('default')
+def provision_roster():
+    user = User(flask_session['userinfo']['preferred_username'])
+    if not user.rtp:
+        return '', 403
+    usernames = []
+    for username in re.split(r'[\s,]+', request.form['users']):
+        username = sanitize_pool_name(username.strip())
+        if username and username not in usernames:
+            usernames.append(username)
+    if not usernames:
+        return 'No users given', 400
+    prefix = request.form['name_prefix']
+    entries = [
+        {'user': username, 'name': _roster_hostname(prefix, username)} for username in usernames
+    ]
+    rejected = [entry['name'] for entry in entries if not is_hostname_valid(entry['name'])]
+    if rejected:
+        return json.dumps({'invalid': rejected}), 400
+    reserved = []
+    for entry in entries:
+        if reserve_hostname(redis_conn, entry['name']):
+            reserved.append(entry['name'])
+        else:
+            rejected.append(entry['name'])
+    if rejected:
+        for name in reserved:
+            release_hostname(redis_conn, name)
+        return json.dumps({'invalid': rejected}), 400
+    job = provisioning_q.enqueue(
+        provision_roster_task,
+        entries,
+        request.form['template'],
+        request.form['cores'],
+        request.form['mem'],
+        request.form.get('ssh_key', ''),
+        job_timeout=app.config['ROSTER_JOB_TIMEOUT'],
+        meta={'users': usernames},
+        on_success=Callback(job_succeeded),
+        on_failure=Callback(job_failed),
+    )
+    publish_quietly(redis_conn, usernames, 'job', {'id': job.id, 'status': None, 'final': False})
+    return json.dumps({'job_id': job.id}), 200
+
+
+@app.route('/roster/<string:job_id>')
+@auth.oidc_auth('default')
+def roster_status(job_id):
+    user = User(flask_session['userinfo']['preferred_username'])
+    if not user.rtp:
+        return '', 403
+    job = provisioning_q.fetch_job(job_id)
+    if job is None:
+        abort(404)
+    return (
+        json.dumps(
+            {
+                'status': job.meta.get('status', job.get_status()),
+                'roster': job.meta.get('roster', {}),
+            }
+        ),
+        200,
+    )
+
+
 @app.route('/limits/<string:user>', methods=['POST'])
 @auth.oidc_auth('default')
 def set_limits(user):
@@ -1074,12 +1435,38 @@ def expire_sessions():
         return '', 403
     expired = _expire_all_sessions()
     try:
-        q.enqueue(enforce_session_timeouts_task, job_timeout=120)
+        interactive_q.enqueue(enforce_session_timeouts_task, job_timeout=120)
     except Exception as e:  # pylint: disable=broad-except
         logging.warning('Failed to enqueue session enforcement: %s', e)
     return jsonify({'expired': expired})
 
 
+@app.route('/admin/profile-token')
+@auth.oidc_auth('default')
+def profile_token():
+    user = User(flask_session['userinfo']['preferred_username'])
+    if not user.rtp:
+        return '', 403
+    return jsonify(
+        {
+            'token': make_profile_token(app, user.name),
+            'expires_in': app.config['PROFILING_TOKEN_TTL'],
+        }
+    )
+
+
+@app.route('/admin/profiles/<string:profile_id>')
+@auth.oidc_auth('default')
+def show_profile(profile_id):
+    user = User(flask_session['userinfo']['preferred_username'])
+    if not user.rtp:
+        return '', 403
+    profile = get_profile(redis_conn, profile_id)
+    if profile is None:
+        abort(404)
+    return Response(profile, mimetype='text/plain')
+
+
 @app.route('/admin/sessions/warn', methods=['POST'])
 @auth.oidc_auth('default')
 def warn_sessions():
@@ -1088,7 +1475,7 @@ def warn_sessions():
         return '', 403
     shortened = _shorten_all_sessions(3)
     try:
-        q.enqueue(enforce_session_timeouts_task, job_timeout=120)
+        interactive_q.enqueue(enforce_session_timeouts_task, job_timeout=120)
     except Exception as e:  # pylint: disable=broad-except
         logging.warning('Failed to enqueue session enforcement: %s', e)
     return jsonify({'shortened': shortened, 'minutes': 3})
@@ -1161,8 +1548,7 @@ def modify_shared_pool(name):
     if user.rtp:
         pool = get_shared_pool(db, name)
         if pool:
-            pool.members = members
-            db.commit()
+            set_shared_pool_members(db, name, members)
             _enqueue_settings_refresh()
             return '', 200
         return 'Pool not found', 400
@@ -1176,10 +1562,7 @@ def delete_shared_pool(name):
     user = User(flask_session['userinfo']['preferred_username'])
     name = sanitize_pool_name(name)
     if user.rtp:
-        pool = get_shared_pool(db, name)
-        if pool:
-            db.delete(pool)
-            db.commit()
+        if delete_shared_pool_entry(db, name):
             proxmox = connect_proxmox()
             proxmox.pools(name).delete()
             _enqueue_settings_refresh()
@@ -1204,30 +1587,15 @@ def allowed_users(user):
         return '', 403
 
 
-@app.route('/console/cleanup', methods=['POST'])
-def cleanup_vnc():
-    if request.form['token'] == app.config['VNC_CLEANUP_TOKEN']:
-        logging.info('Cleaning up targets file...')
-        with open(app.config['WEBSOCKIFY_TARGET_FILE'], 'w') as targets:
-            targets.truncate()
-        logging.info('Clearing vnc tokens from Redis...')
-        count = 0
-        ns_keys = 'vnc_token*'
-        for key in redis_conn.scan_iter(ns_keys):
-            redis_conn.delete(key)
-            count += 1
-        logging.info('Deleted %s key(s).', count)
-        return '', 200
-    logging.warning('Got bad cleanup request')
-    return '', 403
-
-
 @app.route('/template/<string:template_id>/disk')
 @auth.oidc_auth('default')
 def template_disk(template_id):
     if template_id == 'none':
         return '0'
-    return get_template_disk(db, template_id)
+    disk = get_template_disk(db, template_id)
+    if disk is None:
+        abort(404)
+    return disk
 
 
 @app.route('/template/<string:template_id>/edit', methods=['POST'])
@@ -1258,6 +1626,14 @@ def health():
     return jsonify({'status': 'ok'})
 
 
+@app.route('/metrics')
+def stage_metrics():
+    """
+    Provisioning stage and governor wait histograms in the Prometheus text format
+    """
+    return Response(render_metrics(redis_conn), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/session')
 @auth.oidc_auth('default')
 def session_info():
@@ -1286,11 +1662,5 @@ def session_info():
     )
 
 
-def exit_handler():
-    stop_websockify()
-
-
-atexit.register(exit_handler)
-
 if __name__ == '__main__':
     app.run(threaded=False)
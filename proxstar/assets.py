@@ -0,0 +1,187 @@
+"""Builds and serves fingerprinted static assets.
+
+The image build runs `python proxstar/assets.py proxstar/static`, which
+imports nothing from proxstar and so needs no configuration. It minifies
+script.js and the stylesheets, names each copy after a hash of its
+contents and writes gzip and brotli variants next to it in static/dist.
+noVNC is loaded as ES modules that import each other by relative path, so
+its tree is copied whole into one hashed directory instead. The mapping
+from source paths to built ones is written to static/dist/manifest.json.
+
+Once init_assets() has run, url_for('static', filename=...) links the
+built copy. Built copies are served with a year-long immutable
+Cache-Control and the best precompressed variant the browser accepts.
+Without a build, the source files are linked and served as before.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sys
+
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+FILES = ('js/script.js', 'css/styles.css', 'css/circle.css')
+TREES = ('noVNC',)
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.js', '.css', '.html', '.svg', '.json')
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _minify(path, data):
+    # The minifiers and brotli are only needed by the image build
+    # pylint: disable=import-outside-toplevel
+    try:
+        if path.endswith('.js'):
+            import rjsmin
+
+            return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+        if path.endswith('.css'):
+            import rcssmin
+
+            return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    except ImportError as e:
+        logging.warning('Not minifying %s: %s', path, e)
+    return data
+
+
+def _compress(path):
+    if not path.endswith(COMPRESSIBLE):
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli  # pylint: disable=import-outside-toplevel
+
+        variants['.br'] = brotli.compress(data)
+    except ImportError:
+        pass
+    for suffix, compressed in variants.items():
+        # Small files can grow; the original is served then
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def _fingerprint(chunks):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def _build_file(static_dir, source):
+    with open(os.path.join(static_dir, source), 'rb') as f:
+        data = _minify(source, f.read())
+    stem, ext = os.path.splitext(source)
+    target = f'{DIST_DIR}/{stem}.{_fingerprint([data])}{ext}'
+    path = os.path.join(static_dir, target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    _compress(path)
+    return target
+
+
+def _build_tree(static_dir, source):
+    root = os.path.join(static_dir, source)
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(dirpath, filename), root))
+    files.sort()
+    chunks = []
+    for name in files:
+        with open(os.path.join(root, name), 'rb') as f:
+            chunks.extend((name.encode('utf-8'), f.read()))
+    target = f'{DIST_DIR}/{source}.{_fingerprint(chunks)}'
+    shutil.copytree(root, os.path.join(static_dir, target))
+    for name in files:
+        _compress(os.path.join(static_dir, target, name))
+    return target
+
+
+def build(static_dir):
+    """Rebuilds static_dir/dist and returns the manifest."""
+    shutil.rmtree(os.path.join(static_dir, DIST_DIR), ignore_errors=True)
+    manifest = {}
+    for source in FILES:
+        manifest[source] = _build_file(static_dir, source)
+    for source in TREES:
+        if os.path.isdir(os.path.join(static_dir, source)):
+            manifest[source] = _build_tree(static_dir, source)
+        else:
+            logging.warning('Skipping %s: not found', source)
+    with open(os.path.join(static_dir, DIST_DIR, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def resolve(manifest, filename):
+    if filename in manifest:
+        return manifest[filename]
+    tree, _, rest = filename.partition('/')
+    if tree in TREES and tree in manifest and rest:
+        return f'{manifest[tree]}/{rest}'
+    return filename
+
+
+def send_built(static_dir, filename):
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        variant = safe_join(static_dir, filename + suffix)
+        if request.accept_encodings[encoding] and variant and os.path.isfile(variant):
+            response = send_from_directory(
+                static_dir, filename + suffix, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE
+            )
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(static_dir, filename, max_age=IMMUTABLE_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    # The name changes with the contents, so browsers never need to revalidate
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app):
+    manifest = load_manifest(app.static_folder)
+    if not manifest:
+        logging.info('No built assets; serving static files unhashed')
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):  # pylint: disable=unused-variable
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = resolve(manifest, values['filename'])
+
+    def static(filename):
+        # Files are handed to gunicorn's wsgi.file_wrapper, i.e. sendfile
+        if filename.startswith(f'{DIST_DIR}/'):
+            return send_built(app.static_folder, filename)
+        return app.send_static_file(filename)
+
+    app.view_functions['static'] = static
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    built = build(sys.argv[1] if len(sys.argv) > 1 else os.path.join('proxstar', 'static'))
+    logging.info('Built %s assets', len(built))
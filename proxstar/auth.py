@@ -1,20 +1,60 @@
-from flask_pyoidc import OIDCAuthentication
-from flask_pyoidc.provider_configuration import ClientMetadata, ProviderConfiguration
-from tenacity import retry
-
-
-@retry
-def get_auth(app):
-    auth = OIDCAuthentication(
-        provider_configurations={
-            'default': ProviderConfiguration(
-                issuer=app.config['OIDC_ISSUER'],
-                client_metadata=ClientMetadata(
-                    client_id=app.config['OIDC_CLIENT_ID'],
-                    client_secret=app.config['OIDC_CLIENT_SECRET'],
-                ),
-            ),
-        },
-        app=app,
-    )
-    return auth
+import threading
+from functools import wraps
+
+
+class DeferredAuth:
+    """Stands in for flask-pyoidc while proxstar is imported.
+
+    Views are decorated at import time, but flask-pyoidc is only imported
+    and bound to the app by init_app(), which create_app() calls. RQ
+    workers and the other entry points import proxstar without ever
+    paying for it.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.oidc = None
+        self._lock = threading.Lock()
+        self._logout_views = []
+        self._wrapped = {}
+
+    def init_app(self, app):
+        from proxstar.oidc import get_auth  # pylint: disable=import-outside-toplevel
+
+        self.oidc = get_auth(self.config)
+        self.oidc.init_app(app)
+        for fn in self._logout_views:
+            self._wrapped[fn] = self.oidc.oidc_logout(fn)
+
+    def _view(self, key, wrap):
+        # Wrapped once, on the first request, by the real decorator
+        if self.oidc is None:
+            raise RuntimeError('Authentication is not set up; serve create_app()')
+        if key not in self._wrapped:
+            with self._lock:
+                if key not in self._wrapped:
+                    self._wrapped[key] = wrap()
+        return self._wrapped[key]
+
+    def oidc_auth(self, provider_name):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapped(*args, **kwargs):
+                view = self._view(
+                    (provider_name, fn), lambda: self.oidc.oidc_auth(provider_name)(fn)
+                )
+                return view(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    def oidc_logout(self, fn):
+        # flask-pyoidc needs its logout views before the first login
+        self._logout_views.append(fn)
+
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            return self._view(fn, lambda: self.oidc.oidc_logout(fn))(*args, **kwargs)
+
+        return wrapped
@@ -4,7 +4,9 @@ import os
 from flask import current_app as app, has_app_context
 
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import exists
+from sqlalchemy import bindparam, delete, exists, insert, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from proxstar.ldapdb import is_rtp
 
@@ -18,6 +20,7 @@ from proxstar.models import (
     Usage_Limit,
     VM_Expiration,
     Shared_Pools,
+    Shared_Pool_Member,
     Student_Network,
 )
 
@@ -36,101 +39,152 @@ def _get_default_limits():
     )
 
 
+def _insert(db, model):
+    # INSERT ... ON CONFLICT for the bound dialect: Postgres in production,
+    # SQLite under test.
+    if db.get_bind().dialect.name == 'sqlite':
+        return sqlite_insert(model)
+    return postgresql_insert(model)
+
+
+def _insert_ignore(db, model, rows):
+    if rows:
+        db.execute(_insert(db, model).values(rows).on_conflict_do_nothing())
+
+
+def _upsert(db, model, rows, key, columns):
+    if rows:
+        stmt = _insert(db, model).values(rows)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[key],
+                set_={column: stmt.excluded[column] for column in columns},
+            )
+        )
+
+
+def _delete_returning(db, column, keys):
+    keys = set(keys)
+    if not keys:
+        return []
+    stmt = delete(column.class_).where(column.in_(keys)).returning(column)
+    deleted = db.execute(stmt).scalars().all()
+    db.commit()
+    return deleted
+
+
 def get_vm_expire(db, vmid, months):
-    if db.query(exists().where(VM_Expiration.id == vmid)).scalar():
-        expire = db.query(VM_Expiration).filter(VM_Expiration.id == vmid).one().expire_date
-    else:
+    return get_vm_expires(db, [vmid], months)[int(vmid)]
+
+
+def get_vm_expires(db, vmids, months):
+    vmids = {int(vmid) for vmid in vmids}
+    if not vmids:
+        return {}
+    expires = dict(
+        db.query(VM_Expiration.id, VM_Expiration.expire_date)
+        .filter(VM_Expiration.id.in_(vmids))
+        .all()
+    )
+    missing = vmids - expires.keys()
+    if missing:
         expire = datetime.date.today() + relativedelta(months=months)
-        new_expire = VM_Expiration(id=vmid, expire_date=expire)
-        db.add(new_expire)
+        _insert_ignore(
+            db,
+            VM_Expiration,
+            [{'id': vmid, 'expire_date': expire} for vmid in sorted(missing)],
+        )
         db.commit()
-    return expire
+        for vmid in missing:
+            expires[vmid] = expire
+    return expires
 
 
 def renew_vm_expire(db, vmid, months):
-    if db.query(exists().where(VM_Expiration.id == vmid)).scalar():
-        expire = db.query(VM_Expiration).filter(VM_Expiration.id == vmid).one()
-        new_expire = datetime.date.today() + relativedelta(months=months)
-        expire.expire_date = new_expire
-        db.commit()
-    else:
-        expire = datetime.date.today() + relativedelta(months=months)
-        new_expire = VM_Expiration(id=vmid, expire_date=expire)
-        db.add(new_expire)
-        db.commit()
+    renew_vm_expires(db, [vmid], months)
+
+
+def renew_vm_expires(db, vmids, months):
+    expire = datetime.date.today() + relativedelta(months=months)
+    rows = [{'id': vmid, 'expire_date': expire} for vmid in sorted({int(v) for v in vmids})]
+    _upsert(db, VM_Expiration, rows, 'id', ['expire_date'])
+    db.commit()
+    return expire
 
 
 def delete_vm_expire(db, vmid):
-    if db.query(exists().where(VM_Expiration.id == vmid)).scalar():
-        expire = db.query(VM_Expiration).filter(VM_Expiration.id == vmid).one()
-        db.delete(expire)
-        db.commit()
+    delete_vm_expires(db, [vmid])
 
 
-def get_expiring_vms(db):
-    expiring = []
-    today = datetime.date.today()
-    expire = db.query(VM_Expiration).filter((VM_Expiration.expire_date - today) <= 10).all()
-    for vm in expire:
-        expiring.append(vm.id)
-    return expiring
+def delete_vm_expires(db, vmids):
+    return _delete_returning(db, VM_Expiration.id, {int(vmid) for vmid in vmids})
+
+
+def get_expiring_vms(db, days=10):
+    cutoff = datetime.date.today() + datetime.timedelta(days=days)
+    expire = db.query(VM_Expiration.id).filter(VM_Expiration.expire_date <= cutoff).all()
+    return [vm.id for vm in expire]
 
 
 def get_user_usage_limits(db, user):
-    limits = {}
     if is_rtp(user):
-        limits['cpu'] = 1000
-        limits['mem'] = 1000
-        limits['disk'] = 100000
-    elif db.query(exists().where(Usage_Limit.id == user)).scalar():
-        limits['cpu'] = db.query(Usage_Limit).filter(Usage_Limit.id == user).one().cpu
-        limits['mem'] = db.query(Usage_Limit).filter(Usage_Limit.id == user).one().mem
-        limits['disk'] = db.query(Usage_Limit).filter(Usage_Limit.id == user).one().disk
-    else:
-        default_cpu, default_mem, default_disk = _get_default_limits()
-        limits['cpu'] = default_cpu
-        limits['mem'] = default_mem
-        limits['disk'] = default_disk
+        return {'cpu': 1000, 'mem': 1000, 'disk': 100000}
+    return get_users_usage_limits(db, [user])[user]
+
+
+def get_users_usage_limits(db, users):
+    users = set(users)
+    default_cpu, default_mem, default_disk = _get_default_limits()
+    limits = {
+        user: {'cpu': default_cpu, 'mem': default_mem, 'disk': default_disk} for user in users
+    }
+    if users:
+        for row in db.query(Usage_Limit).filter(Usage_Limit.id.in_(users)).all():
+            limits[row.id] = {'cpu': row.cpu, 'mem': row.mem, 'disk': row.disk}
     return limits
 
 
 def set_user_usage_limits(db, user, cpu, mem, disk):
-    if db.query(exists().where(Usage_Limit.id == user)).scalar():
-        limits = db.query(Usage_Limit).filter(Usage_Limit.id == user).one()
-        limits.cpu = cpu
-        limits.mem = mem
-        limits.disk = disk
-        db.commit()
-    else:
-        limits = Usage_Limit(id=user, cpu=cpu, mem=mem, disk=disk)
-        db.add(limits)
-        db.commit()
+    set_users_usage_limits(db, [user], cpu, mem, disk)
+
+
+def set_users_usage_limits(db, users, cpu, mem, disk):
+    rows = [{'id': user, 'cpu': cpu, 'mem': mem, 'disk': disk} for user in sorted(set(users))]
+    _upsert(db, Usage_Limit, rows, 'id', ['cpu', 'mem', 'disk'])
+    db.commit()
 
 
 def delete_user_usage_limits(db, user):
-    if db.query(exists().where(Usage_Limit.id == user)).scalar():
-        limits = db.query(Usage_Limit).filter(Usage_Limit.id == user).one()
-        db.delete(limits)
-        db.commit()
+    delete_users_usage_limits(db, [user])
+
+
+def delete_users_usage_limits(db, users):
+    return _delete_returning(db, Usage_Limit.id, users)
 
 
 def store_pool_cache(db, pools):
     db.query(Pool_Cache).delete()
-    for pool in pools:
-        pool_entry = Pool_Cache(
-            pool=pool['user'],
-            vms=pool['vms'],
-            num_vms=pool['num_vms'],
-            usage=pool['usage'],
-            limits=pool['limits'],
-            percents=pool['percents'],
+    if pools:
+        db.execute(
+            insert(Pool_Cache).values(
+                [
+                    {
+                        'pool': pool['user'],
+                        'vms': pool['vms'],
+                        'num_vms': pool['num_vms'],
+                        'usage': pool['usage'],
+                        'limits': pool['limits'],
+                        'percents': pool['percents'],
+                    }
+                    for pool in pools
+                ]
+            )
         )
-        db.add(pool_entry)
     db.commit()
 
 
 def get_pool_cache(db):
-    db_pools = db.query(Pool_Cache).all()
+    db_pools = db.query(Pool_Cache).order_by(Pool_Cache.pool).all()
     pools = []
     for pool in db_pools:
         pool_dict = {}
@@ -141,122 +195,148 @@ def get_pool_cache(db):
         pool_dict['limits'] = pool.limits
         pool_dict['percents'] = pool.percents
         pools.append(pool_dict)
-    pools = sorted(pools, key=lambda x: x['user'])
     return pools
 
 
 def get_ignored_pools(db):
-    ignored_pools = []
-    for pool in db.query(Ignored_Pools).all():
-        ignored_pools.append(pool.id)
-    return ignored_pools
+    return [row.id for row in db.query(Ignored_Pools.id).all()]
 
 
 def delete_ignored_pool(db, pool):
-    if db.query(exists().where(Ignored_Pools.id == pool)).scalar():
-        ignored_pool = db.query(Ignored_Pools).filter(Ignored_Pools.id == pool).one()
-        db.delete(ignored_pool)
-        db.commit()
+    delete_ignored_pools(db, [pool])
+
+
+def delete_ignored_pools(db, pools):
+    return _delete_returning(db, Ignored_Pools.id, pools)
 
 
 def add_ignored_pool(db, pool):
-    if not db.query(exists().where(Ignored_Pools.id == pool)).scalar():
-        ignored_pool = Ignored_Pools(id=pool)
-        db.add(ignored_pool)
-        db.commit()
+    add_ignored_pools(db, [pool])
+
+
+def add_ignored_pools(db, pools):
+    _insert_ignore(db, Ignored_Pools, [{'id': pool} for pool in sorted(set(pools))])
+    db.commit()
+
+
+def _template_dict(template):
+    return {'id': template.id, 'name': template.name, 'disk': template.disk}
 
 
 def get_templates(db):
-    templates = []
-    for template in db.query(Template).all():
-        template_dict = {}
-        template_dict['id'] = template.id
-        template_dict['name'] = template.name
-        template_dict['disk'] = template.disk
-        templates.append(template_dict)
-    return templates
+    return [_template_dict(template) for template in db.query(Template).all()]
+
+
+def _template_key(template_id):
+    # Template ids come straight from routes; anything that isn't a number
+    # can't match a template
+    try:
+        return int(template_id)
+    except (TypeError, ValueError):
+        return None
 
 
 def get_template(db, template_id):
-    template_dict = {}
-    if db.query(exists().where(Template.id == template_id)).scalar():
-        template = db.query(Template).filter(Template.id == template_id).one()
-        template_dict['id'] = template.id
-        template_dict['name'] = template.name
-        template_dict['disk'] = template.disk
-    return template_dict
+    template_id = _template_key(template_id)
+    if template_id is None:
+        return None
+    template = db.get(Template, template_id)
+    return _template_dict(template) if template else {}
+
+
+def get_templates_by_id(db, template_ids):
+    template_ids = {int(template_id) for template_id in template_ids}
+    if not template_ids:
+        return {}
+    return {
+        template.id: _template_dict(template)
+        for template in db.query(Template).filter(Template.id.in_(template_ids)).all()
+    }
 
 
 def get_template_disk(db, template_id):
-    disk = 0
-    if db.query(exists().where(Template.id == template_id)).scalar():
-        template = db.query(Template).filter(Template.id == template_id).one()
-        disk = template.disk
-    return str(disk)
+    template_id = _template_key(template_id)
+    if template_id is None:
+        return None
+    disk = db.query(Template.disk).filter(Template.id == template_id).scalar()
+    return str(disk or 0)
 
 
 def get_allowed_users(db):
-    allowed_users = []
-    for user in db.query(Allowed_Users).all():
-        allowed_users.append(user.id)
-    return allowed_users
+    return [row.id for row in db.query(Allowed_Users.id).all()]
+
+
+def is_allowed_user(db, user):
+    return db.query(exists().where(Allowed_Users.id == user)).scalar()
 
 
 def add_allowed_user(db, user):
-    if not db.query(exists().where(Allowed_Users.id == user)).scalar():
-        allowed_user = Allowed_Users(id=user)
-        db.add(allowed_user)
-        db.commit()
+    add_allowed_users(db, [user])
+
+
+def add_allowed_users(db, users):
+    _insert_ignore(db, Allowed_Users, [{'id': user} for user in sorted(set(users))])
+    db.commit()
 
 
 def delete_allowed_user(db, user):
-    if db.query(exists().where(Allowed_Users.id == user)).scalar():
-        allowed_user = db.query(Allowed_Users).filter(Allowed_Users.id == user).one()
-        db.delete(allowed_user)
-        db.commit()
+    delete_allowed_users(db, [user])
+
+
+def delete_allowed_users(db, users):
+    return _delete_returning(db, Allowed_Users.id, users)
 
 
 def set_template_info(db, template_id, name, disk):
-    if db.query(
-        exists().where(
-            Template.id == template_id,
-        )
-    ).scalar():
-        template = (
-            db.query(Template)
-            .filter(
-                Template.id == template_id,
-            )
-            .one()
-        )
-        template.name = name
-        template.disk = disk
-        db.commit()
+    set_templates_info(db, {template_id: (name, disk)})
+
+
+def set_templates_info(db, templates):
+    """Update name and disk for existing templates, given {id: (name, disk)}."""
+    if not templates:
+        return
+    table = Template.__table__
+    db.execute(
+        update(table)
+        .where(table.c.id == bindparam('template_id'))
+        .values(name=bindparam('template_name'), disk=bindparam('template_disk')),
+        [
+            {'template_id': int(template_id), 'template_name': name, 'template_disk': disk}
+            for template_id, (name, disk) in templates.items()
+        ],
+    )
+    db.commit()
 
 
 def sync_templates(db, templates):
     if templates is None:
         return
-    template_ids = set()
-    for template in templates:
-        template_id = int(template['id'])
-        template_ids.add(template_id)
-        record = db.query(Template).filter(Template.id == template_id).one_or_none()
+    incoming = {int(template['id']): template for template in templates}
+    existing = {}
+    if incoming:
+        existing = {
+            record.id: record
+            for record in db.query(Template).filter(Template.id.in_(incoming.keys())).all()
+        }
+    new_rows = []
+    for template_id, template in incoming.items():
+        record = existing.get(template_id)
         disk = template.get('disk')
         if record:
             record.name = template.get('name', record.name)
             if disk is not None and (record.disk == 0 or record.disk is None):
                 record.disk = disk
         else:
-            db.add(
-                Template(
-                    id=template_id,
-                    name=template.get('name', str(template_id)),
-                    disk=disk or 0,
-                )
+            new_rows.append(
+                {
+                    'id': template_id,
+                    'name': template.get('name', str(template_id)),
+                    'disk': disk or 0,
+                }
             )
-    if template_ids:
-        db.query(Template).filter(~Template.id.in_(template_ids)).delete(
+    _insert_ignore(db, Template, new_rows)
+    if incoming:
+        db.query(Template).filter(~Template.id.in_(incoming.keys())).delete(
             synchronize_session=False
         )
     else:
@@ -264,24 +344,80 @@ def sync_templates(db, templates):
     db.commit()
 
 
+def _clean_members(members):
+    return {member.strip() for member in members or [] if member and member.strip()}
+
+
 def add_shared_pool(db, name, members):
-    if db.query(Shared_Pools).get(name):
+    if db.get(Shared_Pools, name):
         return 'Name Already in Use'
-    db.add(Shared_Pools(name=name, members=members))
+    db.add(Shared_Pools(name=name))
+    db.flush()
+    _insert_shared_pool_members(db, name, _clean_members(members))
     db.commit()
+    return None
 
 
 def get_shared_pool(db, name):
-    return db.query(Shared_Pools).get(name)
+    return db.get(Shared_Pools, name)
 
 
 def get_shared_pools(db, user, all_pools):
     if all_pools:
         return db.query(Shared_Pools).all()
-    pools = []
-    for pool in db.query(Shared_Pools).filter(Shared_Pools.members.contains(f'{{{user}}}')).all():
-        pools.append(pool)
-    return pools
+    return (
+        db.query(Shared_Pools)
+        .join(Shared_Pool_Member, Shared_Pool_Member.pool == Shared_Pools.name)
+        .filter(Shared_Pool_Member.username == user)
+        .all()
+    )
+
+
+def get_shared_pool_members(db, name):
+    rows = (
+        db.query(Shared_Pool_Member.username)
+        .filter(Shared_Pool_Member.pool == name)
+        .order_by(Shared_Pool_Member.username)
+        .all()
+    )
+    return [row.username for row in rows]
+
+
+def is_shared_pool_member(db, name, user):
+    return db.query(
+        exists().where(Shared_Pool_Member.pool == name, Shared_Pool_Member.username == user)
+    ).scalar()
+
+
+def _insert_shared_pool_members(db, name, members):
+    _insert_ignore(
+        db,
+        Shared_Pool_Member,
+        [{'pool': name, 'username': member} for member in sorted(members)],
+    )
+
+
+def set_shared_pool_members(db, name, members):
+    members = _clean_members(members)
+    removed = delete(Shared_Pool_Member).where(Shared_Pool_Member.pool == name)
+    if members:
+        removed = removed.where(Shared_Pool_Member.username.notin_(members))
+    db.execute(removed)
+    _insert_shared_pool_members(db, name, members)
+    db.commit()
+    db.expire_all()
+
+
+def delete_shared_pool(db, name):
+    db.query(Shared_Pool_Member).filter(Shared_Pool_Member.pool == name).delete(
+        synchronize_session=False
+    )
+    deleted = (
+        db.query(Shared_Pools).filter(Shared_Pools.name == name).delete(synchronize_session=False)
+    )
+    db.commit()
+    db.expire_all()
+    return bool(deleted)
 
 
 def get_student_network(db, user):
@@ -0,0 +1,117 @@
+import json
+import logging
+import threading
+import time
+
+from proxstar.vmcache import invalidate_vm_lists
+
+EVENTS_CHANNEL_PREFIX = 'events|'
+# RTPs see every user's VMs, so they get every event
+RTP_EVENTS_CHANNEL = f'{EVENTS_CHANNEL_PREFIX}rtp'
+# Sent to the browser as the EventSource reconnect delay
+RECONNECT_MS = 3000
+# Retry-After for streams refused by StreamLimit; pages poll until then
+STREAM_LIMIT_RETRY_SECONDS = 30
+# Counters bumped with every event, so API responses can be tagged with a
+# version without building them
+GENERATION_PREFIX = 'generation|'
+RTP_GENERATION_KEY = f'{GENERATION_PREFIX}rtp'
+
+
+def get_user_channel(user):
+    return f'{EVENTS_CHANNEL_PREFIX}user|{user}'
+
+
+def get_user_generation_key(user):
+    return f'{GENERATION_PREFIX}user|{user}'
+
+
+def get_vm_generation_key(vmid):
+    return f'{GENERATION_PREFIX}vm|{vmid}'
+
+
+def bump_generations(redis_conn, users=(), vmids=()):
+    pipe = redis_conn.pipeline(transaction=False)
+    for user in set(users):
+        pipe.incr(get_user_generation_key(user))
+    for vmid in set(vmids):
+        pipe.incr(get_vm_generation_key(vmid))
+    pipe.incr(RTP_GENERATION_KEY)
+    invalidate_vm_lists(pipe, users)
+    pipe.execute()
+
+
+def get_generations(redis_conn, keys):
+    return [int(value or 0) for value in redis_conn.mget(keys)]
+
+
+def publish(redis_conn, users, event_type, data):
+    """Sends an event to each of users and to the RTP channel, bumps their
+    generations and drops their cached VM lists."""
+    message = json.dumps({'type': event_type, 'data': data})
+    pipe = redis_conn.pipeline(transaction=False)
+    for user in set(users):
+        pipe.publish(get_user_channel(user), message)
+        pipe.incr(get_user_generation_key(user))
+    pipe.publish(RTP_EVENTS_CHANNEL, message)
+    pipe.incr(RTP_GENERATION_KEY)
+    invalidate_vm_lists(pipe, users)
+    pipe.execute()
+
+
+def publish_quietly(redis_conn, users, event_type, data):
+    # Browsers resync on reconnect, so a lost event only delays an update
+    try:
+        publish(redis_conn, users, event_type, data)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error('Could not publish %s event: %s', event_type, e)
+
+
+def format_event(event_type, data):
+    return f'event: {event_type}\ndata: {json.dumps(data)}\n\n'
+
+
+class StreamLimit:
+    """Caps how many event streams one web process serves at once.
+
+    Each open stream holds a gunicorn thread for up to
+    EVENTS_STREAM_SECONDS. Without a cap, enough open tabs would leave no
+    thread for page loads, console POSTs or health checks.
+    """
+
+    def __init__(self, limit):
+        self._slots = threading.BoundedSemaphore(limit) if limit > 0 else None
+
+    def acquire(self):
+        return self._slots is not None and self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+
+def stream_events(redis_conn, channels, lifetime, keepalive):
+    """Yields Server-Sent Events for messages published on channels.
+
+    The stream ends after lifetime seconds so a long-open tab does not pin a
+    web worker thread forever; EventSource reconnects on its own. A comment
+    line is sent after keepalive idle seconds so proxies keep the response
+    open.
+    """
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*channels)
+    try:
+        yield f'retry: {RECONNECT_MS}\n\n'
+        deadline = time.monotonic() + lifetime
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None:
+                if time.monotonic() - last_sent >= keepalive:
+                    yield ': keepalive\n\n'
+                    last_sent = time.monotonic()
+                continue
+            event = json.loads(message['data'])
+            yield format_event(event['type'], event['data'])
+            last_sent = time.monotonic()
+    finally:
+        pubsub.close()
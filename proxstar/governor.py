@@ -0,0 +1,96 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from proxstar.metrics import GOVERNOR_WAIT_METRIC, observe_quietly
+
+GOVERNOR_PREFIX = 'governor|'
+
+# Takes a slot on every key or on none of them, so a job never holds a node
+# slot while it waits for a storage slot. Each slot is a sorted-set member
+# scored by its lease expiry. Slots whose lease ran out, e.g. from a worker
+# that died mid-clone, are dropped before counting.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expires = tonumber(ARGV[2])
+local token = ARGV[3]
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, expires, token)
+end
+return 1
+"""
+
+
+class GovernorTimeout(RuntimeError):
+    pass
+
+
+def slots_for(config, node, storage):
+    return [
+        (f'{GOVERNOR_PREFIX}node|{node}', config['GOVERNOR_NODE_LIMIT']),
+        (f'{GOVERNOR_PREFIX}storage|{storage}', config['GOVERNOR_STORAGE_LIMIT']),
+    ]
+
+
+def acquire(
+    redis_conn, slots, lease, wait_timeout, operation, poll_interval=1
+):  # pylint: disable=too-many-arguments
+    """Waits for a slot on every (key, limit) in slots and returns a token
+    for release(). Raises GovernorTimeout after wait_timeout seconds.
+
+    The time spent waiting goes to the governor wait histogram, labelled by
+    operation and resource, so limits can be tuned against storage
+    throughput.
+    """
+    keys = [key for key, _ in slots]
+    limits = [limit for _, limit in slots]
+    token = uuid.uuid4().hex
+    script = redis_conn.register_script(_ACQUIRE_SCRIPT)
+    start = time.time()
+    while True:
+        now = time.time()
+        if script(keys=keys, args=[now, now + lease, token, *limits]):
+            outcome = 'acquired'
+            break
+        if now - start >= wait_timeout:
+            outcome = 'timeout'
+            break
+        time.sleep(poll_interval)
+    waited = time.time() - start
+    for key in keys:
+        resource = key[len(GOVERNOR_PREFIX) :]
+        observe_quietly(
+            redis_conn,
+            GOVERNOR_WAIT_METRIC,
+            waited,
+            {'operation': operation, 'resource': resource, 'outcome': outcome},
+        )
+    if outcome == 'timeout':
+        names = ', '.join(keys)
+        raise GovernorTimeout(f'Timed out after {int(waited)}s waiting for {names}')
+    return (keys, token)
+
+
+def release(redis_conn, held):
+    keys, token = held
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.zrem(key, token)
+    pipe.execute()
+
+
+@contextmanager
+def governed(
+    redis_conn, slots, lease, wait_timeout, operation
+):  # pylint: disable=too-many-arguments
+    held = acquire(redis_conn, slots, lease, wait_timeout, operation)
+    try:
+        yield
+    finally:
+        release(redis_conn, held)
@@ -0,0 +1,98 @@
+import uuid
+
+from flask import current_app as app
+
+from proxstar.proxmox import connect_proxmox
+
+HOSTNAME_INDEX_KEY = 'hostnames'
+HOSTNAME_INDEX_FRESH_KEY = 'hostnames_fresh'
+HOSTNAME_RESERVATION_PREFIX = 'hostname_reserved|'
+# Names added since the last two rebuilds began. A rebuild's cluster
+# snapshot may predate them, so they are merged into the index it writes.
+HOSTNAME_RECENT_KEY = 'hostnames|recent'
+HOSTNAME_PREVIOUS_KEY = 'hostnames|previous'
+
+
+def get_reservation_key(name):
+    return f'{HOSTNAME_RESERVATION_PREFIX}{name}'
+
+
+def refresh_hostname_index(redis_conn, proxmox=None):
+    """Rebuilds the set of VM names from one cluster snapshot.
+
+    Names added while the snapshot is taken are merged back in, and the
+    index is replaced in one transaction, so readers never see a partial
+    index and no add_hostname() is lost. A name removed during the rebuild
+    stays taken until the next one, which only errs on the safe side.
+    """
+    if proxmox is None:
+        proxmox = connect_proxmox()
+    # Start a new generation of recent names; the last one is kept in case
+    # the snapshot lags behind Proxmox
+    pipe = redis_conn.pipeline()
+    pipe.sunionstore(HOSTNAME_PREVIOUS_KEY, [HOSTNAME_RECENT_KEY])
+    pipe.delete(HOSTNAME_RECENT_KEY)
+    pipe.execute()
+    names = {vm['name'] for vm in proxmox.cluster.resources.get(type='vm') if vm.get('name')}
+    staging_key = f'{HOSTNAME_INDEX_KEY}|staging|{uuid.uuid4().hex}'
+    pipe = redis_conn.pipeline()
+    if names:
+        pipe.sadd(staging_key, *names)
+    pipe.sunionstore(HOSTNAME_INDEX_KEY, [staging_key, HOSTNAME_RECENT_KEY, HOSTNAME_PREVIOUS_KEY])
+    pipe.delete(staging_key)
+    pipe.set(HOSTNAME_INDEX_FRESH_KEY, '1', ex=app.config['HOSTNAME_INDEX_TTL'])
+    pipe.execute()
+
+
+def _ensure_index(redis_conn, proxmox=None):
+    if not redis_conn.exists(HOSTNAME_INDEX_FRESH_KEY):
+        refresh_hostname_index(redis_conn, proxmox)
+
+
+def is_hostname_taken(redis_conn, name, proxmox=None):
+    # Only talks to Proxmox when the index has gone stale
+    _ensure_index(redis_conn, proxmox)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.sismember(HOSTNAME_INDEX_KEY, name)
+    pipe.exists(get_reservation_key(name))
+    in_cluster, reserved = pipe.execute()
+    return bool(in_cluster) or bool(reserved)
+
+
+def reserve_hostname(redis_conn, name, proxmox=None):
+    """Reserves name for a VM that is about to be created.
+
+    Returns False if a VM already has the name or another request reserved
+    it first. The reservation expires after HOSTNAME_RESERVATION_TTL seconds;
+    by then the VM is in the index or the job has released it.
+    """
+    _ensure_index(redis_conn, proxmox)
+    if redis_conn.sismember(HOSTNAME_INDEX_KEY, name):
+        return False
+    return bool(
+        redis_conn.set(
+            get_reservation_key(name), '1', nx=True, ex=app.config['HOSTNAME_RESERVATION_TTL']
+        )
+    )
+
+
+def release_hostname(redis_conn, name):
+    redis_conn.delete(get_reservation_key(name))
+
+
+def add_hostname(redis_conn, name):
+    # The VM exists now; the index holds the name from here on
+    pipe = redis_conn.pipeline()
+    pipe.sadd(HOSTNAME_INDEX_KEY, name)
+    pipe.sadd(HOSTNAME_RECENT_KEY, name)
+    pipe.delete(get_reservation_key(name))
+    pipe.execute()
+
+
+def remove_hostname(redis_conn, name):
+    # The VM is gone; the name can be reserved again
+    pipe = redis_conn.pipeline()
+    pipe.srem(HOSTNAME_INDEX_KEY, name)
+    pipe.srem(HOSTNAME_RECENT_KEY, name)
+    pipe.srem(HOSTNAME_PREVIOUS_KEY, name)
+    pipe.execute()
@@ -0,0 +1,124 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+
+STAGE_METRIC = 'proxstar_provision_stage_seconds'
+GOVERNOR_WAIT_METRIC = 'proxstar_governor_wait_seconds'
+CONSOLE_CONNECT_METRIC = 'proxstar_console_connect_seconds'
+CONSOLE_SESSION_METRIC = 'proxstar_console_session_seconds'
+CONSOLE_THROUGHPUT_METRIC = 'proxstar_console_throughput_bytes_per_second'
+HISTOGRAM_HELP = {
+    STAGE_METRIC: 'Time spent in each provisioning stage.',
+    GOVERNOR_WAIT_METRIC: 'Time spent waiting for a node or storage slot.',
+    CONSOLE_CONNECT_METRIC: 'Time from console handshake to VNC server connected.',
+    CONSOLE_SESSION_METRIC: 'Length of console sessions.',
+    CONSOLE_THROUGHPUT_METRIC: 'Average throughput of each console session.',
+}
+METRIC_SERIES_KEY = 'metrics|series'
+HISTOGRAM_PREFIX = 'metrics|histogram|'
+# Upper bounds in seconds; clones on slow storage can take tens of minutes
+HISTOGRAM_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+METRIC_BUCKETS = {
+    CONSOLE_CONNECT_METRIC: (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    CONSOLE_SESSION_METRIC: (10, 60, 300, 900, 1800, 3600, 7200, 14400, 28800),
+    CONSOLE_THROUGHPUT_METRIC: (1000, 10000, 100000, 1000000, 10000000, 100000000),
+}
+
+
+def get_buckets(metric):
+    return METRIC_BUCKETS.get(metric, HISTOGRAM_BUCKETS)
+
+
+def _series_key(metric, labels):
+    return HISTOGRAM_PREFIX + json.dumps({'metric': metric, 'labels': labels}, sort_keys=True)
+
+
+def observe(redis_conn, metric, seconds, labels):
+    # Histograms live in Redis so every worker adds to the same series.
+    # Buckets are stored cumulatively, as Prometheus expects them.
+    key = _series_key(metric, labels)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.sadd(METRIC_SERIES_KEY, key)
+    for bucket in get_buckets(metric):
+        if seconds <= bucket:
+            pipe.hincrby(key, f'le:{bucket}', 1)
+    pipe.hincrby(key, 'count', 1)
+    pipe.hincrbyfloat(key, 'sum', seconds)
+    pipe.execute()
+
+
+def observe_quietly(redis_conn, metric, seconds, labels):
+    # Metrics must never fail the job or request being measured
+    try:
+        observe(redis_conn, metric, seconds, labels)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error('Could not record %s: %s', metric, e)
+
+
+@contextmanager
+def timed_stage(job, redis_conn, stage, labels, start=None):
+    """Times one provisioning stage.
+
+    Start and end timestamps go in job.meta['timings'][stage]. The duration
+    is added to the histogram for labels (task, template, node), read when
+    the stage ends so callers can fill in the node once placement has run.
+    The outcome label is 'failed' if the stage raised or the caller set
+    timing['failed'], e.g. on a timeout. start backdates a stage that began
+    earlier in the job, such as a clone started before its wait.
+    """
+    timing = {'start': start or time.time()}
+    if job is not None:
+        job.meta.setdefault('timings', {})[stage] = timing
+    try:
+        yield timing
+    except Exception:
+        timing['failed'] = True
+        raise
+    finally:
+        timing['end'] = time.time()
+        if job is not None:
+            job.save_meta()
+        observe_quietly(
+            redis_conn,
+            STAGE_METRIC,
+            timing['end'] - timing['start'],
+            dict(labels, stage=stage, outcome='failed' if timing.get('failed') else 'ok'),
+        )
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(redis_conn):
+    """Renders every histogram in the Prometheus text exposition format."""
+    keys = sorted(key.decode('utf-8') for key in redis_conn.smembers(METRIC_SERIES_KEY))
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    series = {metric: [] for metric in HISTOGRAM_HELP}
+    for key, data in zip(keys, pipe.execute() if keys else []):
+        series_id = json.loads(key[len(HISTOGRAM_PREFIX) :])
+        if series_id['metric'] in series:
+            series[series_id['metric']].append((series_id['labels'], data))
+
+    lines = []
+    for metric, entries in series.items():
+        lines.append(f'# HELP {metric} {HISTOGRAM_HELP[metric]}')
+        lines.append(f'# TYPE {metric} histogram')
+        for labels, data in entries:
+            data = {field.decode('utf-8'): value.decode('utf-8') for field, value in data.items()}
+            label_str = ','.join(
+                f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())
+            )
+            for bucket in get_buckets(metric):
+                count = data.get(f'le:{bucket}', '0')
+                lines.append(f'{metric}_bucket{{{label_str},le="{bucket}"}} {count}')
+            count = data.get('count', '0')
+            lines.append(f'{metric}_bucket{{{label_str},le="+Inf"}} {count}')
+            total = data.get('sum', '0')
+            lines.append(f'{metric}_sum{{{label_str}}} {total}')
+            lines.append(f'{metric}_count{{{label_str}}} {count}')
+    return '\n'.join(lines) + '\n'
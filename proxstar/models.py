@@ -1,7 +1,6 @@
-from sqlalchemy import Column, Date, Integer, String
+from sqlalchemy import Column, Date, ForeignKey, Index, Integer, String
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.types import JSON, Text
 
 from proxstar.util import default_repr
@@ -13,7 +12,7 @@ Base = declarative_base()
 class VM_Expiration(Base):
     __tablename__ = 'vm_expiration'
     id = Column(Integer, primary_key=True)
-    expire_date = Column(Date, nullable=False)
+    expire_date = Column(Date, nullable=False, index=True)
 
 
 @default_repr
@@ -60,7 +59,27 @@ class Allowed_Users(Base):
 class Shared_Pools(Base):
     __tablename__ = 'shared_pools'
     name = Column(String(32), primary_key=True)
-    members = Column(MutableList.as_mutable(postgresql.ARRAY(String(32))))
+    member_entries = relationship(
+        'Shared_Pool_Member',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
+        lazy='selectin',
+        order_by='Shared_Pool_Member.username',
+    )
+
+    @property
+    def members(self):
+        return [entry.username for entry in self.member_entries]
+
+
+@default_repr
+class Shared_Pool_Member(Base):
+    __tablename__ = 'shared_pool_member'
+    # The primary key serves "who is in pool Y", the username index serves
+    # "which shared pools is user X in".
+    pool = Column(String(32), ForeignKey('shared_pools.name', ondelete='CASCADE'), primary_key=True)
+    username = Column(String(32), primary_key=True)
+    __table_args__ = (Index('ix_shared_pool_member_username', 'username', 'pool'),)
 
 
 @default_repr
@@ -0,0 +1,65 @@
+import threading
+
+from flask_pyoidc import OIDCAuthentication
+from flask_pyoidc.provider_configuration import ClientMetadata, ProviderConfiguration
+from flask_pyoidc.pyoidc_facade import PyoidcFacade
+from flask_pyoidc.redirect_uri_config import RedirectUriConfig
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+
+class LazyOIDCAuthentication(OIDCAuthentication):
+    """OIDCAuthentication that fetches the issuer's metadata on the first
+    login instead of in init_app.
+
+    An unreachable issuer then fails logins, and the next login tries again,
+    rather than keeping every web worker from booting.
+    """
+
+    def __init__(self, provider_configurations):
+        self._clients = None
+        self._clients_lock = threading.Lock()
+        super().__init__(provider_configurations)
+
+    @property
+    def clients(self):
+        if self._clients is None and self._redirect_uri_config is not None:
+            with self._clients_lock:
+                if self._clients is None:
+                    self._clients = self._build_clients()
+        return self._clients
+
+    @clients.setter
+    def clients(self, value):
+        self._clients = value
+
+    def init_app(self, app):
+        # Same as OIDCAuthentication.init_app, minus building the clients
+        if not self._redirect_uri_config:
+            self._redirect_uri_config = RedirectUriConfig.from_config(app.config)
+        app.add_url_rule(
+            '/' + self._redirect_uri_config.endpoint,
+            self._redirect_uri_config.endpoint,
+            self._handle_authentication_response,
+            methods=['GET', 'POST'],
+        )
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(max=5), reraise=True)
+    def _build_clients(self):
+        return {
+            name: PyoidcFacade(configuration, self._redirect_uri_config.full_uri)
+            for name, configuration in self._provider_configurations.items()
+        }
+
+
+def get_auth(config):
+    return LazyOIDCAuthentication(
+        provider_configurations={
+            'default': ProviderConfiguration(
+                issuer=config['OIDC_ISSUER'],
+                client_metadata=ClientMetadata(
+                    client_id=config['OIDC_CLIENT_ID'],
+                    client_secret=config['OIDC_CLIENT_SECRET'],
+                ),
+            ),
+        },
+    )
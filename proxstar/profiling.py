@@ -0,0 +1,297 @@
+"""Per-request instrumentation for the web app.
+
+With PROFILING_ENABLED, every request counts and times its Proxmox calls,
+SQL statements, Redis commands and template renders. The totals go out as a
+Server-Timing header. A sample of requests slower than
+PROFILING_SLOW_SECONDS is logged with the slowest calls and where they were
+made from.
+
+Independently of that, an RTP can run one request under cProfile by adding
+?profile=<token> with a token from /admin/profile-token. The stats are kept
+in Redis and linked from the X-Proxstar-Profile response header. cProfile
+can only run once per process and, since Python 3.12, records every thread,
+so the stats also hold whatever other requests did meanwhile. Only one
+capture runs at a time; a request that asks while another capture (or any
+other profiler) is running is served normally and says why in the
+X-Proxstar-Profile-Skipped header.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import (
+    before_render_template,
+    g,
+    has_request_context,
+    request,
+    session,
+    template_rendered,
+)
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+
+PROFILE_PREFIX = 'profile|'
+PROFILE_TTL = 3600
+PROFILE_ARG = 'profile'
+KINDS = ('proxmox', 'sql', 'redis', 'template')
+# Slowest calls listed per kind in the slow-request log
+SLOW_LOG_CALLS = 5
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Held while a ?profile= capture runs
+_capture_lock = threading.Lock()
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.calls = {kind: [] for kind in KINDS}
+        self.rendering = []
+
+    def add(self, kind, seconds, detail):
+        self.calls[kind].append((seconds, detail))
+
+    def total(self, kind):
+        return sum(seconds for seconds, _ in self.calls[kind])
+
+    def server_timing(self, elapsed):
+        metrics = [
+            f'{kind};dur={self.total(kind) * 1000:.1f};desc="{len(calls)} calls"'
+            for kind, calls in self.calls.items()
+            if calls
+        ]
+        metrics.append(f'total;dur={elapsed * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def breakdown(self):
+        lines = []
+        for kind, calls in self.calls.items():
+            if not calls:
+                continue
+            lines.append(f'  {kind}: {len(calls)} calls, {self.total(kind):.3f}s')
+            for seconds, detail in sorted(calls, key=lambda call: -call[0])[:SLOW_LOG_CALLS]:
+                lines.append(f'    {seconds:.3f}s {detail}')
+        return '\n'.join(lines)
+
+
+def _current():
+    return g.get('request_profile') if has_request_context() else None
+
+
+def _call_site():
+    # The innermost Proxstar frame outside this module, e.g. the lazy
+    # property or route that made the call
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIR) and filename != __file__:
+            return f'{os.path.relpath(filename, _PACKAGE_DIR)}:{frame.f_lineno}'
+        frame = frame.f_back
+    return '?'
+
+
+def record(kind, seconds, detail):
+    profile = _current()
+    if profile is not None:
+        profile.add(kind, seconds, f'{detail} ({_call_site()})')
+
+
+def watch_proxmox(proxmox):
+    """Records every HTTP call made through proxmox, a ProxmoxAPI."""
+
+    def on_response(response, *args, **kwargs):  # pylint: disable=unused-argument
+        path = response.request.path_url.split('/api2/json', 1)[-1]
+        record('proxmox', response.elapsed.total_seconds(), f'{response.request.method} {path}')
+
+    # pylint: disable=protected-access
+    proxmox._store['session'].hooks['response'].append(on_response)
+
+
+def watch_redis(redis_conn):
+    execute_command = redis_conn.execute_command
+    pipeline = redis_conn.pipeline
+
+    def timed_execute_command(*args, **options):
+        start = time.perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            record('redis', time.perf_counter() - start, args[0])
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*exec_args, **exec_kwargs):
+            commands = len(pipe.command_stack)
+            start = time.perf_counter()
+            try:
+                return execute(*exec_args, **exec_kwargs)
+            finally:
+                record('redis', time.perf_counter() - start, f'pipeline of {commands}')
+
+        pipe.execute = timed_execute
+        return pipe
+
+    redis_conn.execute_command = timed_execute_command
+    redis_conn.pipeline = timed_pipeline
+
+
+def watch_sql(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, *args):  # pylint: disable=unused-argument,unused-variable
+        conn.info.setdefault('profiling_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(
+        conn, cursor, statement, *args
+    ):  # pylint: disable=unused-argument,unused-variable
+        seconds = time.perf_counter() - conn.info['profiling_start'].pop()
+        record('sql', seconds, ' '.join(statement.split())[:80])
+
+
+def _before_render(app, template, context):  # pylint: disable=unused-argument
+    profile = _current()
+    if profile is not None:
+        profile.rendering.append(time.perf_counter())
+
+
+def _rendered(app, template, context):  # pylint: disable=unused-argument
+    profile = _current()
+    if profile is not None and profile.rendering:
+        record('template', time.perf_counter() - profile.rendering.pop(), template.name)
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt='proxstar-profile')
+
+
+def make_profile_token(app, user):
+    return _serializer(app).dumps(user)
+
+
+def _profile_requested(app):
+    token = request.args.get(PROFILE_ARG)
+    if not token:
+        return False
+    try:
+        user = _serializer(app).loads(token, max_age=app.config['PROFILING_TOKEN_TTL'])
+    except BadSignature:
+        return False
+    # Tokens only work for the RTP who asked for them
+    return user == session.get('userinfo', {}).get('preferred_username')
+
+
+def get_profile(redis_conn, profile_id):
+    value = redis_conn.get(f'{PROFILE_PREFIX}{profile_id}')
+    return value.decode('utf-8') if value is not None else None
+
+
+def _start_capture():
+    """Returns an enabled profiler, or the reason none could be started."""
+    if not _capture_lock.acquire(blocking=False):
+        return None, 'another profile is being captured'
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # e.g. 'Another profiling tool is already active'
+        _capture_lock.release()
+        return None, str(e)
+    return profiler, None
+
+
+def _finish_capture(profiler):
+    try:
+        profiler.disable()
+    finally:
+        _capture_lock.release()
+
+
+def _save_profile(redis_conn, profiler, profile_id):
+    output = io.StringIO()
+    output.write('Process-wide: includes every thread that ran during the request.\n')
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(60)
+    redis_conn.set(f'{PROFILE_PREFIX}{profile_id}', output.getvalue(), ex=PROFILE_TTL)
+
+
+def _finish(app, redis_conn, label, profile, elapsed, profiler, profile_id):
+    if profile is not None and (
+        elapsed >= app.config['PROFILING_SLOW_SECONDS']
+        and random.random() < app.config['PROFILING_SLOW_SAMPLE_RATE']
+    ):
+        logging.warning('Slow request %s took %.3fs\n%s', label, elapsed, profile.breakdown())
+    if profiler is not None:
+        _finish_capture(profiler)
+        try:
+            _save_profile(redis_conn, profiler, profile_id)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Could not save profile: %s', e)
+
+
+def init_profiling(app, engine, redis_conn):
+    """Hooks profiling into app. Proxmox clients are watched as they are
+    created, by attempt_proxmox_connection."""
+    enabled = app.config['PROFILING_ENABLED']
+    if enabled:
+        watch_sql(engine)
+        watch_redis(redis_conn)
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_profile():  # pylint: disable=unused-variable
+        if enabled:
+            g.request_profile = RequestProfile()
+        if _profile_requested(app):
+            g.profiler, g.profile_skipped = _start_capture()
+
+    @app.after_request
+    def finish_profile(response):  # pylint: disable=unused-variable
+        skipped = g.pop('profile_skipped', None)
+        if skipped:
+            response.headers['X-Proxstar-Profile-Skipped'] = skipped
+        profiler = g.pop('profiler', None)
+        profile_id = None
+        if profiler is not None:
+            # Named now so the header can link stats saved after the body
+            profile_id = uuid.uuid4().hex
+            response.headers['X-Proxstar-Profile'] = f'/admin/profiles/{profile_id}'
+        label = f'{request.method} {request.path}'
+        if response.is_streamed:
+            # Streamed pages load their data while the body is sent, after
+            # this hook, so profiling ends when the response is closed. The
+            # headers are gone by then; the totals only reach the slow log.
+            profile = g.get('request_profile')
+
+            def finish_streamed():
+                elapsed = time.perf_counter() - profile.start if profile is not None else 0
+                _finish(
+                    app, redis_conn, f'{label} (streamed)', profile, elapsed, profiler, profile_id
+                )
+
+            response.call_on_close(finish_streamed)
+            return response
+        # Popped first so saving the cProfile stats isn't counted
+        profile = g.pop('request_profile', None)
+        elapsed = 0
+        if profile is not None:
+            elapsed = time.perf_counter() - profile.start
+            response.headers['Server-Timing'] = profile.server_timing(elapsed)
+        _finish(app, redis_conn, label, profile, elapsed, profiler, profile_id)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):  # pylint: disable=unused-variable,unused-argument
+        # after_request doesn't run when a view raises; the lock must still go
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            _finish_capture(profiler)
@@ -1,11 +1,15 @@
 import math
+import time
 
 from flask import current_app as app
 from proxmoxer import ProxmoxAPI
+from redis import Redis
 
 from proxstar import logging
 from proxstar.db import get_ignored_pools
 from proxstar.ldapdb import is_user
+from proxstar.profiling import watch_proxmox
+from proxstar.vmid import release_vmid, reserve_vmid
 
 
 def connect_proxmox(host=None):
@@ -36,6 +40,8 @@ def attempt_proxmox_connection(host):
         timeout=app.config.get('PROXMOX_TIMEOUT', 10),
         verify_ssl=False,
     )
+    if app.config.get('PROFILING_ENABLED'):
+        watch_proxmox(proxmox)
     proxmox.version.get()
     return proxmox
 
@@ -46,8 +52,44 @@ def get_node_least_mem(proxmox):
     return sorted_nodes[0]['node']
 
 
+def get_nodes_by_free_mem(proxmox):
+    nodes = [node for node in proxmox.nodes.get() if node.get('status', 'online') == 'online']
+    return sorted(nodes, key=lambda x: ('mem' not in x, x.get('mem', None)))
+
+
+def wait_for_task(proxmox, upid, timeout=600, interval=3):
+    node = upid.split(':', 2)[1]
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = proxmox.nodes(node).tasks(upid).status.get()
+        if status.get('status') == 'stopped':
+            exitstatus = status.get('exitstatus', '')
+            if exitstatus and exitstatus != 'OK':
+                raise RuntimeError(f'Proxmox task {upid} failed: {exitstatus}')
+            return True
+        time.sleep(interval)
+    raise RuntimeError(f'Proxmox task timed out after {timeout}s: {upid}')
+
+
+def _vmid_redis():
+    return Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+
+
 def get_free_vmid(proxmox):
-    return proxmox.cluster.nextid.get()
+    # cluster/nextid is not a reservation: concurrent jobs asking at the same
+    # time get the same answer. Reserve from the configured range instead.
+    used = {int(vm['vmid']) for vm in proxmox.cluster.resources.get(type='vm')}
+    return reserve_vmid(
+        _vmid_redis(),
+        used,
+        app.config['VMID_RANGE_START'],
+        app.config['VMID_RANGE_END'],
+        app.config['VMID_RESERVATION_TTL'],
+    )
+
+
+def release_free_vmid(vmid):
+    release_vmid(_vmid_redis(), vmid)
 
 
 def get_vm_node(proxmox, vmid):
@@ -57,6 +99,13 @@ def get_vm_node(proxmox, vmid):
     return None
 
 
+def get_vmid_by_name(proxmox, name, pool):
+    for vm in proxmox.cluster.resources.get(type='vm'):
+        if vm.get('name') == name and vm.get('pool') == pool and not vm.get('template'):
+            return int(vm['vmid'])
+    return None
+
+
 def get_isos(proxmox, storage):
     isos = []
     first_node = app.config['PROXMOX_HOSTS'][0].split('.')[0]  # Get the name of the first node.
@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+# Queue names, highest priority first. Workers started without an explicit
+# queue list listen on all of them in this order, so a burst of clones or a
+# slow cache refresh never delays a student's delete or power action.
+INTERACTIVE_QUEUE = 'interactive'
+PROVISIONING_QUEUE = 'provisioning'
+MAINTENANCE_QUEUE = 'maintenance'
+QUEUE_PRIORITY = (INTERACTIVE_QUEUE, PROVISIONING_QUEUE, MAINTENANCE_QUEUE)
+
+DEBOUNCE_PREFIX = 'debounce|'
+# Create submissions claimed or enqueued, by user and VM name
+CREATE_REQUEST_PREFIX = 'create_request|'
+
+
+def get_queue(connection, name, default_timeout=360):
+    return Queue(name, connection=connection, default_timeout=default_timeout)
+
+
+def is_scheduled_on(scheduler, job_id, queue_name):
+    # Jobs registered before the queues were split still point at the old
+    # default queue; cancel them so the caller re-registers them.
+    if job_id not in scheduler:
+        return False
+    try:
+        job = Job.fetch(job_id, connection=scheduler.connection)
+    except NoSuchJobError:
+        scheduler.cancel(job_id)
+        return False
+    if job.origin == queue_name:
+        return True
+    scheduler.cancel(job_id)
+    return False
+
+
+def enqueue_debounced(scheduler, queue_name, func, delay, timeout=None):
+    """Run func once, delay seconds from now. Calls made while that run is
+    still pending collapse into it and return None."""
+    name = func.__name__
+    job_id = f'debounced:{name}:{int(time.time())}'
+    if not scheduler.connection.set(f'{DEBOUNCE_PREFIX}{name}', job_id, nx=True, ex=delay):
+        return None
+    return scheduler.enqueue_in(
+        timedelta(seconds=delay),
+        func,
+        job_id=job_id,
+        queue_name=queue_name,
+        timeout=timeout,
+    )
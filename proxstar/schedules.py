@@ -0,0 +1,83 @@
+"""Registers Proxstar's periodic jobs with rq-scheduler.
+
+start_scheduler.sh runs this (`python -m proxstar.schedules`) before
+starting rqscheduler, so web and worker processes never touch the schedule.
+"""
+
+import datetime
+import logging
+import os
+
+from flask import Flask
+from redis import Redis
+from rq_scheduler import Scheduler
+
+from proxstar.queues import MAINTENANCE_QUEUE, is_scheduled_on
+from proxstar.tasks import (
+    enforce_session_timeouts_task,
+    generate_pool_cache_task,
+    process_expiring_vms_task,
+    sweep_vnc_tokens_task,
+    sync_templates_task,
+)
+
+
+def _schedule_every(scheduler, job_id, func, interval):
+    if not is_scheduled_on(scheduler, job_id, MAINTENANCE_QUEUE):
+        logging.info('adding %s task to scheduler', job_id)
+        scheduler.schedule(
+            id=job_id,
+            queue_name=MAINTENANCE_QUEUE,
+            scheduled_time=datetime.datetime.utcnow(),
+            func=func,
+            interval=interval,
+        )
+
+
+def register_schedules(scheduler, config):
+    _schedule_every(scheduler, 'generate_pool_cache', generate_pool_cache_task, 90)
+
+    if config.get('ENABLE_VM_EXPIRATION') and not is_scheduled_on(
+        scheduler, 'process_expiring_vms', MAINTENANCE_QUEUE
+    ):
+        logging.info('adding process_expiring_vms task to scheduler')
+        scheduler.cron(
+            '0 2 * * *',
+            id='process_expiring_vms',
+            func=process_expiring_vms_task,
+            queue_name=MAINTENANCE_QUEUE,
+        )
+
+    # Replaced by sweep_vnc_tokens; its task no longer exists
+    if 'cleanup_vnc' in scheduler:
+        scheduler.cancel('cleanup_vnc')
+
+    _schedule_every(
+        scheduler, 'sweep_vnc_tokens', sweep_vnc_tokens_task, config['VNC_TOKEN_SWEEP_INTERVAL']
+    )
+
+    if config.get('TEMPLATE_POOL'):
+        _schedule_every(scheduler, 'sync_templates', sync_templates_task, 300)
+
+    _schedule_every(
+        scheduler,
+        'enforce_session_timeouts',
+        enforce_session_timeouts_task,
+        config['SESSION_CHECK_INTERVAL_SECONDS'],
+    )
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    app = Flask(__name__)
+    if os.path.exists(os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')):
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')
+    else:
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config.py')
+    app.config.from_pyfile(config)
+    redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+    register_schedules(Scheduler(connection=redis_conn), app.config)
+
+
+if __name__ == '__main__':
+    main()
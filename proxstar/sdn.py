@@ -383,7 +383,7 @@ def allocate_student_subnet(db, base_cidr, prefix_len, proxmox=None, reserved=No
     raise RuntimeError('No available subnets in SDN base CIDR')
 
 
-def ensure_student_network(db, config, user, proxmox=None):
+def ensure_student_network(db, config, user, proxmox=None, apply_now=True):
     entry = get_student_network(db, user)
     if proxmox is None:
         proxmox = connect_proxmox()
@@ -429,7 +429,8 @@ def ensure_student_network(db, config, user, proxmox=None):
             ensure_vnet(config, vnet_name, proxmox, alias=vnet_alias, apply_now=False)
             ensure_subnet(config, vnet_name, subnet, proxmox, apply_now=False)
             ensure_firewall_group_rule(config, vnet_name, proxmox, apply_now=False)
-            require_sdn_apply(proxmox, config=config)
+            if apply_now:
+                require_sdn_apply(proxmox, config=config)
         except SubnetCollision as e:
             logging.warning('SDN: subnet collision for %s (%s)', user, e.subnet_cidr)
             adopt_vnet = _find_vnet_by_alias(proxmox, vnet_alias)
@@ -473,7 +474,8 @@ def ensure_student_network(db, config, user, proxmox=None):
             ensure_vnet(config, vnet_name, proxmox, alias=vnet_alias, apply_now=False)
             ensure_subnet(config, vnet_name, subnet, proxmox, apply_now=False)
             ensure_firewall_group_rule(config, vnet_name, proxmox, apply_now=False)
-            require_sdn_apply(proxmox, config=config)
+            if apply_now:
+                require_sdn_apply(proxmox, config=config)
         except SubnetCollision as e:
             db.rollback()
             reserved.add(e.subnet_cidr)
@@ -489,3 +491,24 @@ def ensure_student_network(db, config, user, proxmox=None):
         return entry.vnet, entry.subnet
 
     raise RuntimeError('Unable to allocate a unique SDN subnet')
+
+
+def ensure_student_networks(db, config, users, proxmox=None):
+    """Set up the networks for many users with a single SDN apply.
+
+    Returns ({user: (vnet, subnet)}, {user: error}) for the users that
+    succeeded and failed.
+    """
+    if proxmox is None:
+        proxmox = connect_proxmox()
+    networks = {}
+    errors = {}
+    for user in users:
+        try:
+            networks[user] = ensure_student_network(db, config, user, proxmox, apply_now=False)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('SDN: network setup failed for %s: %s', user, e)
+            errors[user] = e
+    if networks:
+        require_sdn_apply(proxmox, config=config)
+    return networks, errors
@@ -1,5 +1,6 @@
 import time
 
+from proxstar.events import publish_quietly
 
 SESSION_KEY_PREFIX = 'session_start|'
 SESSION_SHUTDOWN_PREFIX = 'session_shutdown|'
@@ -24,12 +25,14 @@ def set_session_start(redis_conn, user, start_ts=None):
     if start_ts is None:
         start_ts = time.time()
     redis_conn.set(get_session_key(user), str(start_ts))
+    publish_quietly(redis_conn, [user], 'session', {'user': user, 'session_start': start_ts})
     return start_ts
 
 
 def clear_session(redis_conn, user):
     redis_conn.delete(get_session_key(user))
     redis_conn.delete(get_shutdown_key(user))
+    publish_quietly(redis_conn, [user], 'session', {'user': user, 'session_start': None})
 
 
 def get_shutdown_started(redis_conn, user):
@@ -1,5 +1,110 @@
 /*jshint esversion: 6 */
 
+// One EventSource per tab, shared by every widget that needs live updates.
+// Handlers are debounced so a burst of events triggers a single refresh, and
+// 'reconnect' handlers run after the stream drops so missed events are
+// caught up with one fetch. When the server refuses the stream (it caps open
+// streams per worker), 'reconnect' handlers poll until a retry gets through.
+const proxstarEvents = (() => {
+    const handlers = {};
+    const fallbackPollMs = 30000;
+    let source = null;
+    let opened = false;
+    let fallbackTimer = null;
+    const debounce = (fn, delayMs) => {
+        let timer = null;
+        return (data) => {
+            clearTimeout(timer);
+            timer = setTimeout(() => fn(data), delayMs);
+        };
+    };
+    const dispatch = (type, data) => {
+        (handlers[type] || []).forEach((handler) => handler(data));
+    };
+    const listen = (type) => {
+        source.addEventListener(type, (event) => {
+            let data = null;
+            try {
+                data = JSON.parse(event.data);
+            } catch (err) {
+                return;
+            }
+            dispatch(type, data);
+        });
+    };
+    const connect = () => {
+        if (source || typeof EventSource === 'undefined') {
+            return;
+        }
+        source = new EventSource('/api/events');
+        source.addEventListener('open', () => {
+            clearInterval(fallbackTimer);
+            fallbackTimer = null;
+            if (opened) {
+                dispatch('reconnect', null);
+            }
+            opened = true;
+        });
+        source.addEventListener('error', () => {
+            // Dropped streams reconnect on their own; refused ones are closed
+            if (source.readyState !== EventSource.CLOSED) {
+                return;
+            }
+            source = null;
+            opened = true;
+            if (!fallbackTimer) {
+                dispatch('reconnect', null);
+                fallbackTimer = setInterval(() => dispatch('reconnect', null), fallbackPollMs);
+            }
+            setTimeout(connect, fallbackPollMs + Math.random() * fallbackPollMs);
+        });
+        Object.keys(handlers).forEach((type) => {
+            if (type !== 'reconnect') {
+                listen(type);
+            }
+        });
+    };
+    const on = (type, handler) => {
+        if (!handlers[type]) {
+            handlers[type] = [];
+            if (source && type !== 'reconnect') {
+                listen(type);
+            }
+        }
+        handlers[type].push(debounce(handler, 250));
+    };
+    return { on, connect };
+})();
+
+// The JSON APIs tag their responses with an ETag. Revalidating against it
+// turns an unchanged refresh into an empty 304, and 'changed' lets callers
+// skip re-rendering. The stored copy is used since the HTTP cache is bypassed
+// to see the 304 at all.
+const etagCache = new Map();
+
+function fetchJsonWithEtag(url, errorName) {
+    const cached = etagCache.get(url);
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+    return fetch(url, { credentials: 'same-origin', cache: 'no-store', headers })
+        .then((response) => {
+            if (response.status === 304 && cached) {
+                return { data: cached.data, changed: false };
+            }
+            if (!response.ok) {
+                throw new Error(errorName);
+            }
+            return response.json().then((data) => {
+                const etag = response.headers.get('ETag');
+                if (etag) {
+                    etagCache.set(url, { etag, data });
+                } else {
+                    etagCache.delete(url);
+                }
+                return { data, changed: true };
+            });
+        });
+}
+
 $(document).ready(function(){
     $('[data-toggle="tooltip"]').tooltip();
     initSessionTimer();
@@ -10,6 +115,7 @@ $(document).ready(function(){
     initRunningVmsRefresh();
     initPageLoader();
     initVmHardware();
+    proxstarEvents.connect();
 });
 
 function initSessionTimer() {
@@ -78,12 +184,13 @@ function initSessionTimer() {
     window.proxstarRefreshSessionTimer = fetchSession;
     fetchSession();
     setInterval(tick, 1000);
-    setInterval(fetchSession, 30000);
+    proxstarEvents.on('session', fetchSession);
+    proxstarEvents.on('reconnect', fetchSession);
 }
 
 function initPendingVmRefresh() {
     const container = document.getElementById('vm-list');
-    if (!container) {
+    if (!container || container.dataset.live !== 'true') {
         return;
     }
     const getPendingCards = () => document.querySelectorAll('.vm-card[data-pending="true"]');
@@ -92,16 +199,12 @@ function initPendingVmRefresh() {
     }
     const viewUser = container.dataset.viewUser;
     const url = viewUser ? `/api/pending-vms?user=${encodeURIComponent(viewUser)}` : '/api/pending-vms';
-    const pollIntervalMs = 5000;
     const poll = () => {
-        fetch(url, { credentials: 'same-origin' })
-            .then((response) => {
-                if (!response.ok) {
-                    throw new Error('pending-vms-fetch-failed');
+        fetchJsonWithEtag(url, 'pending-vms-fetch-failed')
+            .then(({ data, changed }) => {
+                if (!changed) {
+                    return;
                 }
-                return response.json();
-            })
-            .then((data) => {
                 const pending = Array.isArray(data.pending) ? data.pending : [];
                 const statusMap = new Map();
                 pending.forEach((entry) => {
@@ -109,7 +212,7 @@ function initPendingVmRefresh() {
                         statusMap.set(entry.name, entry.status || 'no status yet');
                     }
                 });
-                let shouldReload = false;
+                let finished = false;
                 getPendingCards().forEach((card) => {
                     const name = card.dataset.vmName;
                     if (!name) {
@@ -121,76 +224,141 @@ function initPendingVmRefresh() {
                             statusEl.textContent = statusMap.get(name);
                         }
                     } else {
-                        shouldReload = true;
+                        finished = true;
                     }
                 });
-                if (shouldReload || (getPendingCards().length && pending.length === 0)) {
-                    window.location.reload();
+                // Finished VMs get their real card from the list refresh
+                if (finished && window.proxstarRefreshVmList) {
+                    window.proxstarRefreshVmList();
                 }
             })
             .catch(() => {
-                // Ignore transient failures; the next poll will retry.
+                // Ignore transient failures; the next event will retry.
             });
     };
     poll();
-    setInterval(poll, pollIntervalMs);
+    proxstarEvents.on('job', poll);
+    proxstarEvents.on('reconnect', poll);
+}
+
+// Swaps in freshly rendered cards for the named VMs and puts every card in
+// the order the API listed them. Only VMs that appeared or stopped being
+// pending need new markup; status changes are patched in place.
+function replaceVmCards(row, vms, cards) {
+    const columns = new Map();
+    row.querySelectorAll('.vm-card-col').forEach((column) => {
+        columns.set(column.dataset.vmName, column);
+    });
+    vms.forEach((vm) => {
+        if (!cards[vm.name]) {
+            return;
+        }
+        const template = document.createElement('template');
+        template.innerHTML = cards[vm.name].trim();
+        const column = template.content.firstElementChild;
+        const old = columns.get(vm.name);
+        if (old) {
+            old.replaceWith(column);
+        }
+        columns.set(vm.name, column);
+    });
+    vms.forEach((vm) => {
+        const column = columns.get(vm.name);
+        if (column) {
+            row.appendChild(column);
+        }
+    });
 }
 
 function initVmListRefresh() {
     const container = document.getElementById('vm-list');
-    if (!container) {
+    const row = document.getElementById('vm-cards');
+    if (!container || !row || container.dataset.live !== 'true') {
         return;
     }
     const viewUser = container.dataset.viewUser;
-    const url = viewUser ? `/api/vms?user=${encodeURIComponent(viewUser)}` : '/api/vms';
-    const pollIntervalMs = 10000;
-    const update = () => {
-        fetch(url, { credentials: 'same-origin' })
+    const query = viewUser ? `?user=${encodeURIComponent(viewUser)}` : '';
+    const url = `/api/vms${query}`;
+    const fetchCards = (names) => {
+        const params = new URLSearchParams(viewUser ? { user: viewUser } : {});
+        names.forEach((name) => params.append('name', name));
+        return fetch(`/api/vm-cards?${params}`, { credentials: 'same-origin' })
             .then((response) => {
                 if (!response.ok) {
-                    throw new Error('vm-list-fetch-failed');
+                    throw new Error('vm-cards-fetch-failed');
                 }
                 return response.json();
-            })
-            .then((data) => {
-                const vms = Array.isArray(data.vms) ? data.vms : [];
-                const statusMap = new Map();
-                vms.forEach((vm) => {
-                    if (vm && vm.name) {
-                        statusMap.set(vm.name, {
-                            status: vm.status || 'no status yet',
-                            pending: Boolean(vm.pending),
-                        });
+            });
+    };
+    let running = null;
+    let again = false;
+    const update = () => {
+        // One refresh at a time; events during it trigger one more
+        if (running) {
+            again = true;
+            return running;
+        }
+        running = fetchJsonWithEtag(url, 'vm-list-fetch-failed')
+            .then(({ data, changed }) => {
+                if (!changed) {
+                    return null;
+                }
+                const vms = (Array.isArray(data.vms) ? data.vms : []).filter((vm) => vm && vm.name);
+                const cards = new Map();
+                document.querySelectorAll('.vm-card').forEach((card) => {
+                    cards.set(card.dataset.vmName, card);
+                });
+                // The empty-list and inactive notices are only rendered server-side
+                if (!cards.size !== !vms.length) {
+                    window.location.reload();
+                    return null;
+                }
+                const names = new Set(vms.map((vm) => vm.name));
+                cards.forEach((card, name) => {
+                    if (!names.has(name)) {
+                        card.closest('.vm-card-col').remove();
                     }
                 });
-                const cards = document.querySelectorAll('.vm-card');
-                let shouldReload = false;
-                cards.forEach((card) => {
-                    const name = card.dataset.vmName;
-                    if (!name) {
+                const stale = [];
+                vms.forEach((vm) => {
+                    const card = cards.get(vm.name);
+                    const pending = vm.pending ? 'true' : 'false';
+                    if (!card || card.dataset.pending !== pending) {
+                        stale.push(vm.name);
                         return;
                     }
                     const statusEl = card.querySelector('.vm-status-text');
-                    if (!statusMap.has(name)) {
-                        shouldReload = true;
-                        return;
-                    }
-                    const data = statusMap.get(name);
                     if (statusEl) {
-                        statusEl.textContent = data.status;
+                        statusEl.textContent = vm.status || 'no status yet';
                     }
-                    card.dataset.pending = data.pending ? 'true' : 'false';
                 });
-                if (shouldReload || (cards.length !== vms.length)) {
-                    window.location.reload();
+                if (!stale.length) {
+                    return null;
                 }
+                return fetchCards(stale).then((fragment) => {
+                    replaceVmCards(row, vms, fragment.cards || {});
+                });
             })
             .catch(() => {
-                // Ignore transient failures; next poll will retry.
+                // The list's ETag was stored before the cards were patched;
+                // drop it so the next event re-fetches instead of getting a
+                // 304 for cards that never arrived.
+                etagCache.delete(url);
+            })
+            .finally(() => {
+                running = null;
+                if (again) {
+                    again = false;
+                    update();
+                }
             });
+        return running;
     };
+    window.proxstarRefreshVmList = update;
     update();
-    setInterval(update, pollIntervalMs);
+    proxstarEvents.on('job', update);
+    proxstarEvents.on('vm', update);
+    proxstarEvents.on('reconnect', update);
 }
 
 function initVmConsole() {
@@ -283,7 +451,9 @@ function initVmConsole() {
     };
     const loadRfb = () => {
         if (!rfbPromise) {
-            rfbPromise = import('/static/noVNC/core/rfb.js').then((module) => {
+            // The noVNC URL is fingerprinted once assets are built
+            const rfbUrl = container.dataset.novnc || '/static/noVNC/core/rfb.js';
+            rfbPromise = import(rfbUrl).then((module) => {
                 return module.default || module.RFB || module;
             });
         }
@@ -910,18 +1080,11 @@ function initRunningVmsRefresh() {
         return;
     }
     const tbody = table.querySelector('tbody');
-    const pollIntervalMs = 15000;
     const update = () => {
-        fetch('/api/running-vms', { credentials: 'same-origin' })
-            .then((response) => {
-                if (!response.ok) {
-                    throw new Error('running-vms-fetch-failed');
-                }
-                return response.json();
-            })
-            .then((data) => {
+        fetchJsonWithEtag('/api/running-vms', 'running-vms-fetch-failed')
+            .then(({ data, changed }) => {
                 const vms = Array.isArray(data.vms) ? data.vms : [];
-                if (!tbody) {
+                if (!tbody || !changed) {
                     return;
                 }
                 if (!vms.length) {
@@ -947,11 +1110,12 @@ function initRunningVmsRefresh() {
                 });
             })
             .catch(() => {
-                // Ignore transient failures; next poll will retry.
+                // Ignore transient failures; the next event will retry.
             });
     };
     update();
-    setInterval(update, pollIntervalMs);
+    proxstarEvents.on('vm', update);
+    proxstarEvents.on('reconnect', update);
 }
 
 function initPageLoader() {
@@ -1227,14 +1391,8 @@ function initVmHardware() {
     };
 
     const fetchHardware = () => {
-        fetch(`/api/vm/${vmid}/hardware`, { credentials: 'same-origin' })
-            .then((response) => {
-                if (!response.ok) {
-                    throw new Error('vm-hardware-fetch-failed');
-                }
-                return response.json();
-            })
-            .then((data) => {
+        fetchJsonWithEtag(`/api/vm/${vmid}/hardware`, 'vm-hardware-fetch-failed')
+            .then(({ data }) => {
                 const bootOrder = data.boot_order && Array.isArray(data.boot_order.order)
                     ? data.boot_order.order
                     : [];
@@ -1345,20 +1503,12 @@ function initVmHardware() {
             });
     };
 
-    const summaryRequest = fetch(`/api/vm/${vmid}/summary`, { credentials: 'same-origin' })
-        .then((response) => {
-            if (!response.ok) {
-                throw new Error('vm-summary-fetch-failed');
-            }
-            return response.json();
-        });
-    const hardwareRequest = fetch(`/api/vm/${vmid}/hardware`, { credentials: 'same-origin' })
-        .then((response) => {
-            if (!response.ok) {
-                throw new Error('vm-hardware-fetch-failed');
-            }
-            return response.json();
-        });
+    const summaryRequest = fetchJsonWithEtag(
+        `/api/vm/${vmid}/summary`, 'vm-summary-fetch-failed'
+    ).then(({ data }) => data);
+    const hardwareRequest = fetchJsonWithEtag(
+        `/api/vm/${vmid}/hardware`, 'vm-hardware-fetch-failed'
+    ).then(({ data }) => data);
     Promise.allSettled([summaryRequest, hardwareRequest]).then((results) => {
         const [summaryResult, hardwareResult] = results;
         if (summaryResult.status === 'fulfilled') {
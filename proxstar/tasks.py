@@ -1,8 +1,10 @@
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
-import requests
 from flask import Flask
 from rq import get_current_job
 from redis import Redis
@@ -12,19 +14,30 @@ from sqlalchemy.orm import sessionmaker
 from proxstar.db import (
     Base,
     get_vm_expire,
+    get_vm_expires,
+    renew_vm_expires,
     delete_vm_expire,
     datetime,
     store_pool_cache,
     get_template,
     sync_templates,
 )
+from proxstar.events import publish_quietly
+from proxstar.governor import acquire, governed, release, slots_for
+from proxstar.hostnames import add_hostname, release_hostname, remove_hostname
+from proxstar.metrics import timed_stage
+from proxstar.queues import get_queue
 from proxstar.proxmox import (
     connect_proxmox,
     get_pools,
     get_templates_from_pool,
     get_node_least_mem,
+    get_nodes_by_free_mem,
+    get_vm_node,
+    get_vmid_by_name,
+    wait_for_task,
 )
-from proxstar.sdn import ensure_student_network
+from proxstar.sdn import ensure_student_network, ensure_student_networks
 from proxstar.session import (
     clear_session,
     get_session_start,
@@ -33,9 +46,9 @@ from proxstar.session import (
     set_shutdown_started,
 )
 from proxstar.user import User, get_vms_for_rtp
-from proxstar.vm import VM, clone_vm, create_vm
+from proxstar.vm import VM, clone_vm, create_vm, start_clone
 from proxstar.util import sanitize_pool_name
-from proxstar.vnc import delete_vnc_target
+from proxstar.vnc import revoke_vm_console, sweep_vnc_tokens
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
 
@@ -58,6 +71,93 @@ def connect_db():
 def set_job_status(job, status):
     job.meta['status'] = status
     job.save_meta()
+    _publish_job(job)
+
+
+def _publish_job(job):
+    # Create and roster jobs are enqueued with the users they provision for
+    users = job.meta.get('users')
+    if users:
+        publish_quietly(
+            job.connection,
+            users,
+            'job',
+            {'id': job.id, 'status': job.meta.get('status'), 'final': job.meta.get('final', False)},
+        )
+
+
+def _finish_job(job):
+    # Callbacks run before RQ moves the job out of the started registry, so
+    # the flag is what keeps it out of pending_vms once browsers re-fetch
+    job.get_meta(refresh=True)
+    job.meta['final'] = True
+    job.save_meta()
+    _publish_job(job)
+
+
+def job_succeeded(job, connection, result, *args, **kwargs):  # pylint: disable=unused-argument
+    _finish_job(job)
+
+
+def job_failed(
+    job, connection, exc_type, exc_value, traceback
+):  # pylint: disable=unused-argument,too-many-arguments
+    if not job.retries_left:
+        _finish_job(job)
+
+
+TASK_RUNNING_PREFIX = 'task_running|'
+TASK_RERUN_PREFIX = 'task_rerun|'
+
+
+def skip_if_running(fn):
+    # Scheduled and debounced runs of the same task must not overlap. A run
+    # that starts while another is in progress is dropped, but the running
+    # one queues a fresh run when it finishes, so the edit that triggered
+    # the dropped run isn't left waiting for the next periodic one.
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+        job = get_current_job()
+        ttl = job.timeout if job and job.timeout and job.timeout > 0 else 600
+        key = f'{TASK_RUNNING_PREFIX}{fn.__name__}'
+        rerun_key = f'{TASK_RERUN_PREFIX}{fn.__name__}'
+        value = job.id if job else '1'
+        if not redis_conn.set(key, value, nx=True, ex=int(ttl)):
+            redis_conn.set(rerun_key, value, ex=int(ttl))
+            # Try again in case the running one finished before seeing the flag
+            if not redis_conn.set(key, value, nx=True, ex=int(ttl)):
+                logging.info('%s is still running, it will run again when done.', fn.__name__)
+                return None
+        redis_conn.delete(rerun_key)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            redis_conn.delete(key)
+            if redis_conn.delete(rerun_key) and job is not None:
+                logging.info('Queueing %s again for changes made while it ran.', fn.__name__)
+                get_queue(redis_conn, job.origin).enqueue(
+                    job.func_name, *args, job_timeout=job.timeout, **kwargs
+                )
+
+    return wrapper
+
+
+def connect_redis():
+    return Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+
+
+def _settle_hostname(redis_conn, name, created):
+    # Moves a reserved name into the hostname index once its VM exists, or
+    # frees it when the job gives up. The index is rebuilt from the cluster
+    # when it goes stale, so a failed update here is only logged.
+    try:
+        if created:
+            add_hostname(redis_conn, name)
+        else:
+            release_hostname(redis_conn, name)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error('[%s] Could not update hostname index: %s', name, e)
 
 
 def create_vm_task(user, name, cores, memory, disk, iso):  # pylint: disable=too-many-arguments
@@ -65,38 +165,54 @@ def create_vm_task(user, name, cores, memory, disk, iso):  # pylint: disable=too
         job = get_current_job()
         proxmox = connect_proxmox()
         db = connect_db()
+        redis_conn = connect_redis()
+        labels = {'task': 'create_vm', 'template': '', 'node': ''}
         try:
             try:
-                target_node = get_node_least_mem(proxmox)
-                vnet, _ = ensure_student_network(db, app.config, user, proxmox)
+                with timed_stage(job, redis_conn, 'placement', labels):
+                    target_node = get_node_least_mem(proxmox)
+                labels['node'] = target_node
+                with timed_stage(job, redis_conn, 'sdn', labels):
+                    vnet, _ = ensure_student_network(db, app.config, user, proxmox)
             except Exception as e:  # pylint: disable=broad-except
                 logging.error('[%s] SDN setup failed: %s', name, e)
                 set_job_status(job, 'failed: sdn')
+                _settle_hostname(redis_conn, name, created=False)
                 raise
             pool_id = sanitize_pool_name(user)
             logging.info('[{}] Creating VM.'.format(name))
             set_job_status(job, 'creating VM')
-            vmid = create_vm(
-                proxmox, pool_id, name, cores, memory, disk, iso, vnet, node=target_node
-            )
+            try:
+                with timed_stage(job, redis_conn, 'create', labels):
+                    vmid = create_vm(
+                        proxmox, pool_id, name, cores, memory, disk, iso, vnet, node=target_node
+                    )
+            except Exception:
+                _settle_hostname(redis_conn, name, created=False)
+                raise
+            _settle_hostname(redis_conn, name, created=True)
             logging.info('[{}] Waiting until Proxmox is done provisioning.'.format(name))
             set_job_status(job, 'waiting for Proxmox')
             timeout = 20
             retry = 0
-            while retry < timeout:
-                if not VM(vmid).is_provisioned():
-                    retry += 1
-                    time.sleep(3)
-                    continue
-                break
+            with timed_stage(job, redis_conn, 'wait', labels) as timing:
+                while retry < timeout:
+                    if not VM(vmid).is_provisioned():
+                        retry += 1
+                        time.sleep(3)
+                        continue
+                    break
+                timing['failed'] = retry == timeout
             if retry == timeout:
                 logging.info('[{}] Failed to provision, deleting.'.format(name))
                 set_job_status(job, 'failed to provision')
                 delete_vm_task(vmid)
                 return
-            vm = VM(vmid)
+            # create_vm already sent the whole config, so only the expiration
+            # is left; it gets its own stage rather than passing for configure
             set_job_status(job, 'setting VM expiration')
-            get_vm_expire(db, vmid, app.config['VM_EXPIRE_MONTHS'])
+            with timed_stage(job, redis_conn, 'expiration', labels):
+                get_vm_expire(db, vmid, app.config['VM_EXPIRE_MONTHS'])
             logging.info('[{}] VM successfully provisioned.'.format(name))
             set_job_status(job, 'complete')
         finally:
@@ -106,23 +222,42 @@ def create_vm_task(user, name, cores, memory, disk, iso):  # pylint: disable=too
 def delete_vm_task(vmid):
     with app.app_context():
         db = connect_db()
+        redis_conn = connect_redis()
+        labels = {'task': 'delete_vm', 'template': '', 'node': ''}
+        # When called inline to clean up a failed create, the stages land in
+        # the create job's timings
+        job = get_current_job()
         try:
             vm = VM(vmid)
             # do this before deleting the VM since it is hard to reconcile later
             if vm.status != 'stopped':
-                vm.stop()
-                retry = 0
-                while retry < 10:
-                    time.sleep(3)
-                    if vm.status == 'stopped':
-                        break
-                    retry += 1
-            vm.delete()
-            delete_vm_expire(db, vmid)
+                labels['node'] = vm.node
+                with timed_stage(job, redis_conn, 'stop', labels):
+                    vm.stop()
+                    retry = 0
+                    while retry < 10:
+                        time.sleep(3)
+                        if vm.status == 'stopped':
+                            break
+                        retry += 1
+            labels['node'] = vm.node
+            name = vm.name
+            with timed_stage(job, redis_conn, 'delete', labels):
+                vm.delete()
+                delete_vm_expire(db, vmid)
+            try:
+                remove_hostname(redis_conn, name)
+            except Exception as e:  # pylint: disable=W0703
+                logging.error('[%s] Could not update hostname index: %s', name, e)
+            try:
+                revoke_vm_console(redis_conn, vmid)
+            except Exception as e:  # pylint: disable=W0703
+                logging.error('Could not revoke VNC token: %s', e)
         finally:
             db.close()
 
 
+@skip_if_running
 def process_expiring_vms_task():
     with app.app_context():
         if not app.config.get('ENABLE_VM_EXPIRATION'):
@@ -130,36 +265,32 @@ def process_expiring_vms_task():
         proxmox = connect_proxmox()
         db = connect_db()
         try:
-            pools = get_pools(proxmox, db)
-            for pool in pools:
+            vmids = []
+            for pool in get_pools(proxmox, db):
                 user = User(pool, db_session=db)
-                vms = user.vms
-                for vm in vms:
-                    vm = VM(vm['vmid'])
-                    days = (vm.expire - datetime.date.today()).days
-                    if days <= -7:
-                        logging.info(
-                            'Deleting {} ({}) as it has been at least a week since expiration.'.format(
-                                vm.name, vm.id
-                            )
+                vmids.extend(vm['vmid'] for vm in user.vms)
+            # One query for the existing rows, one insert for the missing ones
+            expires = get_vm_expires(db, vmids, app.config['VM_EXPIRE_MONTHS'])
+            today = datetime.date.today()
+            for vmid in vmids:
+                days = (expires[int(vmid)] - today).days
+                if days > 0:
+                    continue
+                vm = VM(vmid)
+                if days <= -7:
+                    logging.info(
+                        'Deleting {} ({}) as it has been at least a week since expiration.'.format(
+                            vm.name, vm.id
                         )
-                        try:
-                            redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
-                            vmid = vm['vmid']
-                            vnc_token_key = f'vnc_token|{vmid}'
-                            vnc_token = redis_conn.get(vnc_token_key).decode('utf-8')
-                            delete_vnc_target(token=vnc_token)
-                            redis_conn.delete(vnc_token_key)
-                        except Exception as e:  # pylint: disable=W0703
-                            logging.error('Could not delete target from targets file: %s', e)
-
-                        delete_vm_task(vm.id)
-                    elif days <= 0:
-                        vm.stop()
+                    )
+                    delete_vm_task(vm.id)
+                else:
+                    vm.stop()
         finally:
             db.close()
 
 
+@skip_if_running
 def generate_pool_cache_task():
     with app.app_context():
         if not app.config.get('PROXMOX_HOSTS'):
@@ -174,52 +305,159 @@ def generate_pool_cache_task():
             db.close()
 
 
+# Checkpoints for setup_template_task, in order. A retried or requeued job
+# keeps its meta, so it resumes after the last step recorded here instead of
+# cloning the template again.
+TEMPLATE_SETUP_STEPS = ('network ready', 'cloned', 'provisioned', 'configured', 'started')
+
+
+def _checkpoint(job, step, **state):
+    checkpoint = job.meta.setdefault('checkpoint', {})
+    checkpoint.update(state, step=step)
+    job.save_meta()
+    return checkpoint
+
+
+def _step_done(checkpoint, step):
+    if 'step' not in checkpoint:
+        return False
+    return TEMPLATE_SETUP_STEPS.index(checkpoint['step']) >= TEMPLATE_SETUP_STEPS.index(step)
+
+
 def setup_template_task(
     template_id, name, user, ssh_key, cores, memory
-):  # pylint: disable=too-many-arguments
+):  # pylint: disable=too-many-arguments,too-many-statements
     with app.app_context():
         job = get_current_job()
         proxmox = connect_proxmox()
         db = connect_db()
+        redis_conn = connect_redis()
+        checkpoint = job.meta.setdefault('checkpoint', {})
+        labels = {
+            'task': 'setup_template',
+            'template': str(template_id),
+            'node': checkpoint.get('node', ''),
+        }
+        if 'step' in checkpoint:
+            logging.info('[{}] Resuming after step: {}.'.format(name, checkpoint['step']))
+        clone_slot = None
         try:
+            if not _step_done(checkpoint, 'network ready'):
+                try:
+                    with timed_stage(job, redis_conn, 'placement', labels):
+                        target_node = get_node_least_mem(proxmox)
+                    labels['node'] = target_node
+                    with timed_stage(job, redis_conn, 'sdn', labels):
+                        vnet, _ = ensure_student_network(db, app.config, user, proxmox)
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.error('[%s] SDN setup failed: %s', name, e)
+                    set_job_status(job, 'failed: sdn')
+                    raise
+                checkpoint = _checkpoint(job, 'network ready', vnet=vnet, node=target_node)
+            if not _step_done(checkpoint, 'provisioned'):
+                # Held from clone start until Proxmox finishes copying the disk
+                set_job_status(job, 'waiting for storage')
+                with timed_stage(job, redis_conn, 'governor', labels):
+                    clone_slot = acquire(
+                        redis_conn,
+                        slots_for(app.config, checkpoint['node'], app.config['PROXMOX_VM_STORAGE']),
+                        app.config['GOVERNOR_CLONE_LEASE'],
+                        app.config['GOVERNOR_TASK_WAIT'],
+                        'clone',
+                    )
+            if not _step_done(checkpoint, 'cloned'):
+                logging.info(
+                    '[{}] Retrieving template info for template {}.'.format(name, template_id)
+                )
+                get_template(db, template_id)
+                checkpoint = _clone_template(job, proxmox, checkpoint, template_id, name, user)
+                _settle_hostname(redis_conn, name, created=True)
+            vmid = checkpoint['vmid']
             try:
-                target_node = get_node_least_mem(proxmox)
-                vnet, _ = ensure_student_network(db, app.config, user, proxmox)
-            except Exception as e:  # pylint: disable=broad-except
-                logging.error('[%s] SDN setup failed: %s', name, e)
-                set_job_status(job, 'failed: sdn')
-                raise
-            pool_id = sanitize_pool_name(user)
-            logging.info('[{}] Retrieving template info for template {}.'.format(name, template_id))
-            get_template(db, template_id)
-            logging.info('[{}] Cloning template {}.'.format(name, template_id))
-            set_job_status(job, 'cloning template')
-            vmid = clone_vm(
-                proxmox,
-                template_id,
-                name,
-                pool_id,
-                full_clone=app.config.get('TEMPLATE_CLONE_FULL', True),
-                target=target_node,
-            )
-            logging.info('[{}] Waiting until Proxmox is done provisioning.'.format(name))
-            set_job_status(job, 'waiting for Proxmox')
-            timeout = 25
-            retry = 0
-            while retry < timeout:
-                if not VM(vmid).is_provisioned():
-                    retry += 1
-                    time.sleep(12)
-                    continue
-                break
-            if retry == timeout:
+                if not _step_done(checkpoint, 'provisioned'):
+                    checkpoint = _wait_for_clone(job, redis_conn, checkpoint, name, labels)
+                if clone_slot:
+                    # The disk is copied; configuring and starting the VM
+                    # don't need the slot
+                    release(redis_conn, clone_slot)
+                    clone_slot = None
+                _finish_template_setup(
+                    job, db, checkpoint, name, user, ssh_key, cores, memory, labels
+                )
+            except Exception:
+                if getattr(job, 'retries_left', None):
+                    # Keep the clone; the retry picks up from the last checkpoint
+                    logging.info('[{}] Setup failed, will resume on retry.'.format(name))
+                    raise
                 logging.info('[{}] Failed to provision, deleting.'.format(name))
                 set_job_status(job, 'failed to provision')
                 delete_vm_task(vmid)
-                return
+                raise
+        except Exception:
+            if not getattr(job, 'retries_left', None) and not _step_done(checkpoint, 'cloned'):
+                _settle_hostname(redis_conn, name, created=False)
+            raise
+        finally:
+            if clone_slot:
+                release(redis_conn, clone_slot)
+            db.close()
 
-            vm = VM(vmid)
-            vm.set_net_bridge('net0', vnet)
+
+def _clone_template(
+    job, proxmox, checkpoint, template_id, name, user
+):  # pylint: disable=too-many-arguments
+    pool_id = sanitize_pool_name(user)
+    vmid = None
+    if checkpoint.get('clone_started'):
+        # An earlier attempt died between starting the clone and recording
+        # it; adopt that VM rather than clone again
+        vmid = get_vmid_by_name(proxmox, name, pool_id)
+    if vmid is None:
+        # The clone stage is timed from here until the copy is done, in
+        # _wait_for_clone
+        checkpoint = _checkpoint(job, checkpoint['step'], clone_started=time.time())
+        logging.info('[{}] Cloning template {}.'.format(name, template_id))
+        set_job_status(job, 'cloning template')
+        vmid = clone_vm(
+            proxmox,
+            template_id,
+            name,
+            pool_id,
+            full_clone=app.config.get('TEMPLATE_CLONE_FULL', True),
+            target=checkpoint['node'],
+        )
+    else:
+        logging.info('[{}] Adopting clone {} from an earlier run.'.format(name, vmid))
+    return _checkpoint(job, 'cloned', vmid=vmid)
+
+
+def _wait_for_clone(job, redis_conn, checkpoint, name, labels):
+    vmid = checkpoint['vmid']
+    logging.info('[{}] Waiting until Proxmox is done provisioning.'.format(name))
+    set_job_status(job, 'waiting for Proxmox')
+    timeout = 25
+    retry = 0
+    with timed_stage(job, redis_conn, 'clone', labels, start=checkpoint.get('clone_started')):
+        while retry < timeout:
+            if not VM(vmid).is_provisioned():
+                retry += 1
+                time.sleep(12)
+                continue
+            break
+        if retry == timeout:
+            raise RuntimeError('Timed out waiting for Proxmox to provision {}'.format(vmid))
+    return _checkpoint(job, 'provisioned')
+
+
+def _finish_template_setup(
+    job, db, checkpoint, name, user, ssh_key, cores, memory, labels
+):  # pylint: disable=too-many-arguments
+    vmid = checkpoint['vmid']
+    redis_conn = connect_redis()
+    vm = VM(vmid)
+    if not _step_done(checkpoint, 'configured'):
+        with timed_stage(job, redis_conn, 'configure', labels):
+            vm.set_net_bridge('net0', checkpoint['vnet'])
             get_vm_expire(db, vmid, app.config['VM_EXPIRE_MONTHS'])
             logging.info('[{}] Setting CPU and memory.'.format(name))
             set_job_status(job, 'setting CPU and memory')
@@ -231,19 +469,142 @@ def setup_template_task(
             if ssh_key and ssh_key.strip():
                 vm.set_ci_ssh_key(ssh_key)
             vm.set_ci_network()
+        checkpoint = _checkpoint(job, 'configured')
 
-            job.save_meta()
-            logging.info('[{}] Starting VM.'.format(name))
-            set_job_status(job, 'starting VM')
-            job.save_meta()
+    if not _step_done(checkpoint, 'started'):
+        logging.info('[{}] Starting VM.'.format(name))
+        set_job_status(job, 'starting VM')
+        with timed_stage(job, redis_conn, 'start', labels):
             vm.start()
-            logging.info('[{}] Template successfully provisioned.'.format(name))
-            set_job_status(job, 'completed')
-            job.save_meta()
+        _checkpoint(job, 'started')
+    logging.info('[{}] Template successfully provisioned.'.format(name))
+    set_job_status(job, 'completed')
+
+
+def _place_roster(nodes, count, memory):
+    # Greedy placement: each VM goes to the node with the least memory
+    # committed so far, counting the VMs already placed in this run.
+    committed = {node['node']: node.get('mem', 0) for node in nodes}
+    placement = []
+    for _ in range(count):
+        node = min(committed, key=committed.get)
+        placement.append(node)
+        committed[node] += int(memory) * 1024 * 1024
+    return placement
+
+
+def provision_roster_task(
+    entries, template_id, cores, memory, ssh_key=''
+):  # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+    """Provisions one VM per roster entry ({'user': ..., 'name': ...}) from a
+    template. Pools and SDN networks are set up for the whole roster first
+    (one SDN apply), then clones run in parallel under the node and storage
+    governor, each followed by a single config write. Expirations are written
+    in one statement at the end. Per-user progress is kept in
+    job.meta['roster'].
+    """
+    with app.app_context():
+        job = get_current_job()
+        proxmox = connect_proxmox()
+        db = connect_db()
+        progress = {entry['user']: {'name': entry['name'], 'status': 'queued'} for entry in entries}
+        progress_lock = threading.Lock()
+        redis_conn = connect_redis()
+
+        def report(user, status):
+            with progress_lock:
+                progress[user]['status'] = status
+                job.meta['roster'] = progress
+                job.save_meta()
+
+        try:
+            set_job_status(job, 'creating pools')
+            existing_pools = {pool['poolid'] for pool in proxmox.pools.get()}
+            for entry in entries:
+                pool_id = sanitize_pool_name(entry['user'])
+                if pool_id not in existing_pools:
+                    proxmox.pools.post(poolid=pool_id, comment='Managed by Proxstar')
+                    existing_pools.add(pool_id)
+
+            set_job_status(job, 'setting up networks')
+            networks, errors = ensure_student_networks(
+                db, app.config, [entry['user'] for entry in entries], proxmox
+            )
+            for user in errors:
+                report(user, 'failed: sdn')
+                _settle_hostname(redis_conn, progress[user]['name'], created=False)
+            entries = [entry for entry in entries if entry['user'] in networks]
+
+            set_job_status(job, 'cloning templates')
+            template_node = get_vm_node(proxmox, template_id)
+            placement = _place_roster(get_nodes_by_free_mem(proxmox), len(entries), memory)
+
+            def provision(entry, node):
+                user = entry['user']
+                vmid = None
+                with app.app_context():
+                    try:
+                        thread_proxmox = connect_proxmox()
+                        report(user, 'waiting for clone slot')
+                        with governed(
+                            redis_conn,
+                            slots_for(app.config, node, app.config['PROXMOX_VM_STORAGE']),
+                            app.config['GOVERNOR_CLONE_LEASE'],
+                            app.config['ROSTER_CLONE_TIMEOUT'],
+                            'clone',
+                        ):
+                            report(user, 'cloning template')
+                            vmid, upid = start_clone(
+                                thread_proxmox,
+                                template_id,
+                                entry['name'],
+                                sanitize_pool_name(user),
+                                full_clone=app.config.get('TEMPLATE_CLONE_FULL', True),
+                                target=node,
+                                template_node=template_node,
+                            )
+                            _settle_hostname(redis_conn, entry['name'], created=True)
+                            wait_for_task(
+                                thread_proxmox, upid, timeout=app.config['ROSTER_CLONE_TIMEOUT']
+                            )
+                        report(user, 'configuring VM')
+                        vm = VM(vmid, node=node)
+                        vm.configure_clone(networks[user][0], cores, memory, user, ssh_key)
+                        report(user, 'starting VM')
+                        vm.start()
+                        report(user, 'completed')
+                        return vmid
+                    except Exception as e:  # pylint: disable=broad-except
+                        logging.error('[%s] Roster provisioning failed: %s', entry['name'], e)
+                        report(user, 'failed to provision')
+                        if vmid is None:
+                            _settle_hostname(redis_conn, entry['name'], created=False)
+                        else:
+                            try:
+                                delete_vm_task(vmid)
+                            except Exception as cleanup_error:  # pylint: disable=broad-except
+                                logging.error('[%s] Cleanup failed: %s', vmid, cleanup_error)
+                        return None
+
+            vmids = []
+            if entries:
+                # Enough threads to fill every node's slots; the governor does the limiting
+                workers = min(len(entries), app.config['GOVERNOR_NODE_LIMIT'] * len(set(placement)))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    vmids = [
+                        vmid
+                        for vmid in executor.map(provision, entries, placement)
+                        if vmid is not None
+                    ]
+
+            set_job_status(job, 'setting VM expirations')
+            renew_vm_expires(db, vmids, app.config['VM_EXPIRE_MONTHS'])
+            set_job_status(job, f'completed: {len(vmids)} of {len(progress)} VMs provisioned')
         finally:
             db.close()
 
 
+@skip_if_running
 def sync_templates_task():
     with app.app_context():
         pool_name = app.config.get('TEMPLATE_POOL', '')
@@ -258,27 +619,14 @@ def sync_templates_task():
             db.close()
 
 
-def cleanup_vnc_task():
-    """Removes all open VNC sessions. This runs in the RQ worker, and so
-    needs to be routed properly via the Proxstar API
-    TODO (willnilges): Use API, track the task IDs, and kill only the finished
-    ones every couple of minutes
-    https://github.com/ComputerScienceHouse/proxstar/issues/153
-    """
-    # FIXME (willnilges): This... might be working...?
-    try:
-        requests.post(
-            '{}://{}/console/cleanup'.format(
-                app.config.get('SERVER_SCHEME', 'http'), app.config['SERVER_NAME']
-            ),
-            data={'token': app.config['VNC_CLEANUP_TOKEN']},
-            verify=False,
-            timeout=30,
-        )
-    except Exception as e:  # pylint: disable=W0703
-        logging.error('VNC cleanup request failed: %s', e)
+def sweep_vnc_tokens_task():
+    with app.app_context():
+        swept = sweep_vnc_tokens(connect_redis())
+        if swept:
+            logging.info('Swept %s expired VNC token(s)', swept)
 
 
+@skip_if_running
 def enforce_session_timeouts_task():
     with app.app_context():
         if not app.config.get('PROXMOX_HOSTS'):
@@ -6,11 +6,13 @@ from proxmoxer.core import ResourceException
 from rq.registry import StartedJobRegistry
 
 from proxstar.ldapdb import is_active, is_user, is_current_student
-from proxstar import db, q, redis_conn
-from proxstar.db import get_allowed_users, get_user_usage_limits, is_rtp, get_shared_pools
+from proxstar import db, provisioning_q, redis_conn
+from proxstar.db import is_allowed_user, get_user_usage_limits, is_rtp, get_shared_pools
 from proxstar.proxmox import connect_proxmox, get_pools, get_proxmox_userid
+from proxstar.queues import PROVISIONING_QUEUE
 from proxstar.util import lazy_property, default_repr, sanitize_pool_name
 from proxstar.vm import VM
+from proxstar.vmcache import cache_vm_list, get_cached_vm_list
 
 
 @default_repr
@@ -22,13 +24,18 @@ class User:
         self.active = (
             is_active(self.name)
             or is_current_student(self.name)
-            or self.name in get_allowed_users(self.db)
+            or is_allowed_user(self.db, self.name)
         )
         self.rtp = is_rtp(self.name)
         self.limits = get_user_usage_limits(self.db, self.name)
 
     @lazy_property
     def vms(self):
+        # Writes and cluster events drop the cache, so the TTL only bounds
+        # how long a change nobody reported stays hidden
+        vms = get_cached_vm_list(redis_conn, self.pool_id)
+        if vms is not None:
+            return vms
         proxmox = connect_proxmox()
         try:
             # try to get the users vms from their pool
@@ -45,18 +52,34 @@ class User:
             if 'name' not in vm:
                 vms.remove(vm)
         vms = sorted(vms, key=lambda k: k['name'])
+        cache_vm_list(redis_conn, self.pool_id, vms, app.config['VM_LIST_CACHE_TTL'])
 
         return vms
 
     @lazy_property
     def pending_vms(self):
-        jobs = StartedJobRegistry('default', connection=redis_conn).get_job_ids()
-        for job_id in q.job_ids:
+        # Only create/clone jobs carry (user, name, ...) args; they all run on
+        # the provisioning queue.
+        jobs = StartedJobRegistry(PROVISIONING_QUEUE, connection=redis_conn).get_job_ids()
+        for job_id in provisioning_q.job_ids:
             jobs.append(job_id)
         pending_vms = []
         for job in jobs:
-            job = q.fetch_job(job)
-            if job and len(job.args) > 2:
+            job = provisioning_q.fetch_job(job)
+            if not job or job.meta.get('final'):
+                continue
+            roster_entry = job.meta.get('roster', {}).get(self.name)
+            if roster_entry:
+                # Roster jobs provision many users at once and track each in meta
+                if roster_entry['status'] != 'completed':
+                    pending_vms.append(
+                        {
+                            'name': roster_entry['name'],
+                            'status': roster_entry['status'],
+                            'pending': True,
+                        }
+                    )
+            elif len(job.args) > 2 and isinstance(job.args[0], str):
                 if self.name in (job.args[0], job.args[2]):
                     vm_dict = {}
                     vm_dict['name'] = job.args[1]
@@ -1,3 +1,4 @@
+import os
 import random
 import re
 
@@ -10,6 +11,37 @@ def sanitize_pool_name(name, max_len=64):
     return cleaned[:max_len]
 
 
+def read_git_revision(root):
+    """Returns the short commit root was built from without running git.
+
+    Images record it in a REVISION file at build time; checkouts fall back
+    to reading .git directly.
+    """
+    try:
+        with open(os.path.join(root, 'REVISION'), encoding='utf-8') as f:
+            return f.read().strip()[:7]
+    except OSError:
+        pass
+    git_dir = os.path.join(root, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), encoding='utf-8') as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head[:7]
+        ref = head[len('ref: ') :]
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path, encoding='utf-8') as f:
+                return f.read().strip()[:7]
+        with open(os.path.join(git_dir, 'packed-refs'), encoding='utf-8') as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line[:7]
+    except OSError:
+        pass
+    return 'unknown'
+
+
 def gen_password(
     length, charset='ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*'
 ):
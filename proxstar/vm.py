@@ -7,7 +7,13 @@ from tenacity import retry, stop_after_attempt, wait_fixed
 
 from proxstar import db
 from proxstar.db import delete_vm_expire, get_vm_expire
-from proxstar.proxmox import connect_proxmox, get_free_vmid, get_node_least_mem, get_vm_node
+from proxstar.proxmox import (
+    connect_proxmox,
+    get_free_vmid,
+    get_node_least_mem,
+    get_vm_node,
+    release_free_vmid,
+)
 from proxstar.util import lazy_property, default_repr
 
 
@@ -19,8 +25,11 @@ def check_in_gb(size):
 
 @default_repr
 class VM:
-    def __init__(self, vmid):
+    def __init__(self, vmid, node=None):
         self.id = vmid
+        if node:
+            # Callers that already know the node skip the cluster lookup
+            self._lazy_node = node
 
     @lazy_property
     def name(self):
@@ -431,6 +440,25 @@ class VM:
         escaped_key = urllib.parse.quote(ssh_key, safe='')
         proxmox.nodes(self.node).qemu(self.id).config.put(sshkeys=escaped_key)
 
+    @retry(wait=wait_fixed(2), stop=stop_after_attempt(5))
+    def configure_clone(
+        self, bridge, cores, memory, user, ssh_key=None
+    ):  # pylint: disable=too-many-arguments
+        # Everything setup_template_task sets one call at a time, in a single PUT
+        int_type = self.config.get('net0', 'virtio').split(',')[0]
+        config = {
+            'net0': f'{int_type},bridge={bridge}',
+            'cores': cores,
+            'sockets': 1,
+            'memory': memory,
+            'ciuser': user,
+            'ipconfig0': 'ip=dhcp',
+        }
+        if ssh_key and ssh_key.strip():
+            config['sshkeys'] = urllib.parse.quote(ssh_key, safe='')
+        proxmox = connect_proxmox()
+        proxmox.nodes(self.node).qemu(self.id).config.put(**config)
+
     @retry(wait=wait_fixed(2), stop=stop_after_attempt(5))
     def set_ci_network(self):
         proxmox = connect_proxmox()
@@ -447,35 +475,52 @@ def create_vm(
     vmid = get_free_vmid(proxmox)
     # Make sure lingering expirations are deleted
     delete_vm_expire(db, vmid)
-    node.qemu.create(
-        vmid=vmid,
-        name=name,
-        cores=cores,
-        memory=memory,
-        storage=app.config['PROXMOX_VM_STORAGE'],
-        virtio0='{}:{}'.format(app.config['PROXMOX_VM_STORAGE'], disk),
-        ide2='{},media=cdrom'.format(iso),
-        net0=f'virtio,bridge={bridge}',
-        pool=user,
-        description='Managed by Proxstar',
-    )
+    try:
+        node.qemu.create(
+            vmid=vmid,
+            name=name,
+            cores=cores,
+            memory=memory,
+            storage=app.config['PROXMOX_VM_STORAGE'],
+            virtio0='{}:{}'.format(app.config['PROXMOX_VM_STORAGE'], disk),
+            ide2='{},media=cdrom'.format(iso),
+            net0=f'virtio,bridge={bridge}',
+            pool=user,
+            description='Managed by Proxstar',
+        )
+    except Exception:
+        release_free_vmid(vmid)
+        raise
     return vmid
 
 
 # Will clone a new VM from a template, does not guarantee the
 # VM is done provisioning when returning
 def clone_vm(proxmox, template_id, name, pool, full_clone=True, target=None):
-    node = proxmox.nodes(get_vm_node(proxmox, template_id))
-    vmid = get_free_vmid(proxmox)
+    vmid, _ = start_clone(proxmox, template_id, name, pool, full_clone=full_clone, target=target)
     # Make sure lingering expirations are deleted
     delete_vm_expire(db, vmid)
-    target = target or get_node_least_mem(proxmox)
-    node.qemu(template_id).clone.post(
-        newid=vmid,
-        name=name,
-        pool=pool,
-        full=1 if full_clone else 0,
-        description='Managed by Proxstar',
-        target=target,
-    )
     return vmid
+
+
+# Starts the clone and returns the new vmid along with the Proxmox task id
+# so callers can wait on the clone itself. Does not touch the database.
+def start_clone(
+    proxmox, template_id, name, pool, full_clone=True, target=None, template_node=None
+):  # pylint: disable=too-many-arguments
+    node = proxmox.nodes(template_node or get_vm_node(proxmox, template_id))
+    vmid = get_free_vmid(proxmox)
+    target = target or get_node_least_mem(proxmox)
+    try:
+        upid = node.qemu(template_id).clone.post(
+            newid=vmid,
+            name=name,
+            pool=pool,
+            full=1 if full_clone else 0,
+            description='Managed by Proxstar',
+            target=target,
+        )
+    except Exception:
+        release_free_vmid(vmid)
+        raise
+    return vmid, upid
@@ -0,0 +1,36 @@
+import json
+import logging
+
+from proxstar.util import sanitize_pool_name
+
+VM_LIST_PREFIX = 'vm_list|'
+
+
+def get_vm_list_key(user):
+    # Pools are named after their owner, so pool and user names both work
+    return f'{VM_LIST_PREFIX}{sanitize_pool_name(user)}'
+
+
+def get_cached_vm_list(redis_conn, user):
+    """Returns the cached members of user's pool, or None on a miss."""
+    try:
+        value = redis_conn.get(get_vm_list_key(user))
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not read VM list cache: %s', e)
+        return None
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def cache_vm_list(redis_conn, user, vms, ttl):
+    try:
+        redis_conn.set(get_vm_list_key(user), json.dumps(vms), ex=ttl)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Could not cache VM list: %s', e)
+
+
+def invalidate_vm_lists(pipe, users):
+    """Queues deletion of the cached lists of users on pipe."""
+    for user in set(users):
+        pipe.delete(get_vm_list_key(user))
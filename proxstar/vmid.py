@@ -0,0 +1,26 @@
+VMID_RESERVATION_PREFIX = 'vmid_reserved|'
+
+
+def get_reservation_key(vmid):
+    return f'{VMID_RESERVATION_PREFIX}{vmid}'
+
+
+def reserve_vmid(redis_conn, used, start, end, ttl):
+    """Reserves the lowest VMID in [start, end] that is neither in use nor
+    reserved by another job.
+
+    used is the set of VMIDs in the cluster snapshot. The reservation is a
+    Redis SET NX with a TTL, so it is atomic across workers. It expires on its
+    own once the new VM shows up in the cluster, and release_vmid frees it at
+    once if the create or clone fails.
+    """
+    for vmid in range(start, end + 1):
+        if vmid in used:
+            continue
+        if redis_conn.set(get_reservation_key(vmid), '1', nx=True, ex=ttl):
+            return vmid
+    raise RuntimeError(f'No free VMIDs between {start} and {end}')
+
+
+def release_vmid(redis_conn, vmid):
+    redis_conn.delete(get_reservation_key(vmid))
@@ -1,82 +1,126 @@
-import os
-import subprocess
+import json
 import time
 
-from flask import current_app as app
-
-from proxstar import logging
 from proxstar.util import gen_password
 
 
-def stop_websockify():
-    result = subprocess.run(['pgrep', 'websockify'], stdout=subprocess.PIPE, check=False)
-    if result.stdout:
-        pids = result.stdout.splitlines()
-        for pid in pids:
-            subprocess.run(['kill', pid], stdout=subprocess.PIPE, check=False)
-            # FIXME (willnilges): Willard is lazy.
-            time.sleep(1)
-            if subprocess.run(['pgrep', 'websockify'], stdout=subprocess.PIPE, check=False).stdout:
-                time.sleep(5)
-                if subprocess.run(
-                    ['pgrep', 'websockify'], stdout=subprocess.PIPE, check=False
-                ).stdout:
-                    logging.info("websockify didn't stop, killing forcefully")
-                    subprocess.run(['kill', '-9', pid], stdout=subprocess.PIPE, check=False)
-
-
-def get_vnc_targets():
-    targets = []
-    if os.path.exists(app.config['WEBSOCKIFY_TARGET_FILE']):
-        target_file = open(app.config['WEBSOCKIFY_TARGET_FILE'])
-        for line in target_file:
-            target_dict = {}
-            values = line.strip().split(':')
-            target_dict['token'] = values[0]
-            target_dict['host'] = f'{values[1].strip()}:{values[2]}'
-            targets.append(target_dict)
-        target_file.close()
-    return targets
-
-
-def add_vnc_target(node, port):
-    # TODO (willnilges): This doesn't throw an error if the target file is wrong.
-    targets = get_vnc_targets()
-    target = next((target for target in targets if target['host'] == f'{node}:{port}'), None)
-    if target:
-        logging.info('Host is already in the targets file')
-        return target['token']
-    else:
-        target_file = open(app.config['WEBSOCKIFY_TARGET_FILE'], 'a')
-        token = gen_password(32, 'abcdefghijklmnopqrstuvwxyz0123456789')
-        target_file.write(f'{token}: {node}:{port}\n')
-        target_file.close()
-        return token
-
-
-def delete_vnc_target(node=None, port=None, token=None):
-    targets = get_vnc_targets()
-    if node is not None and port is not None:
-        target = next((target for target in targets if target['host'] == f'{node}:{port}'), None)
-    elif token is not None:
-        target = next((target for target in targets if target['token'] == f'{token}'), None)
-    else:
-        raise ValueError('Need either a node and port, or a token.')
-    if target:
-        targets.remove(target)
-        target_file = open(app.config['WEBSOCKIFY_TARGET_FILE'], 'w')
-        for target in targets:
-            target_file.write(f"{target['token']}: {target['host']}\n")
-        target_file.close()
-    else:
-        raise LookupError('Target does not exist')
+# '<namespace>:<token>' holds the VNC endpoint and owner the console proxy
+# checks the token against
+VNC_TARGET_NAMESPACE = 'vnc_target'
+# Per VM, the tokens issued for it scored by expiry, so power actions can
+# revoke every console open on it
+VNC_TOKEN_PREFIX = 'vnc_tokens|'
+# Every token as '<vmid>|<token>' scored by expiry, for the sweeper
+VNC_TOKEN_EXPIRY_KEY = 'vnc_token_expiry'
+# Console parameters last handed to a user for a VM, kept until the proxy
+# dials the vncproxy behind them
+CONSOLE_SESSION_PREFIX = 'console_session|'
+
+
+def get_target_key(token):
+    return f'{VNC_TARGET_NAMESPACE}:{token}'
+
+
+def get_vm_token_key(vmid):
+    return f'{VNC_TOKEN_PREFIX}{vmid}'
+
+
+def get_console_session_key(vmid, user):
+    return f'{CONSOLE_SESSION_PREFIX}{vmid}|{user}'
+
+
+def add_vnc_target(redis_conn, vmid, user, node, port, ttl):
+    token = gen_password(32, 'abcdefghijklmnopqrstuvwxyz0123456789')
+    target = {'host': node, 'port': int(port), 'user': user, 'vmid': int(vmid)}
+    expires = time.time() + ttl
+    pipe = redis_conn.pipeline()
+    pipe.set(get_target_key(token), json.dumps(target), ex=ttl)
+    pipe.zadd(get_vm_token_key(vmid), {token: expires})
+    pipe.expire(get_vm_token_key(vmid), ttl)
+    pipe.zadd(VNC_TOKEN_EXPIRY_KEY, {f'{vmid}|{token}': expires})
+    pipe.execute()
+    return token
+
+
+def get_vnc_target(redis_conn, token):
+    """Returns the target a token was issued for, or None once it has
+    expired or been revoked."""
+    target = redis_conn.get(get_target_key(token))
+    if target is None:
+        return None
+    return json.loads(target)
+
+
+def cache_console_session(redis_conn, vmid, user, session, ttl):
+    redis_conn.set(get_console_session_key(vmid, user), json.dumps(session), ex=ttl)
+
+
+def get_console_session(redis_conn, vmid, user):
+    """Returns the cached console parameters for user and vmid, or None.
+
+    A Proxmox vncproxy listener takes a single connection, so a session is
+    only reusable until the console proxy dials it. Sessions whose token has
+    been revoked since are ignored.
+    """
+    session = redis_conn.get(get_console_session_key(vmid, user))
+    if session is None:
+        return None
+    session = json.loads(session)
+    if not redis_conn.exists(get_target_key(session['token'])):
+        return None
+    return session
+
+
+def release_console_session(redis_conn, vmid, user):
+    redis_conn.delete(get_console_session_key(vmid, user))
+
+
+def delete_vnc_target(redis_conn, token):
+    return bool(redis_conn.delete(get_target_key(token)))
+
+
+def revoke_vm_console(redis_conn, vmid):
+    """Revokes every console token issued for vmid. Returns False if there
+    were none."""
+    tokens = [token.decode('utf-8') for token in redis_conn.zrange(get_vm_token_key(vmid), 0, -1)]
+    if not tokens:
+        return False
+    pipe = redis_conn.pipeline()
+    pipe.delete(*[get_target_key(token) for token in tokens])
+    pipe.delete(get_vm_token_key(vmid))
+    pipe.zrem(VNC_TOKEN_EXPIRY_KEY, *[f'{vmid}|{token}' for token in tokens])
+    pipe.execute()
+    return True
+
+
+def sweep_vnc_tokens(redis_conn, now=None):
+    """Drops index entries for tokens that have expired and returns how many.
+
+    The target keys expire in Redis on their own; this only trims the
+    per-VM and expiry indexes, touching nothing but the expired entries.
+    """
+    if now is None:
+        now = time.time()
+    expired = [
+        entry.decode('utf-8')
+        for entry in redis_conn.zrangebyscore(VNC_TOKEN_EXPIRY_KEY, '-inf', now)
+    ]
+    if not expired:
+        return 0
+    pipe = redis_conn.pipeline()
+    for entry in expired:
+        vmid, token = entry.split('|', 1)
+        pipe.zrem(get_vm_token_key(vmid), token)
+    pipe.zrem(VNC_TOKEN_EXPIRY_KEY, *expired)
+    pipe.execute()
+    return len(expired)
 
 
 def open_vnc_session(vmid, node, proxmox):
     """Pings the Proxmox API to request a VNC Proxy connection. Authenticates
     against the API using a Uname/Token, gets a few tokens back, then uses those
     tokens to  open the VNC Proxy. Use these to connect to the VM's host with
-    websockify proxy.
+    the console proxy.
     Returns: Ticket to use as the noVNC password, and a port.
     """
     # TODO (willnilges): Report errors
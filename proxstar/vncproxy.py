@@ -0,0 +1,309 @@
+"""Console proxy between noVNC in the browser and the VNC ports Proxmox opens.
+
+Run it with `python -m proxstar.vncproxy`. The browser connects with a token
+issued by /vm/<vmid>/console; the token is looked up in Redis, the VNC server
+is dialled and bytes are pumped both ways until either side hangs up.
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import struct
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from flask import Flask
+from redis import Redis
+
+from proxstar.metrics import (
+    CONSOLE_CONNECT_METRIC,
+    CONSOLE_SESSION_METRIC,
+    CONSOLE_THROUGHPUT_METRIC,
+    observe_quietly,
+)
+from proxstar.vnc import get_vnc_target, release_console_session
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+CLOSE_NORMAL = 1000
+CLOSE_UNSUPPORTED = 1003
+CLOSE_TOO_BIG = 1009
+READ_SIZE = 64 * 1024
+MAX_REQUEST_SIZE = 16 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class HandshakeError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f'{status} {reason}')
+        self.status = status
+        self.reason = reason
+
+
+class ProtocolError(Exception):
+    def __init__(self, code, reason):
+        super().__init__(reason)
+        self.code = code
+
+
+def accept_key(key):
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def frame_header(opcode, length):
+    # Server frames are never masked, so the payload can follow the header
+    # as its own buffer without being copied into a single frame
+    first = 0x80 | opcode
+    if length < 126:
+        return struct.pack('!BB', first, length)
+    if length < 1 << 16:
+        return struct.pack('!BBH', first, 126, length)
+    return struct.pack('!BBQ', first, 127, length)
+
+
+def unmask(payload, mask):
+    # XOR the whole payload as one integer rather than byte by byte
+    length = len(payload)
+    if not length:
+        return payload
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+async def read_frame(reader):
+    """Reads one client frame and returns (opcode, payload)."""
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack('!Q', await reader.readexactly(8))
+    if not second & 0x80:
+        raise ProtocolError(CLOSE_UNSUPPORTED, 'Client frames must be masked')
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(CLOSE_TOO_BIG, f'Frame of {length} bytes is too large')
+    mask = await reader.readexactly(4)
+    return opcode, unmask(await reader.readexactly(length), mask)
+
+
+async def read_request(reader):
+    """Reads the HTTP upgrade request and returns (path, headers)."""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError as e:
+        raise HandshakeError(431, 'Request Header Fields Too Large') from e
+    except asyncio.IncompleteReadError as e:
+        raise HandshakeError(400, 'Bad Request') from e
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or parts[0] != 'GET':
+        raise HandshakeError(400, 'Bad Request')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return parts[1], headers
+
+
+class ConsoleSession:
+    def __init__(self, target):
+        self.target = target
+        self.start = time.time()
+        self.bytes_to_vm = 0
+        self.bytes_to_client = 0
+
+
+class VNCProxy:
+    """Serves console websockets.
+
+    At most user_limit consoles per user are open at once through this
+    process; further handshakes are refused with 429.
+    """
+
+    def __init__(self, redis_conn, user_limit, connect_timeout=10):
+        self.redis_conn = redis_conn
+        self.user_limit = user_limit
+        self.connect_timeout = connect_timeout
+        self.connections = {}
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_SIZE)
+        logging.info('Console proxy listening on %s:%s', host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            await self._handle(reader, writer)
+        except HandshakeError as e:
+            logging.info('Refused console connection: %s', e)
+            writer.write(
+                f'HTTP/1.1 {e.status} {e.reason}\r\n'
+                'Connection: close\r\nContent-Length: 0\r\n\r\n'.encode('ascii')
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Console connection failed: %s', e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _handle(self, reader, writer):
+        path, headers = await read_request(reader)
+        if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+            raise HandshakeError(400, 'Bad Request')
+        token = parse_qs(urlsplit(path).query).get('token', [None])[0]
+        if not token:
+            raise HandshakeError(403, 'Forbidden')
+        requested = time.time()
+        target = await asyncio.to_thread(get_vnc_target, self.redis_conn, token)
+        if target is None:
+            raise HandshakeError(403, 'Forbidden')
+        user = target['user']
+        if self.connections.get(user, 0) >= self.user_limit:
+            raise HandshakeError(429, 'Too Many Requests')
+        # Counted before the dial so parallel handshakes can't overshoot
+        self.connections[user] = self.connections.get(user, 0) + 1
+        try:
+            try:
+                upstream_reader, upstream_writer = await asyncio.wait_for(
+                    asyncio.open_connection(target['host'], target['port']), self.connect_timeout
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.error('Could not reach VNC server for VM %s: %s', target['vmid'], e)
+                raise HandshakeError(502, 'Bad Gateway') from e
+            # The vncproxy listener is spent; the next open needs a new one
+            await asyncio.to_thread(release_console_session, self.redis_conn, target['vmid'], user)
+            await self._observe(
+                CONSOLE_CONNECT_METRIC, time.time() - requested, {'node': target['host']}
+            )
+            response = [
+                'HTTP/1.1 101 Switching Protocols',
+                'Upgrade: websocket',
+                'Connection: Upgrade',
+                'Sec-WebSocket-Accept: ' + accept_key(headers['sec-websocket-key']),
+            ]
+            protocols = [p.strip() for p in headers.get('sec-websocket-protocol', '').split(',')]
+            if 'binary' in protocols:
+                response.append('Sec-WebSocket-Protocol: binary')
+            writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('ascii'))
+            session = ConsoleSession(target)
+            try:
+                await self._proxy(reader, writer, upstream_reader, upstream_writer, session)
+            finally:
+                upstream_writer.close()
+                await self._record(session)
+        finally:
+            self.connections[user] -= 1
+            if not self.connections[user]:
+                del self.connections[user]
+
+    async def _proxy(
+        self, reader, writer, upstream_reader, upstream_writer, session
+    ):  # pylint: disable=too-many-arguments
+        pumps = [
+            asyncio.create_task(self._to_vm(reader, writer, upstream_writer, session)),
+            asyncio.create_task(self._to_client(upstream_reader, writer, session)),
+        ]
+        done, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        for pump in pending:
+            pump.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for pump in done:
+            if pump.exception() is not None and not isinstance(
+                pump.exception(), (asyncio.IncompleteReadError, ConnectionError)
+            ):
+                logging.error(
+                    'Console for VM %s failed: %s', session.target['vmid'], pump.exception()
+                )
+
+    async def _to_vm(self, reader, writer, upstream_writer, session):
+        while True:
+            try:
+                opcode, payload = await read_frame(reader)
+            except ProtocolError as e:
+                self._close(writer, e.code)
+                return
+            if opcode in (OP_BINARY, OP_CONTINUATION):
+                upstream_writer.write(payload)
+                session.bytes_to_vm += len(payload)
+                await upstream_writer.drain()
+            elif opcode == OP_PING:
+                writer.writelines((frame_header(OP_PONG, len(payload)), payload))
+            elif opcode == OP_CLOSE:
+                writer.writelines((frame_header(OP_CLOSE, len(payload)), payload))
+                await writer.drain()
+                return
+            elif opcode != OP_PONG:
+                # noVNC dropped base64 text framing long ago
+                self._close(writer, CLOSE_UNSUPPORTED)
+                return
+
+    async def _to_client(self, upstream_reader, writer, session):
+        while True:
+            data = await upstream_reader.read(READ_SIZE)
+            if not data:
+                self._close(writer, CLOSE_NORMAL)
+                await writer.drain()
+                return
+            writer.writelines((frame_header(OP_BINARY, len(data)), data))
+            session.bytes_to_client += len(data)
+            await writer.drain()
+
+    @staticmethod
+    def _close(writer, code):
+        payload = struct.pack('!H', code)
+        writer.writelines((frame_header(OP_CLOSE, len(payload)), payload))
+
+    async def _observe(self, metric, seconds, labels):
+        # The Redis client is synchronous; keep it off the event loop
+        await asyncio.to_thread(observe_quietly, self.redis_conn, metric, seconds, labels)
+
+    async def _record(self, session):
+        duration = max(time.time() - session.start, 0.001)
+        node = session.target['host']
+        logging.info(
+            'Console for VM %s (%s) closed after %.1fs: %s bytes to VM, %s bytes to client',
+            session.target['vmid'],
+            session.target['user'],
+            duration,
+            session.bytes_to_vm,
+            session.bytes_to_client,
+        )
+        await self._observe(CONSOLE_SESSION_METRIC, duration, {'node': node})
+        for direction, sent in (
+            ('to_vm', session.bytes_to_vm),
+            ('to_client', session.bytes_to_client),
+        ):
+            await self._observe(
+                CONSOLE_THROUGHPUT_METRIC, sent / duration, {'node': node, 'direction': direction}
+            )
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    app = Flask(__name__)
+    if os.path.exists(os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')):
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')
+    else:
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config.py')
+    app.config.from_pyfile(config)
+    redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+    proxy = VNCProxy(redis_conn, app.config['VNC_PROXY_USER_LIMIT'])
+    asyncio.run(proxy.serve(app.config['VNC_PROXY_BIND'], int(app.config['VNC_PROXY_PORT'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Watches the cluster and publishes VM changes.
+
+Run it with `./start_watcher.sh` (`python -m proxstar.watcher`). Every
+WATCHER_INTERVAL seconds it reads cluster/resources once, diffs it against
+the previous snapshot and publishes one event per change. The snapshot is
+kept in Redis so web workers can read VM state without asking Proxmox.
+"""
+
+import json
+import logging
+import os
+import time
+
+from flask import Flask
+from redis import Redis
+
+from proxstar.events import get_vm_generation_key, publish_quietly
+from proxstar.hostnames import add_hostname, remove_hostname
+from proxstar.proxmox import connect_proxmox
+
+CLUSTER_SNAPSHOT_KEY = 'cluster|vms'
+CLUSTER_SNAPSHOT_FRESH_KEY = 'cluster|vms_fresh'
+# Capped stream of every event, for consumers that must not miss one
+CLUSTER_EVENTS_KEY = 'cluster|events'
+# Fields kept per VM; the rest of cluster/resources changes every poll
+SNAPSHOT_FIELDS = ('vmid', 'name', 'node', 'status', 'pool', 'template', 'maxcpu', 'maxmem')
+
+
+def _snapshot_entry(vm):
+    return {field: vm.get(field) for field in SNAPSHOT_FIELDS}
+
+
+def take_snapshot(proxmox):
+    return {int(vm['vmid']): _snapshot_entry(vm) for vm in proxmox.cluster.resources.get(type='vm')}
+
+
+def diff_snapshots(previous, current):
+    """Returns (event, vm, old vm) for every change between snapshots; old
+    vm is None for created and deleted VMs.
+
+    A VM can produce several events in one poll, e.g. migrated and status
+    changed.
+    """
+    changes = []
+    for vmid, vm in current.items():
+        old = previous.get(vmid)
+        if old is None:
+            changes.append(('created', vm, None))
+            continue
+        if old['status'] != vm['status']:
+            changes.append(('status changed', vm, old))
+        if old['node'] != vm['node']:
+            changes.append(('migrated', vm, old))
+        if old['pool'] != vm['pool']:
+            changes.append(('pool changed', vm, old))
+    for vmid, old in previous.items():
+        if vmid not in current:
+            changes.append(('deleted', old, None))
+    return changes
+
+
+def store_snapshot(redis_conn, snapshot, fresh_ttl):
+    # Built under a staging key and renamed, so readers never see half of it
+    staging_key = f'{CLUSTER_SNAPSHOT_KEY}|staging'
+    pipe = redis_conn.pipeline()
+    pipe.delete(staging_key)
+    if snapshot:
+        pipe.hset(staging_key, mapping={vmid: json.dumps(vm) for vmid, vm in snapshot.items()})
+        pipe.rename(staging_key, CLUSTER_SNAPSHOT_KEY)
+    else:
+        pipe.delete(CLUSTER_SNAPSHOT_KEY)
+    pipe.set(CLUSTER_SNAPSHOT_FRESH_KEY, str(time.time()), ex=fresh_ttl)
+    pipe.execute()
+
+
+def load_snapshot(redis_conn):
+    return {
+        int(vmid): json.loads(vm) for vmid, vm in redis_conn.hgetall(CLUSTER_SNAPSHOT_KEY).items()
+    }
+
+
+def get_cluster_snapshot(redis_conn):
+    """Returns the watcher's snapshot as {vmid: vm}, or None when the watcher
+    has not refreshed it recently and callers should ask Proxmox."""
+    if not redis_conn.exists(CLUSTER_SNAPSHOT_FRESH_KEY):
+        return None
+    return load_snapshot(redis_conn)
+
+
+def publish_changes(redis_conn, changes, stream_length):
+    messages = []
+    for event, vm, old in changes:
+        data = dict(vm, event=event)
+        # Pools are named after their owner; a pool change concerns both
+        users = {vm['pool']}
+        if old is not None:
+            data['previous'] = {field: old[field] for field in ('status', 'node', 'pool')}
+            users.add(old['pool'])
+        messages.append((users - {None}, data))
+    pipe = redis_conn.pipeline(transaction=False)
+    for _, data in messages:
+        pipe.xadd(
+            CLUSTER_EVENTS_KEY, {'event': json.dumps(data)}, maxlen=stream_length, approximate=True
+        )
+        pipe.incr(get_vm_generation_key(data['vmid']))
+    pipe.execute()
+    for users, data in messages:
+        publish_quietly(redis_conn, users, 'vm', data)
+
+
+def sync_hostnames(redis_conn, changes, current):
+    """Keeps the hostname index current between its rebuilds.
+
+    A name can be deleted and reused within one poll, so a name is only
+    removed when no VM in the new snapshot has it.
+    """
+    names = {vm['name'] for vm in current.values() if vm.get('name')}
+    for event, vm, _ in changes:
+        if not vm.get('name'):
+            continue
+        if event == 'created':
+            add_hostname(redis_conn, vm['name'])
+        elif event == 'deleted' and vm['name'] not in names:
+            remove_hostname(redis_conn, vm['name'])
+
+
+def watch_once(redis_conn, proxmox, previous, config):
+    """Runs one poll and returns the new snapshot.
+
+    previous is None on the first poll after start; nothing is published
+    then unless Redis still holds the snapshot from the last run.
+    """
+    current = take_snapshot(proxmox)
+    if previous is None:
+        previous = load_snapshot(redis_conn) or None
+    store_snapshot(redis_conn, current, config['WATCHER_STALE_SECONDS'])
+    if previous is not None:
+        changes = diff_snapshots(previous, current)
+        if changes:
+            publish_changes(redis_conn, changes, config['WATCHER_EVENT_STREAM_LENGTH'])
+            logging.info('Published %s cluster change(s)', len(changes))
+            try:
+                sync_hostnames(redis_conn, changes, current)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Could not update hostname index: %s', e)
+    return current
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    app = Flask(__name__)
+    if os.path.exists(os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')):
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config_local.py')
+    else:
+        config = os.path.join(app.config.get('ROOT_DIR', os.getcwd()), 'config.py')
+    app.config.from_pyfile(config)
+    redis_conn = Redis(app.config['REDIS_HOST'], app.config['REDIS_PORT'])
+    interval = app.config['WATCHER_INTERVAL']
+    snapshot = None
+    proxmox = None
+    with app.app_context():
+        while True:
+            started = time.monotonic()
+            try:
+                if proxmox is None:
+                    proxmox = connect_proxmox()
+                snapshot = watch_once(redis_conn, proxmox, snapshot, app.config)
+            except Exception as e:  # pylint: disable=broad-except
+                # Reconnect next time; a failed poll leaves the old snapshot
+                # to go stale so readers fall back to Proxmox
+                logging.error('Cluster poll failed: %s', e)
+                proxmox = None
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
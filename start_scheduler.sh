@@ -2,4 +2,8 @@
 
 PROXSTAR_REDIS_URL=redis://$PROXSTAR_REDIS_HOST:$PROXSTAR_REDIS_PORT
 
-rqscheduler -u "$PROXSTAR_REDIS_URL"
+# Periodic jobs are registered here rather than by every web worker
+python -m proxstar.schedules || exit 1
+
+# Poll often enough that debounced refresh jobs fire close to their due time.
+rqscheduler -u "$PROXSTAR_REDIS_URL" -i "${PROXSTAR_SCHEDULER_INTERVAL:-5}"
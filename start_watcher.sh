@@ -0,0 +1,4 @@
+#!/bin/sh
+
+# One process per deployment; it polls Proxmox on behalf of every web worker.
+exec python -m proxstar.watcher
@@ -2,4 +2,15 @@
 
 PROXSTAR_REDIS_URL=redis://$PROXSTAR_REDIS_HOST:$PROXSTAR_REDIS_PORT
 
-rq worker -u "$PROXSTAR_REDIS_URL" -c rqsettings
+# Queues are listed highest priority first. Pin a worker to a subset by passing
+# queue names as arguments or via PROXSTAR_WORKER_QUEUES, e.g.
+#   ./start_worker.sh interactive
+#   PROXSTAR_WORKER_QUEUES="provisioning maintenance" ./start_worker.sh
+# "default" is kept last so jobs queued before the split still drain.
+if [ "$#" -gt 0 ]; then
+    PROXSTAR_WORKER_QUEUES="$*"
+fi
+PROXSTAR_WORKER_QUEUES=${PROXSTAR_WORKER_QUEUES:-"interactive provisioning maintenance default"}
+
+# shellcheck disable=SC2086
+rq worker -u "$PROXSTAR_REDIS_URL" -c rqsettings $PROXSTAR_WORKER_QUEUES
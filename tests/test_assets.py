@@ -0,0 +1,68 @@
+import gzip
+
+from flask import Flask, url_for
+
+from proxstar import assets
+
+
+def _static_dir(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'js').mkdir(parents=True)
+    (static / 'css').mkdir()
+    (static / 'noVNC' / 'core').mkdir(parents=True)
+    (static / 'js' / 'script.js').write_text('function hello() {\n    return "hi";\n}\n' * 50)
+    (static / 'css' / 'styles.css').write_text('body {\n    color: red;\n}\n')
+    (static / 'css' / 'circle.css').write_text('.c {\n    margin: 0;\n}\n')
+    (static / 'noVNC' / 'core' / 'rfb.js').write_text('export default class RFB {}\n' * 50)
+    return static
+
+
+def test_build_fingerprints_and_compresses(tmp_path):
+    static = _static_dir(tmp_path)
+    manifest = assets.build(str(static))
+    script = manifest['js/script.js']
+    assert script.startswith('dist/js/script.') and script.endswith('.js')
+    assert (
+        gzip.decompress((static / (script + '.gz')).read_bytes()) == (static / script).read_bytes()
+    )
+    assert (static / manifest['noVNC'] / 'core' / 'rfb.js.gz').exists()
+    assert assets.load_manifest(str(static)) == manifest
+    # Same contents, same names
+    assert assets.build(str(static)) == manifest
+    assert assets.resolve(manifest, 'noVNC/core/rfb.js') == manifest['noVNC'] + '/core/rfb.js'
+    assert assets.resolve(manifest, 'img/logo.png') == 'img/logo.png'
+
+
+def test_built_assets_are_linked_and_served_immutable(tmp_path):
+    static = _static_dir(tmp_path)
+    manifest = assets.build(str(static))
+    app = Flask(__name__, static_folder=str(static))
+    assets.init_assets(app)
+    with app.test_request_context():
+        url = url_for('static', filename='js/script.js')
+    assert url == f'/static/{manifest["js/script.js"]}'
+
+    client = app.test_client()
+    response = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/javascript'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == (static / manifest['js/script.js']).read_bytes()
+    response.close()
+
+    response = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    response.close()
+
+    response = client.get('/static/css/styles.css')
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+    response.close()
+
+
+def test_unbuilt_assets_are_served_from_source(tmp_path):
+    static = _static_dir(tmp_path)
+    app = Flask(__name__, static_folder=str(static))
+    assets.init_assets(app)
+    with app.test_request_context():
+        assert url_for('static', filename='js/script.js') == '/static/js/script.js'
@@ -0,0 +1,155 @@
+from types import SimpleNamespace
+
+from rq.job import Job
+
+import proxstar as app_mod
+
+
+class FakeScript:
+    # Mirrors the compare-and-delete release script
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __call__(self, keys, args):
+        value = args[0] if isinstance(args[0], bytes) else args[0].encode('utf-8')
+        if self.redis.get(keys[0]) == value:
+            del self.redis.store[keys[0]]
+            return 1
+        return 0
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def register_script(self, _script):
+        return FakeScript(self)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, nx=False, ex=None):  # pylint: disable=unused-argument
+        if nx and key in self.store:
+            return None
+        self.store[key] = value.encode('utf-8')
+        return True
+
+
+class FakeJob:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'queued'
+
+    def get_status(self):
+        return self.status
+
+
+class FakeQueue:
+    def __init__(self):
+        self.jobs = {}
+        self.kwargs = None
+
+    def enqueue(self, *_args, **kwargs):
+        job = FakeJob(f'job-{len(self.jobs) + 1}')
+        self.jobs[job.id] = job
+        self.kwargs = kwargs
+        return job
+
+    def fetch_job(self, job_id):
+        return self.jobs.get(job_id)
+
+
+class FakeUser:
+    def __init__(self, name):
+        self.name = name
+        self.rtp = False
+        self.active = True
+
+    def check_usage(self, *_args):
+        return None
+
+
+FORM = {
+    'name': 'vm1',
+    'cores': '2',
+    'mem': '2048',
+    'template': '100',
+    'disk': '10',
+    'iso': 'none',
+    'ssh_key': '',
+}
+
+
+def _create():
+    with app_mod.app.test_request_context('/vm/create', method='POST', data=FORM):
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        return app_mod.create()
+
+
+def _setup(monkeypatch, reserve=lambda *_args: True):
+    queue = FakeQueue()
+    redis = FakeRedis()
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    monkeypatch.setattr(app_mod, 'connect_proxmox', lambda: object())
+    monkeypatch.setattr(app_mod, 'redis_conn', redis)
+    monkeypatch.setattr(app_mod, 'provisioning_q', queue)
+    monkeypatch.setattr(app_mod, 'reserve_hostname', reserve)
+    return queue, redis
+
+
+def test_duplicate_create_returns_existing_job(monkeypatch):
+    queue, _ = _setup(monkeypatch)
+
+    first = _create().get_json()
+    second = _create().get_json()
+    assert first == second == {'job_id': 'job-1'}
+    assert len(queue.jobs) == 1
+
+    # A failed job does not block a fresh attempt
+    queue.jobs['job-1'].status = 'failed'
+    assert _create().get_json() == {'job_id': 'job-2'}
+
+
+def test_create_again_after_the_first_job_finished(monkeypatch):
+    queue, _ = _setup(monkeypatch)
+    assert _create().get_json() == {'job_id': 'job-1'}
+    # e.g. the VM was created, then deleted, within CREATE_REQUEST_TTL
+    queue.jobs['job-1'].status = 'finished'
+    assert _create().get_json() == {'job_id': 'job-2'}
+    assert len(queue.jobs) == 2
+
+
+def test_concurrent_create_returns_pending(monkeypatch):
+    queue, redis = _setup(monkeypatch)
+    # Another request claimed the key and is still enqueueing
+    redis.store[app_mod._create_request_key('alice', 'vm1')] = b'claim|other'
+    assert _create().get_json() == {'job_id': None, 'pending': True}
+    assert not queue.jobs
+
+
+def test_taken_name_releases_claim(monkeypatch):
+    queue, redis = _setup(monkeypatch, reserve=lambda *_args: False)
+    response, status = _create()
+    assert (response, status) == ('', 200)
+    assert not queue.jobs
+    assert app_mod._create_request_key('alice', 'vm1') not in redis.store
+
+
+class FakePipeline:
+    def __getattr__(self, _name):
+        return lambda *_args, **_kwargs: None
+
+
+def test_failed_template_setup_is_requeued(monkeypatch):
+    queue, _ = _setup(monkeypatch)
+    _create()
+    retry = queue.kwargs['retry']
+    job = Job.create(print, connection=FakePipeline())
+    job.retries_left, job.retry_intervals = retry.max, retry.intervals
+    requeued = []
+    # A retry with an interval would go to schedule_job, which only a worker
+    # started with --with-scheduler ever runs
+    retry_queue = SimpleNamespace(_enqueue_job=lambda job, pipeline: requeued.append(job))
+    job.retry(retry_queue, FakePipeline())
+    assert requeued == [job]
+    assert job.retries_left == retry.max - 1
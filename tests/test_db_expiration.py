@@ -0,0 +1,53 @@
+import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from proxstar.db import get_expiring_vms, get_vm_expires
+from proxstar.models import VM_Expiration
+
+
+def _make_session():
+    engine = create_engine('sqlite://')
+    VM_Expiration.__table__.create(engine)
+    statements = []
+    event.listen(
+        engine,
+        'before_cursor_execute',
+        lambda _conn, _cursor, statement, *_args: statements.append(statement),
+    )
+    return sessionmaker(bind=engine)(), statements
+
+
+def test_get_vm_expires_loads_and_inserts_in_bulk():
+    session, statements = _make_session()
+    existing = datetime.date.today() + datetime.timedelta(days=3)
+    session.add(VM_Expiration(id=100, expire_date=existing))
+    session.commit()
+    statements.clear()
+
+    expires = get_vm_expires(session, [100, '101', 102], 3)
+
+    assert expires[100] == existing
+    assert expires[101] == expires[102]
+    assert expires[101] > existing
+    selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+    inserts = [s for s in statements if s.lstrip().upper().startswith('INSERT')]
+    assert len(selects) == 1
+    assert len(inserts) == 1
+    assert session.query(VM_Expiration).count() == 3
+
+
+def test_get_expiring_vms_uses_date_range():
+    session, _ = _make_session()
+    today = datetime.date.today()
+    session.add_all(
+        [
+            VM_Expiration(id=1, expire_date=today - datetime.timedelta(days=2)),
+            VM_Expiration(id=2, expire_date=today + datetime.timedelta(days=10)),
+            VM_Expiration(id=3, expire_date=today + datetime.timedelta(days=11)),
+        ]
+    )
+    session.commit()
+
+    assert sorted(get_expiring_vms(session)) == [1, 2]
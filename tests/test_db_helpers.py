@@ -0,0 +1,123 @@
+import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from proxstar.db import (
+    Base,
+    add_allowed_users,
+    add_ignored_pools,
+    delete_allowed_users,
+    delete_ignored_pools,
+    delete_vm_expires,
+    get_allowed_users,
+    get_ignored_pools,
+    get_template,
+    get_template_disk,
+    get_templates_by_id,
+    get_users_usage_limits,
+    get_vm_expire,
+    is_allowed_user,
+    renew_vm_expires,
+    set_templates_info,
+    set_users_usage_limits,
+    sync_templates,
+)
+from proxstar.models import (
+    Allowed_Users,
+    Ignored_Pools,
+    Template,
+    Usage_Limit,
+    VM_Expiration,
+)
+
+
+def _make_session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(
+        engine,
+        tables=[
+            Allowed_Users.__table__,
+            Ignored_Pools.__table__,
+            Template.__table__,
+            Usage_Limit.__table__,
+            VM_Expiration.__table__,
+        ],
+    )
+    statements = []
+    event.listen(
+        engine,
+        'before_cursor_execute',
+        lambda _conn, _cursor, statement, *_args: statements.append(statement),
+    )
+    return sessionmaker(bind=engine)(), statements
+
+
+def test_vm_expire_upsert_and_delete_returning():
+    session, statements = _make_session()
+    old = datetime.date.today() - datetime.timedelta(days=30)
+    session.add(VM_Expiration(id=1, expire_date=old))
+    session.commit()
+    statements.clear()
+
+    renewed = renew_vm_expires(session, [1, 2], 3)
+
+    assert len(statements) == 1
+    assert get_vm_expire(session, 1, 3) == renewed
+    assert get_vm_expire(session, 2, 3) == renewed
+    assert sorted(delete_vm_expires(session, [1, 2, 3])) == [1, 2]
+    assert session.query(VM_Expiration).count() == 0
+
+
+def test_usage_limits_batch_upsert_and_load():
+    session, statements = _make_session()
+    set_users_usage_limits(session, ['alice', 'bob'], 4, 4, 100)
+    set_users_usage_limits(session, ['bob'], 2, 2, 50)
+    statements.clear()
+
+    limits = get_users_usage_limits(session, ['alice', 'bob', 'carol'])
+
+    assert len(statements) == 1
+    assert limits['alice'] == {'cpu': 4, 'mem': 4, 'disk': 100}
+    assert limits['bob'] == {'cpu': 2, 'mem': 2, 'disk': 50}
+    assert limits['carol'] == {'cpu': 8, 'mem': 8, 'disk': 250}
+
+
+def test_allowed_users_and_ignored_pools_are_idempotent():
+    session, _ = _make_session()
+    add_allowed_users(session, ['alice', 'bob'])
+    add_allowed_users(session, ['alice'])
+    add_ignored_pools(session, ['lab'])
+    add_ignored_pools(session, ['lab'])
+
+    assert sorted(get_allowed_users(session)) == ['alice', 'bob']
+    assert is_allowed_user(session, 'bob')
+    assert delete_allowed_users(session, ['bob', 'carol']) == ['bob']
+    assert not is_allowed_user(session, 'bob')
+    assert get_ignored_pools(session) == ['lab']
+    assert delete_ignored_pools(session, ['lab']) == ['lab']
+    assert get_ignored_pools(session) == []
+
+
+def test_sync_templates_and_batch_template_info():
+    session, statements = _make_session()
+    session.add_all([Template(id=1, name='old', disk=0), Template(id=9, name='gone', disk=5)])
+    session.commit()
+    statements.clear()
+
+    sync_templates(session, [{'id': 1, 'name': 'debian', 'disk': 10}, {'id': '2', 'disk': 20}])
+
+    assert len([s for s in statements if s.lstrip().upper().startswith('SELECT')]) == 1
+    assert get_templates_by_id(session, [1, 2, 9]) == {
+        1: {'id': 1, 'name': 'debian', 'disk': 10},
+        2: {'id': 2, 'name': '2', 'disk': 20},
+    }
+
+    set_templates_info(session, {1: ('bookworm', 12), '2': ('rocky', 30)})
+    assert get_template(session, '1') == {'id': 1, 'name': 'bookworm', 'disk': 12}
+    assert get_template_disk(session, 2) == '30'
+    assert get_template_disk(session, 9) == '0'
+    assert get_template(session, 9) == {}
+    # Malformed ids from routes such as /template/abc/disk are not found
+    assert get_template(session, 'abc') is None
+    assert get_template_disk(session, 'abc') is None
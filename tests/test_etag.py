@@ -0,0 +1,160 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from werkzeug.exceptions import Forbidden
+
+import proxstar as app_mod
+from proxstar.events import get_user_generation_key, get_vm_generation_key
+from proxstar.watcher import CLUSTER_SNAPSHOT_FRESH_KEY, CLUSTER_SNAPSHOT_KEY
+
+
+class FakeRedis:
+    def __init__(self, store=None):
+        self.store = dict(store or {})
+        self.calls = []
+        self.piped = False
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        self.piped = True
+        return self
+
+    def hgetall(self, key):
+        return self.store.get(key, {})
+
+    def mget(self, keys):
+        self.calls.append(('mget', keys))
+
+    def exists(self, key):
+        if not self.piped:
+            return int(key in self.store)
+        self.calls.append(('exists', key))
+
+    def incr(self, key):
+        self.calls.append(('incr', key))
+
+    def delete(self, key):
+        self.calls.append(('delete', key))
+
+    def execute(self):
+        results = []
+        for call in self.calls:
+            if call[0] == 'mget':
+                results.append([self.store.get(key) for key in call[1]])
+            elif call[0] == 'exists':
+                results.append(int(call[1] in self.store))
+            elif call[0] == 'delete':
+                results.append(int(self.store.pop(call[1], None) is not None))
+            else:
+                self.store[call[1]] = int(self.store.get(call[1], 0)) + 1
+                results.append(self.store[call[1]])
+        self.calls = []
+        self.piped = False
+        return results
+
+
+def test_version_tag_needs_fresh_watcher(monkeypatch):
+    key = get_vm_generation_key(100)
+    monkeypatch.setattr(app_mod, 'redis_conn', FakeRedis({key: b'3'}))
+    with app_mod.app.app_context():
+        assert app_mod._version_tag([key]) is None
+        assert app_mod._version_tag([key], needs_watcher=False).endswith('-3')
+
+
+def test_version_tag_changes_with_generation(monkeypatch):
+    key = get_vm_generation_key(100)
+    fake = FakeRedis({CLUSTER_SNAPSHOT_FRESH_KEY: b'1'})
+    monkeypatch.setattr(app_mod, 'redis_conn', fake)
+    with app_mod.app.app_context():
+        before = app_mod._version_tag([key, get_user_generation_key('alice')])
+        assert before.endswith('-0-0')
+        fake.store[key] = b'1'
+        assert app_mod._version_tag([key, get_user_generation_key('alice')]) != before
+
+
+def test_conditional_json_skips_build_on_match():
+    built = []
+
+    def build():
+        built.append(True)
+        return {'vms': []}
+
+    with app_mod.app.test_request_context('/api/vms', headers={'If-None-Match': '"abc-1"'}):
+        response = app_mod._conditional_json('abc-1', build)
+        assert response.status_code == 304
+        assert response.headers['ETag'] == '"abc-1"'
+        assert not built
+        response = app_mod._conditional_json('abc-2', build)
+        assert response.status_code == 200
+        assert response.get_json() == {'vms': []}
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+
+def test_conditional_json_without_tag():
+    with app_mod.app.test_request_context('/api/vms', headers={'If-None-Match': '*'}):
+        response = app_mod._conditional_json(None, lambda: {'vms': []})
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+
+
+def test_successful_post_bumps_generations(monkeypatch):
+    fake = FakeRedis({'vm_list|alice': b'[]'})
+    monkeypatch.setattr(app_mod, 'redis_conn', fake)
+    with app_mod.app.test_request_context('/vm/100/power/start', method='POST'):
+        app_mod.request.view_args = {'vmid': '100'}
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        app_mod.bump_generations_after_write(app_mod.Response(status=200))
+        app_mod.bump_generations_after_write(app_mod.Response(status=403))
+    assert fake.store == {
+        get_user_generation_key('alice'): 1,
+        get_vm_generation_key('100'): 1,
+        app_mod.RTP_GENERATION_KEY: 1,
+    }
+
+
+class NoProxmoxUser:
+    def __init__(self, name):
+        self.name = name
+        self.pool_id = name
+        self.rtp = False
+
+    @property
+    def allowed_vms(self):
+        raise AssertionError('allowed_vms lists pools from Proxmox')
+
+
+@pytest.mark.parametrize('view,path', [('vm_hardware', 'hardware'), ('vm_summary', 'summary')])
+def test_matching_etag_makes_no_proxmox_calls(monkeypatch, view, path):
+    def no_proxmox(*_args, **_kwargs):
+        raise AssertionError('Proxmox was called')
+
+    vm = {'vmid': 100, 'pool': 'shared', 'status': 'running'}
+    fake = FakeRedis(
+        {
+            CLUSTER_SNAPSHOT_FRESH_KEY: b'1',
+            CLUSTER_SNAPSHOT_KEY: {b'100': json.dumps(vm).encode()},
+        }
+    )
+    monkeypatch.setattr(app_mod, 'redis_conn', fake)
+    monkeypatch.setattr(app_mod, 'User', NoProxmoxUser)
+    monkeypatch.setattr(app_mod, 'connect_proxmox', no_proxmox)
+    monkeypatch.setattr(app_mod, 'VM', no_proxmox)
+    monkeypatch.setattr(
+        app_mod, 'get_shared_pools', lambda _db, _user, _all: [SimpleNamespace(name='shared')]
+    )
+    with app_mod.app.app_context():
+        keys = [get_vm_generation_key('100')]
+        if view == 'vm_summary':
+            keys.append(get_user_generation_key('alice'))
+        tag = app_mod._version_tag(keys)
+    headers = {'If-None-Match': f'"{tag}"'}
+    with app_mod.app.test_request_context(f'/api/vm/100/{path}', headers=headers):
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        assert getattr(app_mod, view)('100').status_code == 304
+    # Someone else's VM is refused from the snapshot too
+    vm['pool'] = 'bob'
+    fake.store[CLUSTER_SNAPSHOT_KEY] = {b'100': json.dumps(vm).encode()}
+    with app_mod.app.test_request_context(f'/api/vm/100/{path}', headers=headers):
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        with pytest.raises(Forbidden):
+            getattr(app_mod, view)('100')
@@ -0,0 +1,123 @@
+import json
+
+import proxstar as app_mod
+from proxstar import events, tasks
+from proxstar.events import StreamLimit
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, *channels):
+        self.channels.extend(channels)
+
+    def get_message(self, timeout):  # pylint: disable=unused-argument
+        if self.messages:
+            return {'data': self.messages.pop(0)}
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRedis:
+    def __init__(self, messages=()):
+        self.published = []
+        self.deleted = []
+        self.pubsub_conn = FakePubSub(messages)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+    def incr(self, _key):
+        return None
+
+    def delete(self, key):
+        self.deleted.append(key)
+
+    def execute(self):
+        return []
+
+    def pubsub(self, ignore_subscribe_messages=False):  # pylint: disable=unused-argument
+        return self.pubsub_conn
+
+
+class FakeJob:
+    def __init__(self, meta, retries_left=None):
+        self.id = 'job-1'
+        self.meta = meta
+        self.retries_left = retries_left
+        self.connection = FakeRedis()
+
+    def get_meta(self, refresh=True):  # pylint: disable=unused-argument
+        return self.meta
+
+    def save_meta(self):
+        return None
+
+
+def test_publish_sends_to_users_and_rtp():
+    redis = FakeRedis()
+    events.publish(redis, ['alice', 'alice'], 'session', {'user': 'alice'})
+    assert redis.published == [
+        ('events|user|alice', {'type': 'session', 'data': {'user': 'alice'}}),
+        ('events|rtp', {'type': 'session', 'data': {'user': 'alice'}}),
+    ]
+    assert redis.deleted == ['vm_list|alice']
+
+
+def test_stream_events_formats_messages_and_closes():
+    message = json.dumps({'type': 'vm', 'data': {'vmid': 100}})
+    redis = FakeRedis([message])
+    stream = events.stream_events(redis, ['events|user|alice'], lifetime=0.05, keepalive=0)
+    chunks = list(stream)
+    assert chunks[0] == f'retry: {events.RECONNECT_MS}\n\n'
+    assert chunks[1] == 'event: vm\ndata: {"vmid": 100}\n\n'
+    assert ': keepalive\n\n' in chunks[2:]
+    assert redis.pubsub_conn.channels == ['events|user|alice']
+    assert redis.pubsub_conn.closed
+
+
+def test_job_callbacks_mark_final_and_publish():
+    job = FakeJob({'users': ['alice'], 'status': 'completed'})
+    tasks.job_succeeded(job, job.connection, None)
+    assert job.meta['final'] is True
+    assert job.connection.published[0] == (
+        'events|user|alice',
+        {'type': 'job', 'data': {'id': 'job-1', 'status': 'completed', 'final': True}},
+    )
+
+    retrying = FakeJob({'users': ['alice'], 'status': 'waiting for Proxmox'}, retries_left=1)
+    tasks.job_failed(retrying, retrying.connection, RuntimeError, RuntimeError(), None)
+    assert 'final' not in retrying.meta
+    assert not retrying.connection.published
+
+
+def test_event_streams_are_capped_per_process(monkeypatch):
+    class FakeUser:
+        def __init__(self, name):
+            self.name = name
+            self.rtp = False
+
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    monkeypatch.setattr(app_mod, 'event_streams', StreamLimit(1))
+
+    def open_stream():
+        with app_mod.app.test_request_context('/api/events'):
+            app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+            return app_mod.events_api()
+
+    first = open_stream()
+    assert first.mimetype == 'text/event-stream'
+    refused = open_stream()
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == '30'
+    # Closing a stream, even one never read, frees its slot
+    first.close()
+    assert open_stream().status_code == 200
@@ -0,0 +1,82 @@
+import pytest
+
+from proxstar import governor
+
+
+class FakeScript:
+    # Mirrors the Lua acquire script against FakeRedis.zsets
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __call__(self, keys, args):
+        now, expires, token = args[0], args[1], args[2]
+        limits = args[3:]
+        for key, limit in zip(keys, limits):
+            members = self.redis.zsets.setdefault(key, {})
+            for member, score in list(members.items()):
+                if score <= now:
+                    del members[member]
+            if len(members) >= limit:
+                return 0
+        for key in keys:
+            self.redis.zsets[key][token] = expires
+        return 1
+
+
+class FakeRedis:
+    def __init__(self):
+        self.zsets = {}
+
+    def register_script(self, _script):
+        return FakeScript(self)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def execute(self):
+        return []
+
+    def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    def sadd(self, *_args):
+        return None
+
+    def hincrby(self, *_args):
+        return None
+
+    def hincrbyfloat(self, *_args):
+        return None
+
+
+CONFIG = {'GOVERNOR_NODE_LIMIT': 1, 'GOVERNOR_STORAGE_LIMIT': 2}
+
+
+def test_governor_limits_per_node_and_storage(monkeypatch):
+    monkeypatch.setattr(governor.time, 'sleep', lambda *_args: None)
+    redis = FakeRedis()
+    first = governor.acquire(redis, governor.slots_for(CONFIG, 'a', 'ceph'), 60, 0, 'clone')
+    # Node a is full, so nothing is taken on the storage either
+    with pytest.raises(governor.GovernorTimeout):
+        governor.acquire(redis, governor.slots_for(CONFIG, 'a', 'ceph'), 60, 0, 'clone')
+    assert len(redis.zsets['governor|storage|ceph']) == 1
+
+    second = governor.acquire(redis, governor.slots_for(CONFIG, 'b', 'ceph'), 60, 0, 'clone')
+    with pytest.raises(governor.GovernorTimeout):
+        governor.acquire(redis, governor.slots_for(CONFIG, 'c', 'ceph'), 60, 0, 'clone')
+
+    governor.release(redis, first)
+    governor.release(redis, second)
+    with governor.governed(redis, governor.slots_for(CONFIG, 'a', 'ceph'), 60, 0, 'clone'):
+        assert len(redis.zsets['governor|node|a']) == 1
+    assert not redis.zsets['governor|node|a']
+
+
+def test_governor_drops_expired_leases(monkeypatch):
+    redis = FakeRedis()
+    clock = iter([100.0, 100.0, 100.0, 200.0, 200.0, 200.0])
+    monkeypatch.setattr(governor.time, 'time', lambda: next(clock))
+    governor.acquire(redis, governor.slots_for(CONFIG, 'a', 'ceph'), 10, 0, 'clone')
+    # The first holder's lease ran out at 110, so its slot is reclaimed
+    governor.acquire(redis, governor.slots_for(CONFIG, 'a', 'ceph'), 10, 0, 'clone')
+    assert len(redis.zsets['governor|node|a']) == 1
@@ -0,0 +1,118 @@
+from proxstar import app
+from proxstar import hostnames
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+        self.results = []
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        self.results = []
+        return self
+
+    def execute(self):
+        return self.results
+
+    def _record(self, value):
+        self.results.append(value)
+        return value
+
+    def set(self, key, value, nx=False, ex=None):  # pylint: disable=unused-argument
+        if nx and key in self.store:
+            return self._record(None)
+        self.store[key] = value
+        return self._record(True)
+
+    def exists(self, key):
+        return self._record(int(key in self.store))
+
+    def delete(self, key):
+        return self._record(int(self.store.pop(key, None) is not None))
+
+    def sadd(self, key, *members):
+        self.store.setdefault(key, set()).update(members)
+        return self._record(len(members))
+
+    def sismember(self, key, member):
+        return self._record(member in self.store.get(key, set()))
+
+    def srem(self, key, *members):
+        self.store.setdefault(key, set()).difference_update(members)
+        return self._record(len(members))
+
+    def sunionstore(self, dest, keys):
+        union = set().union(*(self.store.get(key, set()) for key in keys))
+        self.store[dest] = union
+        return self._record(len(union))
+
+    def rename(self, src, dst):
+        self.store[dst] = self.store.pop(src)
+        return self._record(True)
+
+
+class FakeProxmox:
+    def __init__(self, names):
+        self.calls = 0
+        self.names = names
+        self.cluster = self
+        self.resources = self
+
+    def get(self, type=None):  # pylint: disable=redefined-builtin,unused-argument
+        self.calls += 1
+        return [{'name': name} for name in self.names]
+
+
+def test_hostname_lookups_use_index():
+    redis = FakeRedis()
+    proxmox = FakeProxmox(['alpha', 'beta'])
+    with app.app_context():
+        assert hostnames.is_hostname_taken(redis, 'alpha', proxmox) is True
+        assert hostnames.is_hostname_taken(redis, 'gamma', proxmox) is False
+    assert proxmox.calls == 1
+
+
+def test_reserve_hostname_blocks_concurrent_create():
+    redis = FakeRedis()
+    proxmox = FakeProxmox(['alpha'])
+    with app.app_context():
+        assert hostnames.reserve_hostname(redis, 'alpha', proxmox) is False
+        assert hostnames.reserve_hostname(redis, 'gamma', proxmox) is True
+        assert hostnames.reserve_hostname(redis, 'gamma', proxmox) is False
+        assert hostnames.is_hostname_taken(redis, 'gamma', proxmox) is True
+
+        hostnames.add_hostname(redis, 'gamma')
+        assert hostnames.get_reservation_key('gamma') not in redis.store
+        assert hostnames.is_hostname_taken(redis, 'gamma', proxmox) is True
+
+        assert hostnames.reserve_hostname(redis, 'delta', proxmox) is True
+        hostnames.release_hostname(redis, 'delta')
+        assert hostnames.is_hostname_taken(redis, 'delta', proxmox) is False
+
+
+def test_remove_hostname_frees_name():
+    redis = FakeRedis()
+    proxmox = FakeProxmox(['alpha'])
+    with app.app_context():
+        assert hostnames.is_hostname_taken(redis, 'alpha', proxmox) is True
+        hostnames.remove_hostname(redis, 'alpha')
+        assert hostnames.reserve_hostname(redis, 'alpha', proxmox) is True
+
+
+def test_rebuild_keeps_names_added_during_it():
+    redis = FakeRedis()
+
+    class AddingProxmox(FakeProxmox):
+        def get(self, type=None):  # pylint: disable=redefined-builtin
+            # Created after the snapshot was read
+            hostnames.add_hostname(redis, 'late')
+            return super().get(type)
+
+    with app.app_context():
+        hostnames.refresh_hostname_index(redis, AddingProxmox(['alpha']))
+        assert redis.store[hostnames.HOSTNAME_INDEX_KEY] == {'alpha', 'late'}
+        # Still merged in by the next rebuild, in case the snapshot lags
+        hostnames.refresh_hostname_index(redis, FakeProxmox(['alpha']))
+        assert 'late' in redis.store[hostnames.HOSTNAME_INDEX_KEY]
+        hostnames.refresh_hostname_index(redis, FakeProxmox(['alpha']))
+        assert redis.store[hostnames.HOSTNAME_INDEX_KEY] == {'alpha'}
@@ -0,0 +1,92 @@
+import pytest
+
+from proxstar import metrics
+
+
+class FakeRedis:
+    def __init__(self):
+        self.sets = {}
+        self.hashes = {}
+        self.results = []
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        self.results = []
+        return self
+
+    def execute(self):
+        return self.results
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member.encode('utf-8'))
+
+    def smembers(self, key):
+        return self.sets.get(key, set())
+
+    def hincrby(self, key, field, amount):
+        data = self.hashes.setdefault(key, {})
+        data[field] = data.get(field, 0) + amount
+
+    def hincrbyfloat(self, key, field, amount):
+        self.hincrby(key, field, amount)
+
+    def hgetall(self, key):
+        data = self.hashes.get(key, {})
+        self.results.append(
+            {field.encode('utf-8'): str(value).encode('utf-8') for field, value in data.items()}
+        )
+
+
+class FakeJob:
+    def __init__(self):
+        self.meta = {}
+
+    def save_meta(self):
+        return None
+
+
+def test_timed_stage_records_meta_and_histogram():
+    redis = FakeRedis()
+    job = FakeJob()
+    labels = {'task': 'setup_template', 'template': '100', 'node': ''}
+
+    with metrics.timed_stage(job, redis, 'placement', labels):
+        labels['node'] = 'node1'
+
+    timing = job.meta['timings']['placement']
+    assert timing['end'] >= timing['start']
+    output = metrics.render_metrics(redis)
+    assert (
+        'proxstar_provision_stage_seconds_bucket{node="node1",outcome="ok",stage="placement",'
+        'task="setup_template",template="100",le="0.5"} 1'
+    ) in output
+    assert 'le="+Inf"} 1' in output
+    assert 'proxstar_provision_stage_seconds_count{' in output
+
+
+def test_timed_stage_labels_failures():
+    redis = FakeRedis()
+    job = FakeJob()
+
+    with pytest.raises(RuntimeError):
+        with metrics.timed_stage(job, redis, 'clone', {'task': 'setup_template'}):
+            raise RuntimeError('clone failed')
+    # e.g. a wait that ran out of retries without raising
+    with metrics.timed_stage(job, redis, 'wait', {'task': 'create_vm'}) as timing:
+        timing['failed'] = True
+
+    assert job.meta['timings']['clone']['failed'] is True
+    output = metrics.render_metrics(redis)
+    assert 'outcome="failed",stage="clone",task="setup_template",le="+Inf"} 1' in output
+    assert 'outcome="failed",stage="wait",task="create_vm",le="+Inf"} 1' in output
+    assert 'outcome="ok"' not in output
+
+
+def test_timed_stage_backdates_start():
+    redis = FakeRedis()
+    job = FakeJob()
+
+    with metrics.timed_stage(job, redis, 'clone', {'task': 'setup_template'}, start=100.0):
+        pass
+
+    assert job.meta['timings']['clone']['start'] == 100.0
+    assert 'le="1800"} 0' in metrics.render_metrics(redis)
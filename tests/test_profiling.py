@@ -0,0 +1,178 @@
+import cProfile
+import threading
+
+from flask import Flask, render_template_string, session, stream_template_string
+from sqlalchemy import create_engine, text
+
+from proxstar import profiling
+
+
+class FakePipeline:
+    def __init__(self):
+        self.command_stack = []
+
+    def set(self, key, value):
+        self.command_stack.append(('SET', key, value))
+
+    def execute(self):
+        return [True] * len(self.command_stack)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def execute_command(self, *args, **options):  # pylint: disable=unused-argument
+        return None
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline()
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        self.store[key] = value.encode('utf-8')
+
+
+def _app(enabled, redis_conn, engine):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config.update(
+        PROFILING_ENABLED=enabled,
+        PROFILING_SLOW_SECONDS=0,
+        PROFILING_SLOW_SAMPLE_RATE=1,
+        PROFILING_TOKEN_TTL=60,
+    )
+    profiling.init_profiling(app, engine, redis_conn)
+
+    @app.route('/work')
+    def work():
+        redis_conn.execute_command('GET', 'key')
+        pipe = redis_conn.pipeline()
+        pipe.set('a', 1)
+        pipe.set('b', 2)
+        pipe.execute()
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+        return render_template_string('{{ value }}', value='done')
+
+    @app.route('/stream')
+    def stream():
+        def load():
+            redis_conn.execute_command('GET', 'streamed')
+            return 'done'
+
+        return app.response_class(stream_template_string('{{ load() }}', load=load))
+
+    @app.route('/login/<user>')
+    def login(user):
+        session['userinfo'] = {'preferred_username': user}
+        return ''
+
+    return app
+
+
+def test_server_timing_and_slow_log(caplog):
+    app = _app(True, FakeRedis(), create_engine('sqlite://'))
+    with caplog.at_level('WARNING'):
+        response = app.test_client().get('/work')
+    assert response.data == b'done'
+    timing = response.headers['Server-Timing']
+    assert 'sql;dur=' in timing and 'desc="1 calls"' in timing
+    assert 'redis;dur=' in timing and 'desc="2 calls"' in timing
+    assert 'template;dur=' in timing
+    assert 'total;dur=' in timing
+    assert 'Slow request GET /work' in caplog.text
+    assert 'pipeline of 2' in caplog.text
+    assert 'SELECT 1' in caplog.text
+
+
+def test_disabled_adds_nothing():
+    app = _app(False, FakeRedis(), create_engine('sqlite://'))
+    response = app.test_client().get('/work')
+    assert 'Server-Timing' not in response.headers
+
+
+def test_profile_token_runs_one_request_under_cprofile():
+    redis_conn = FakeRedis()
+    app = _app(False, redis_conn, create_engine('sqlite://'))
+    client = app.test_client()
+    client.get('/login/alice')
+    with app.app_context():
+        token = profiling.make_profile_token(app, 'alice')
+        other = profiling.make_profile_token(app, 'bob')
+    assert 'X-Proxstar-Profile' not in client.get(f'/work?profile={other}').headers
+    assert 'X-Proxstar-Profile' not in client.get('/work?profile=forged').headers
+    location = client.get(f'/work?profile={token}').headers['X-Proxstar-Profile']
+    profile_id = location.rsplit('/', 1)[-1]
+    assert 'function calls' in profiling.get_profile(redis_conn, profile_id)
+
+
+def _profile_client(app):
+    client = app.test_client()
+    client.get('/login/alice')
+    with app.app_context():
+        token = profiling.make_profile_token(app, 'alice')
+    return client, token
+
+
+def test_overlapping_profiles_skip_instead_of_failing():
+    app = _app(False, FakeRedis(), create_engine('sqlite://'))
+    entered, release = threading.Event(), threading.Event()
+
+    @app.route('/wait')
+    def wait():  # pylint: disable=unused-variable
+        entered.set()
+        release.wait(5)
+        return 'done'
+
+    first_client, token = _profile_client(app)
+    second_client, _ = _profile_client(app)
+    responses = {}
+    thread = threading.Thread(
+        target=lambda: responses.setdefault('first', first_client.get(f'/wait?profile={token}'))
+    )
+    thread.start()
+    assert entered.wait(5)
+    second = second_client.get(f'/work?profile={token}')
+    release.set()
+    thread.join(5)
+    assert second.status_code == 200
+    assert 'X-Proxstar-Profile' not in second.headers
+    assert second.headers['X-Proxstar-Profile-Skipped'] == 'another profile is being captured'
+    assert 'X-Proxstar-Profile' in responses['first'].headers
+    # The lock was released, so the next capture runs
+    assert 'X-Proxstar-Profile' in second_client.get(f'/work?profile={token}').headers
+
+
+def test_profile_skipped_while_another_profiler_runs():
+    app = _app(False, FakeRedis(), create_engine('sqlite://'))
+    client, token = _profile_client(app)
+    other = cProfile.Profile()
+    other.enable()
+    try:
+        response = client.get(f'/work?profile={token}')
+    finally:
+        other.disable()
+    assert response.status_code == 200
+    assert 'X-Proxstar-Profile-Skipped' in response.headers
+    assert 'X-Proxstar-Profile' in client.get(f'/work?profile={token}').headers
+
+
+def test_streamed_response_profiled_after_body(caplog):
+    redis_conn = FakeRedis()
+    app = _app(True, redis_conn, create_engine('sqlite://'))
+    client, token = _profile_client(app)
+    with caplog.at_level('WARNING'):
+        response = client.get(f'/stream?profile={token}')
+        assert 'Server-Timing' not in response.headers
+        profile_id = response.headers['X-Proxstar-Profile'].rsplit('/', 1)[-1]
+        assert response.get_data() == b'done'
+        assert 'GET /stream' not in caplog.text
+        assert profiling.get_profile(redis_conn, profile_id) is None
+        response.close()
+    # Both finish once the body, and the calls made rendering it, are done
+    assert 'Slow request GET /stream (streamed)' in caplog.text
+    assert 'redis: 1 calls' in caplog.text
+    assert 'function calls' in profiling.get_profile(redis_conn, profile_id)
@@ -0,0 +1,47 @@
+from rq.exceptions import NoSuchJobError
+
+from proxstar import queues
+
+
+class _FakeScheduler:
+    def __init__(self, job_ids):
+        self.job_ids = set(job_ids)
+        self.connection = object()
+        self.cancelled = []
+
+    def __contains__(self, job_id):
+        return job_id in self.job_ids
+
+    def cancel(self, job_id):
+        self.cancelled.append(job_id)
+        self.job_ids.discard(job_id)
+
+
+class _FakeJob:
+    def __init__(self, origin):
+        self.origin = origin
+
+
+def test_is_scheduled_on_keeps_jobs_on_the_right_queue(monkeypatch):
+    scheduler = _FakeScheduler(['sync'])
+    monkeypatch.setattr(
+        queues.Job, 'fetch', lambda *_args, **_kwargs: _FakeJob(queues.MAINTENANCE_QUEUE)
+    )
+
+    assert queues.is_scheduled_on(scheduler, 'sync', queues.MAINTENANCE_QUEUE)
+    assert not queues.is_scheduled_on(scheduler, 'missing', queues.MAINTENANCE_QUEUE)
+    assert scheduler.cancelled == []
+
+
+def test_is_scheduled_on_cancels_jobs_on_the_legacy_queue(monkeypatch):
+    scheduler = _FakeScheduler(['sync', 'gone'])
+    monkeypatch.setattr(queues.Job, 'fetch', lambda *_args, **_kwargs: _FakeJob('default'))
+
+    assert not queues.is_scheduled_on(scheduler, 'sync', queues.MAINTENANCE_QUEUE)
+
+    def fetch_missing(*_args, **_kwargs):
+        raise NoSuchJobError()
+
+    monkeypatch.setattr(queues.Job, 'fetch', fetch_missing)
+    assert not queues.is_scheduled_on(scheduler, 'gone', queues.MAINTENANCE_QUEUE)
+    assert scheduler.cancelled == ['sync', 'gone']
@@ -0,0 +1,112 @@
+import contextlib
+
+from proxstar import tasks
+
+
+class FakeJob:
+    def __init__(self):
+        self.meta = {}
+
+    def save_meta(self):
+        return None
+
+
+class FakeDB:
+    def close(self):
+        return None
+
+
+class FakePools:
+    def __init__(self, existing):
+        self.existing = existing
+        self.created = []
+
+    def get(self):
+        return [{'poolid': pool} for pool in self.existing]
+
+    def post(self, poolid, comment):  # pylint: disable=unused-argument
+        self.created.append(poolid)
+
+
+class FakeProxmox:
+    def __init__(self, pools):
+        self.pools = pools
+
+
+def test_place_roster_spreads_by_committed_memory():
+    nodes = [{'node': 'a', 'mem': 0}, {'node': 'b', 'mem': 768 * 1024 * 1024}]
+    assert tasks._place_roster(nodes, 3, 512) == ['a', 'a', 'b']
+
+
+def test_provision_roster_task(monkeypatch):
+    job = FakeJob()
+    pools = FakePools(['alice'])
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: job)
+    monkeypatch.setattr(tasks, 'connect_proxmox', lambda: FakeProxmox(pools))
+    monkeypatch.setattr(tasks, 'connect_db', FakeDB)
+    monkeypatch.setattr(tasks, 'get_vm_node', lambda *_args: 'tmpl-node')
+    monkeypatch.setattr(tasks, 'governed', lambda *_args: contextlib.nullcontext())
+    monkeypatch.setattr(
+        tasks,
+        'get_nodes_by_free_mem',
+        lambda *_args: [{'node': 'a', 'mem': 0}, {'node': 'b', 'mem': 1}],
+    )
+
+    sdn_calls = []
+
+    def fake_networks(_db, _config, users, _proxmox):
+        sdn_calls.append(list(users))
+        return {'alice': ('vnet-a', 'a'), 'bob': ('vnet-b', 'b')}, {'carol': 'no subnet'}
+
+    monkeypatch.setattr(tasks, 'ensure_student_networks', fake_networks)
+
+    vmids = {'lab-alice': 201, 'lab-bob': 202}
+
+    def fake_start_clone(_proxmox, _template, name, pool, **kwargs):
+        assert kwargs['template_node'] == 'tmpl-node'
+        return vmids[name], f'UPID:{kwargs["target"]}:{name}:{pool}'
+
+    monkeypatch.setattr(tasks, 'start_clone', fake_start_clone)
+
+    def fake_wait(_proxmox, upid, timeout):  # pylint: disable=unused-argument
+        if ':bob' in upid:
+            raise RuntimeError('clone failed')
+
+    monkeypatch.setattr(tasks, 'wait_for_task', fake_wait)
+
+    configured = []
+
+    class FakeVM:
+        def __init__(self, vmid, node=None):
+            self.vmid = vmid
+            self.node = node
+
+        def configure_clone(self, bridge, cores, memory, user, ssh_key=None):
+            configured.append((self.vmid, self.node, bridge, cores, memory, user, ssh_key))
+
+        def start(self):
+            return None
+
+    monkeypatch.setattr(tasks, 'VM', FakeVM)
+    deleted = []
+    monkeypatch.setattr(tasks, 'delete_vm_task', deleted.append)
+    renewed = []
+    monkeypatch.setattr(tasks, 'renew_vm_expires', lambda _db, ids, _months: renewed.append(ids))
+
+    entries = [
+        {'user': 'alice', 'name': 'lab-alice'},
+        {'user': 'bob', 'name': 'lab-bob'},
+        {'user': 'carol', 'name': 'lab-carol'},
+    ]
+    tasks.provision_roster_task(entries, '100', '2', '2048', 'ssh-ed25519 AAAA')
+
+    assert pools.created == ['bob', 'carol']
+    assert sdn_calls == [['alice', 'bob', 'carol']]
+    assert configured == [(201, 'a', 'vnet-a', '2', '2048', 'alice', 'ssh-ed25519 AAAA')]
+    assert deleted == [202]
+    assert renewed == [[201]]
+    roster = job.meta['roster']
+    assert roster['alice']['status'] == 'completed'
+    assert roster['bob']['status'] == 'failed to provision'
+    assert roster['carol']['status'] == 'failed: sdn'
+    assert job.meta['status'] == 'completed: 1 of 3 VMs provisioned'
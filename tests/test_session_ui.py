@@ -114,7 +114,7 @@ def test_expire_sessions_endpoint(monkeypatch):
 
     monkeypatch.setattr(app_mod, 'redis_conn', fake_redis)
     monkeypatch.setattr(app_mod, 'User', FakeUser)
-    monkeypatch.setattr(app_mod, 'q', fake_queue)
+    monkeypatch.setattr(app_mod, 'interactive_q', fake_queue)
     monkeypatch.setattr(app_mod.time, 'time', lambda: 1000.0)
     app_mod.app.config['SESSION_TIMEOUT_HOURS'] = 1
 
@@ -1,31 +1,99 @@
+from types import SimpleNamespace
+
 import proxstar as app_mod
+from proxstar import tasks
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store = {}
 
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        return True
 
-class _DummyQueue:
+    def delete(self, key):
+        return 1 if self.store.pop(key, None) is not None else 0
+
+
+class _DummyScheduler:
     def __init__(self):
+        self.connection = _FakeRedis()
         self.calls = []
 
-    def enqueue(self, func, job_timeout=None):
-        self.calls.append(func.__name__)
+    def enqueue_in(self, time_delta, func, job_id=None, queue_name=None, timeout=None):
+        self.calls.append((func.__name__, queue_name, job_id, time_delta.total_seconds()))
 
 
 def test_settings_refresh_enqueues_pool_cache(monkeypatch):
-    dummy = _DummyQueue()
-    monkeypatch.setattr(app_mod, 'q', dummy)
+    dummy = _DummyScheduler()
+    monkeypatch.setattr(app_mod, 'scheduler', dummy)
     app_mod.app.config['TEMPLATE_POOL'] = ''
 
     app_mod._enqueue_settings_refresh()
 
-    assert 'generate_pool_cache_task' in dummy.calls
-    assert 'sync_templates_task' not in dummy.calls
+    names = [call[0] for call in dummy.calls]
+    assert 'generate_pool_cache_task' in names
+    assert 'sync_templates_task' not in names
+    assert all(call[1] == app_mod.MAINTENANCE_QUEUE for call in dummy.calls)
 
 
 def test_settings_refresh_enqueues_template_sync_when_enabled(monkeypatch):
-    dummy = _DummyQueue()
-    monkeypatch.setattr(app_mod, 'q', dummy)
+    dummy = _DummyScheduler()
+    monkeypatch.setattr(app_mod, 'scheduler', dummy)
     app_mod.app.config['TEMPLATE_POOL'] = 'templates'
 
     app_mod._enqueue_settings_refresh()
 
-    assert 'generate_pool_cache_task' in dummy.calls
-    assert 'sync_templates_task' in dummy.calls
+    names = [call[0] for call in dummy.calls]
+    assert 'generate_pool_cache_task' in names
+    assert 'sync_templates_task' in names
+
+
+def test_settings_refresh_burst_collapses_into_one_job(monkeypatch):
+    dummy = _DummyScheduler()
+    monkeypatch.setattr(app_mod, 'scheduler', dummy)
+    app_mod.app.config['TEMPLATE_POOL'] = 'templates'
+    app_mod.app.config['SETTINGS_REFRESH_DEBOUNCE_SECONDS'] = 15
+
+    for _ in range(20):
+        app_mod._enqueue_settings_refresh()
+
+    assert sorted(call[0] for call in dummy.calls) == [
+        'generate_pool_cache_task',
+        'sync_templates_task',
+    ]
+    assert all(call[3] == 15 for call in dummy.calls)
+    assert all(call[2].startswith(f'debounced:{call[0]}:') for call in dummy.calls)
+
+
+def test_refresh_during_a_running_refresh_runs_again_after_it(monkeypatch):
+    redis = _FakeRedis()
+    job = SimpleNamespace(
+        id='periodic', timeout=120, origin=app_mod.MAINTENANCE_QUEUE, func_name='refresh'
+    )
+    requeued = []
+    queue = SimpleNamespace(enqueue=lambda *args, **kwargs: requeued.append(args))
+    monkeypatch.setattr(tasks, 'Redis', lambda *_args: redis)
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: job)
+    monkeypatch.setattr(tasks, 'get_queue', lambda _redis, name: queue)
+    runs = []
+
+    @tasks.skip_if_running
+    def refresh(edit=False):
+        runs.append(edit)
+        if not edit:
+            # A settings edit's debounced run fires while this one is going
+            assert refresh(edit=True) is None
+
+    refresh()
+    assert runs == [False]
+    assert requeued == [('refresh',)]
+    assert not redis.store
+
+    # Without an overlapping run nothing is queued again
+    requeued.clear()
+    tasks.skip_if_running(lambda: None)()
+    assert not requeued
@@ -0,0 +1,59 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from proxstar.db import (
+    add_shared_pool,
+    delete_shared_pool,
+    get_shared_pool,
+    get_shared_pool_members,
+    get_shared_pools,
+    is_shared_pool_member,
+    set_shared_pool_members,
+)
+from proxstar.models import Shared_Pool_Member, Shared_Pools
+
+
+def _make_session():
+    engine = create_engine('sqlite://')
+    Shared_Pools.__table__.create(engine)
+    Shared_Pool_Member.__table__.create(engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_shared_pool_membership_lookups():
+    session = _make_session()
+    add_shared_pool(session, 'lab1', ['alice', ' bob', '', 'alice'])
+    add_shared_pool(session, 'lab2', ['bob'])
+
+    assert add_shared_pool(session, 'lab1', []) == 'Name Already in Use'
+    assert get_shared_pool_members(session, 'lab1') == ['alice', 'bob']
+    assert get_shared_pool(session, 'lab1').members == ['alice', 'bob']
+    assert sorted(pool.name for pool in get_shared_pools(session, 'bob', False)) == [
+        'lab1',
+        'lab2',
+    ]
+    assert [pool.name for pool in get_shared_pools(session, 'alice', False)] == ['lab1']
+    assert is_shared_pool_member(session, 'lab2', 'bob')
+    assert not is_shared_pool_member(session, 'lab2', 'alice')
+
+
+def test_set_shared_pool_members_replaces_set():
+    session = _make_session()
+    add_shared_pool(session, 'lab1', ['alice', 'bob'])
+
+    set_shared_pool_members(session, 'lab1', ['bob', 'carol'])
+    assert get_shared_pool_members(session, 'lab1') == ['bob', 'carol']
+    assert get_shared_pool(session, 'lab1').members == ['bob', 'carol']
+
+    set_shared_pool_members(session, 'lab1', [''])
+    assert get_shared_pool_members(session, 'lab1') == []
+
+
+def test_delete_shared_pool_removes_members():
+    session = _make_session()
+    add_shared_pool(session, 'lab1', ['alice'])
+
+    assert delete_shared_pool(session, 'lab1') is True
+    assert delete_shared_pool(session, 'lab1') is False
+    assert get_shared_pool(session, 'lab1') is None
+    assert session.query(Shared_Pool_Member).count() == 0
@@ -0,0 +1,106 @@
+import pytest
+from flask import Flask
+
+from proxstar import schedules, util
+from proxstar.auth import DeferredAuth
+
+
+class FakeScheduler:
+    def __init__(self, existing=()):
+        self.jobs = set(existing)
+        self.scheduled = {}
+        self.cancelled = []
+
+    def __contains__(self, job_id):
+        return job_id in self.jobs
+
+    def schedule(self, **kwargs):
+        self.scheduled[kwargs['id']] = kwargs
+
+    def cron(self, _cron_string, **kwargs):
+        self.scheduled[kwargs['id']] = kwargs
+
+    def cancel(self, job_id):
+        self.cancelled.append(job_id)
+
+
+class FakeOIDC:
+    def __init__(self):
+        self.calls = []
+
+    def init_app(self, app):
+        self.calls.append(('init_app', app))
+
+    def oidc_auth(self, provider_name):
+        def decorator(fn):
+            self.calls.append(('oidc_auth', provider_name))
+            return fn
+
+        return decorator
+
+    def oidc_logout(self, fn):
+        self.calls.append(('oidc_logout', fn.__name__))
+        return fn
+
+
+def test_read_git_revision_prefers_revision_file(tmp_path):
+    (tmp_path / '.git' / 'refs' / 'heads').mkdir(parents=True)
+    (tmp_path / '.git' / 'HEAD').write_text('ref: refs/heads/main\n')
+    (tmp_path / '.git' / 'refs' / 'heads' / 'main').write_text('0123456789abcdef\n')
+    assert util.read_git_revision(str(tmp_path)) == '0123456'
+    (tmp_path / 'REVISION').write_text('fedcba9\n')
+    assert util.read_git_revision(str(tmp_path)) == 'fedcba9'
+
+
+def test_read_git_revision_packed_refs_and_missing(tmp_path):
+    assert util.read_git_revision(str(tmp_path)) == 'unknown'
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.git' / 'HEAD').write_text('ref: refs/heads/main\n')
+    (tmp_path / '.git' / 'packed-refs').write_text('# pack-refs\nabcdef0123 refs/heads/main\n')
+    assert util.read_git_revision(str(tmp_path)) == 'abcdef0'
+
+
+def test_register_schedules(monkeypatch):
+    monkeypatch.setattr(schedules, 'is_scheduled_on', lambda s, job_id, _q: job_id in s)
+    scheduler = FakeScheduler(existing=['cleanup_vnc', 'generate_pool_cache'])
+    config = {
+        'ENABLE_VM_EXPIRATION': False,
+        'TEMPLATE_POOL': 'templates',
+        'VNC_TOKEN_SWEEP_INTERVAL': 300,
+        'SESSION_CHECK_INTERVAL_SECONDS': 60,
+    }
+    schedules.register_schedules(scheduler, config)
+    assert scheduler.cancelled == ['cleanup_vnc']
+    assert set(scheduler.scheduled) == {
+        'sweep_vnc_tokens',
+        'sync_templates',
+        'enforce_session_timeouts',
+    }
+    assert scheduler.scheduled['enforce_session_timeouts']['interval'] == 60
+
+
+def test_deferred_auth_wraps_views_once_set_up(monkeypatch):
+    oidc = FakeOIDC()
+    monkeypatch.setattr('proxstar.oidc.get_auth', lambda _config: oidc)
+    auth = DeferredAuth({})
+
+    @auth.oidc_auth('default')
+    def view():
+        return 'ok'
+
+    @auth.oidc_logout
+    def logout():
+        return 'bye'
+
+    with pytest.raises(RuntimeError):
+        view()
+    app = Flask(__name__)
+    auth.init_app(app)
+    assert view() == 'ok'
+    assert view() == 'ok'
+    assert logout() == 'bye'
+    assert oidc.calls == [
+        ('init_app', app),
+        ('oidc_logout', 'logout'),
+        ('oidc_auth', 'default'),
+    ]
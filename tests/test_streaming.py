@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+import proxstar as app_mod
+
+
+class FakeUser:
+    loaded = []
+
+    def __init__(self, name):
+        self.name = name
+        self.rtp = False
+        self.active = True
+
+    @property
+    def vms(self):
+        FakeUser.loaded.append(self.name)
+        if self.name == 'broken':
+            raise ConnectionError('proxmox is down')
+        return [{'name': 'web', 'vmid': 100, 'status': 'running'}]
+
+    @property
+    def pending_vms(self):
+        return []
+
+
+def _render(view, path, username='alice'):
+    with app_mod.app.test_request_context(path):
+        app_mod.flask_session['userinfo'] = {'preferred_username': username}
+        response = view()
+        assert response.is_streamed
+        chunks = iter(response.response)
+        first = next(chunks)
+        loaded_early = list(FakeUser.loaded)
+        return first, loaded_early, first + ''.join(chunks)
+
+
+def test_list_vms_sends_layout_before_loading_vms(monkeypatch):
+    FakeUser.loaded = []
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    first, loaded_early, html = _render(app_mod.list_vms, '/')
+    assert '<!doctype html>' in first
+    assert not loaded_early
+    assert FakeUser.loaded == ['alice']
+    assert 'data-vm-name="web"' in html
+    assert html.rstrip().endswith('</html>')
+
+
+def test_list_vms_reports_errors_in_page(monkeypatch):
+    FakeUser.loaded = []
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    _, _, html = _render(app_mod.list_vms, '/', username='broken')
+    assert "couldn't be loaded from Proxmox" in html
+    assert html.rstrip().endswith('</html>')
+
+
+def test_list_pools_streams_shared_pools(monkeypatch):
+    class FakePools:
+        def __init__(self, name):
+            self.name = name
+
+        def get(self):
+            if self.name == 'broken':
+                raise ConnectionError('proxmox is down')
+            return {'members': []}
+
+    pools = [
+        SimpleNamespace(name='empty', members=['alice']),
+        SimpleNamespace(name='broken', members=['alice']),
+    ]
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    monkeypatch.setattr(app_mod, 'get_shared_pools', lambda _db, _user, _all: pools)
+    monkeypatch.setattr(app_mod, 'connect_proxmox', lambda: SimpleNamespace(pools=FakePools))
+    _, _, html = _render(app_mod.list_pools, '/pools')
+    assert '/pool/shared/empty' in html and '/pool/shared/broken' in html
+    # The delete button is only offered for pools known to be empty
+    assert 'data-pool="empty">DELETE' in html
+    assert 'data-pool="broken">DELETE' not in html
+
+
+def test_list_pools_reports_errors_in_page(monkeypatch):
+    class FakeRTP(FakeUser):
+        def __init__(self, name):
+            super().__init__(name)
+            self.rtp = True
+
+    def fail(*_args):
+        raise ConnectionError('database is down')
+
+    monkeypatch.setattr(app_mod, 'User', FakeRTP)
+    monkeypatch.setattr(app_mod, 'get_pool_cache', fail)
+    monkeypatch.setattr(app_mod, 'get_shared_pools', fail)
+    _, _, html = _render(app_mod.list_pools, '/pools')
+    assert "User pools couldn't be loaded" in html
+    assert "Shared pools couldn't be loaded" in html
+    assert html.rstrip().endswith('</html>')
@@ -58,6 +58,7 @@ def test_template_ssh_key_optional(monkeypatch):
     monkeypatch.setattr(tasks, 'get_current_job', lambda: _DummyJob())
     monkeypatch.setattr(tasks, 'connect_db', lambda: _DummyDB())
     monkeypatch.setattr(tasks, 'VM', _DummyVM)
+    monkeypatch.setattr(tasks, 'acquire', lambda *_args, **_kwargs: None)
 
     tasks.setup_template_task(
         template_id=1,
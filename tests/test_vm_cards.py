@@ -0,0 +1,41 @@
+import proxstar as app_mod
+
+
+class FakeUser:
+    def __init__(self, name):
+        self.name = name
+        self.rtp = False
+        self.active = True
+        self.vms = [
+            {'name': 'web', 'vmid': 100, 'status': 'running'},
+            {'name': 'db', 'vmid': 101, 'status': 'stopped'},
+        ]
+        self.pending_vms = [{'name': 'new', 'status': 'cloning template', 'pending': True}]
+
+
+def test_vm_cards_renders_only_requested_cards(monkeypatch):
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    monkeypatch.setattr(app_mod, '_version_tag', lambda _keys: 'tag-1')
+    with app_mod.app.test_request_context('/api/vm-cards?name=new&name=db'):
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        cards = app_mod.vm_cards_api().get_json()['cards']
+    assert set(cards) == {'new', 'db'}
+    assert 'data-pending="true"' in cards['new'] and 'href' not in cards['new']
+    assert 'href="/vm/101"' in cards['db'] and 'class="vm-status-text">stopped' in cards['db']
+
+
+def test_vm_cards_matches_list_page_markup(monkeypatch):
+    monkeypatch.setattr(app_mod, 'User', FakeUser)
+    monkeypatch.setattr(app_mod, '_version_tag', lambda _keys: None)
+    with app_mod.app.test_request_context('/api/vm-cards?name=web'):
+        app_mod.flask_session['userinfo'] = {'preferred_username': 'alice'}
+        card = app_mod.vm_cards_api().get_json()['cards']['web']
+        page = app_mod.render_template(
+            'list_vms.html',
+            user=FakeUser('alice'),
+            external_view=None,
+            vms=FakeUser('alice').vms,
+            view_user=None,
+        )
+    assert card.strip() in page
+    assert 'data-live="true"' in page
@@ -76,6 +76,9 @@ def test_delete_vm_task_stops_then_deletes(monkeypatch):
     state = {'status': 'running', 'stop_called': 0, 'delete_called': 0}
 
     class FakeVM:
+        node = 'node1'
+        name = 'vm55'
+
         def __init__(self, vmid):
             self.vmid = vmid
 
@@ -94,11 +97,15 @@ def test_delete_vm_task_stops_then_deletes(monkeypatch):
     monkeypatch.setattr(tasks, 'connect_db', _fake_connect_db)
     monkeypatch.setattr(tasks.time, 'sleep', lambda *_args, **_kwargs: None)
     monkeypatch.setattr(tasks, 'delete_vm_expire', lambda _db, vmid: state.setdefault('expire', vmid))
+    monkeypatch.setattr(
+        tasks, 'remove_hostname', lambda _redis, name: state.setdefault('name', name)
+    )
 
     tasks.delete_vm_task(55)
     assert state['stop_called'] == 1
     assert state['delete_called'] == 1
     assert state['expire'] == 55
+    assert state['name'] == 'vm55'
 
 
 def test_setup_template_task_clones_and_applies_cloud_init(monkeypatch):
@@ -111,6 +118,7 @@ def test_setup_template_task_clones_and_applies_cloud_init(monkeypatch):
     monkeypatch.setattr(tasks, 'get_template', lambda *_args, **_kwargs: None)
     monkeypatch.setattr(tasks, 'get_vm_expire', lambda *_args, **_kwargs: None)
     monkeypatch.setattr(tasks.time, 'sleep', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'acquire', lambda *_args, **_kwargs: None)
     tasks.app.config['TEMPLATE_CLONE_FULL'] = False
 
     clone_args = {}
@@ -163,6 +171,136 @@ def test_setup_template_task_clones_and_applies_cloud_init(monkeypatch):
     assert ('start',) in FakeVM.last_instance.calls
 
 
+def test_setup_template_task_resumes_after_clone(monkeypatch):
+    job = FakeJob()
+    job.meta['checkpoint'] = {'step': 'cloned', 'vnet': 'vnet1', 'node': 'node1', 'vmid': 303}
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: job)
+    monkeypatch.setattr(tasks, 'connect_proxmox', lambda: object())
+    monkeypatch.setattr(tasks, 'connect_db', _fake_connect_db)
+    monkeypatch.setattr(tasks, 'get_vm_expire', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'acquire', lambda *_args, **_kwargs: None)
+
+    def fail(*_args, **_kwargs):
+        raise AssertionError('completed step was re-run')
+
+    monkeypatch.setattr(tasks, 'ensure_student_network', fail)
+    monkeypatch.setattr(tasks, 'clone_vm', fail)
+    monkeypatch.setattr(tasks, 'delete_vm_task', fail)
+
+    class FakeVM:
+        started = []
+        fail_start = True
+
+        def __init__(self, vmid):
+            self.vmid = vmid
+
+        def is_provisioned(self):
+            return True
+
+        def __getattr__(self, _name):
+            return lambda *_args, **_kwargs: None
+
+        def start(self):
+            if FakeVM.fail_start:
+                raise RuntimeError('start failed')
+            FakeVM.started.append(self.vmid)
+
+    monkeypatch.setattr(tasks, 'VM', FakeVM)
+
+    # With retries left the clone is kept for the retry to resume
+    job.retries_left = 1
+    with pytest.raises(RuntimeError):
+        tasks.setup_template_task(7, 'vm1', 'alice', '', '2', '1024')
+    assert job.meta['checkpoint']['step'] == 'configured'
+
+    FakeVM.fail_start = False
+    tasks.setup_template_task(7, 'vm1', 'alice', '', '2', '1024')
+    assert FakeVM.started == [303]
+    assert job.meta['checkpoint']['step'] == 'started'
+    assert job.meta['status'] == 'completed'
+
+
+def test_setup_template_task_frees_clone_slot_once_provisioned(monkeypatch):
+    job = FakeJob()
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: job)
+    monkeypatch.setattr(tasks, 'connect_proxmox', lambda: object())
+    monkeypatch.setattr(tasks, 'connect_db', _fake_connect_db)
+    monkeypatch.setattr(tasks, 'get_node_least_mem', lambda *_args, **_kwargs: 'node1')
+    monkeypatch.setattr(tasks, 'ensure_student_network', lambda *_args, **_kwargs: ('vnet1', 'snet'))
+    monkeypatch.setattr(tasks, 'get_template', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'get_vm_expire', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'clone_vm', lambda *_args, **_kwargs: 202)
+    monkeypatch.setattr(tasks, 'acquire', lambda *_args, **_kwargs: 'slot')
+    released = []
+    monkeypatch.setattr(tasks, 'release', lambda _redis, slot: released.append(slot))
+
+    class FakeVM:
+        configured_with_slot = []
+
+        def __init__(self, vmid):
+            self.vmid = vmid
+
+        def is_provisioned(self):
+            return not released
+
+        def set_net_bridge(self, *_args):
+            FakeVM.configured_with_slot.append(not released)
+
+        def __getattr__(self, _name):
+            return lambda *_args, **_kwargs: None
+
+    monkeypatch.setattr(tasks, 'VM', FakeVM)
+
+    tasks.setup_template_task(7, 'vm1', 'alice', '', '2', '1024')
+    assert released == ['slot']
+    assert FakeVM.configured_with_slot == [False]
+    assert job.meta['status'] == 'completed'
+    # The clone stage runs from the clone request until the disk is copied
+    timings = job.meta['timings']
+    assert timings['clone']['start'] == job.meta['checkpoint']['clone_started']
+    assert 'wait' not in timings
+
+
+def test_setup_template_task_adopts_clone_started_before_a_crash(monkeypatch):
+    job = FakeJob()
+    job.meta['checkpoint'] = {
+        'step': 'network ready',
+        'vnet': 'vnet1',
+        'node': 'node1',
+        'clone_started': True,
+    }
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: job)
+    monkeypatch.setattr(tasks, 'connect_proxmox', lambda: object())
+    monkeypatch.setattr(tasks, 'connect_db', _fake_connect_db)
+    monkeypatch.setattr(tasks, 'get_template', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'get_vm_expire', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'acquire', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(
+        tasks, 'get_vmid_by_name', lambda _proxmox, name, pool: 404 if name == 'vm1' else None
+    )
+
+    def fail(*_args, **_kwargs):
+        raise AssertionError('template was cloned again')
+
+    monkeypatch.setattr(tasks, 'clone_vm', fail)
+
+    class FakeVM:
+        def __init__(self, vmid):
+            self.vmid = vmid
+
+        def is_provisioned(self):
+            return True
+
+        def __getattr__(self, _name):
+            return lambda *_args, **_kwargs: None
+
+    monkeypatch.setattr(tasks, 'VM', FakeVM)
+
+    tasks.setup_template_task(7, 'vm1', 'alice', '', '2', '1024')
+    assert job.meta['checkpoint']['vmid'] == 404
+    assert job.meta['checkpoint']['step'] == 'started'
+
+
 def test_process_expiring_vms_task_deletes_and_stops(monkeypatch):
     tasks.app.config['ENABLE_VM_EXPIRATION'] = True
 
@@ -190,6 +328,13 @@ def test_process_expiring_vms_task_deletes_and_stops(monkeypatch):
         2: {'expire': base_date - datetime.timedelta(days=1), 'stopped': 0},
         3: {'expire': base_date + datetime.timedelta(days=5), 'stopped': 0},
     }
+    expire_calls = []
+
+    def fake_get_vm_expires(_db, vmids, _months):
+        expire_calls.append(list(vmids))
+        return {vmid: vm_state[vmid]['expire'] for vmid in vmids}
+
+    monkeypatch.setattr(tasks, 'get_vm_expires', fake_get_vm_expires)
 
     class FakeVM:
         def __init__(self, vmid):
@@ -197,10 +342,6 @@ def test_process_expiring_vms_task_deletes_and_stops(monkeypatch):
             self.name = f'vm{vmid}'
             self._data = vm_state[vmid]
 
-        @property
-        def expire(self):
-            return self._data['expire']
-
         def stop(self):
             self._data['stopped'] += 1
 
@@ -220,15 +361,19 @@ def test_process_expiring_vms_task_deletes_and_stops(monkeypatch):
         def get(self, _key):
             return b'token'
 
+        def set(self, _key, _value, **_kwargs):
+            return True
+
         def delete(self, _key):
             return None
 
     monkeypatch.setattr(tasks, 'Redis', FakeRedis)
-    monkeypatch.setattr(tasks, 'delete_vnc_target', lambda *_args, **_kwargs: None)
+    monkeypatch.setattr(tasks, 'revoke_vm_console', lambda *_args, **_kwargs: None)
 
     tasks.process_expiring_vms_task()
 
     assert deleted == [1]
+    assert expire_calls == [[1, 2, 3]]
     assert vm_state[2]['stopped'] == 1
     assert vm_state[3]['stopped'] == 0
 
@@ -246,8 +391,9 @@ def test_enforce_session_timeouts_sets_start(monkeypatch):
         def get(self, key):
             return self.store.get(key)
 
-        def set(self, key, value):
+        def set(self, key, value, **_kwargs):
             self.store[key] = str(value).encode('utf-8')
+            return True
 
         def delete(self, key):
             self.store.pop(key, None)
@@ -294,8 +440,9 @@ def test_enforce_session_timeouts_shutdown_then_stop(monkeypatch):
         def get(self, key):
             return self.store.get(key)
 
-        def set(self, key, value):
+        def set(self, key, value, **_kwargs):
             self.store[key] = str(value).encode('utf-8')
+            return True
 
         def delete(self, key):
             self.store.pop(key, None)
@@ -332,3 +479,37 @@ def test_enforce_session_timeouts_shutdown_then_stop(monkeypatch):
     tasks.enforce_session_timeouts_task()
     assert vm_state['shutdown'] == 0
     assert vm_state['stop'] == 1
+
+
+def test_scheduled_task_skips_while_previous_run_active(monkeypatch):
+    class FakeRedis:
+        def __init__(self, *_args, **_kwargs):
+            self.store = {'task_running|generate_pool_cache_task': b'other-job'}
+
+        def set(self, key, value, nx=False, ex=None):
+            if nx and key in self.store:
+                return None
+            self.store[key] = value
+            return True
+
+        def delete(self, key):
+            self.store.pop(key, None)
+
+    fake_redis = FakeRedis()
+    monkeypatch.setattr(tasks, 'Redis', lambda *_args, **_kwargs: fake_redis)
+    monkeypatch.setattr(tasks, 'get_current_job', lambda: None)
+    tasks.app.config['PROXMOX_HOSTS'] = ['node1']
+    stored = []
+    monkeypatch.setattr(tasks, 'connect_proxmox', lambda: object())
+    monkeypatch.setattr(tasks, 'connect_db', _fake_connect_db)
+    monkeypatch.setattr(tasks, 'get_vms_for_rtp', lambda *_args: ['pool'])
+    monkeypatch.setattr(tasks, 'store_pool_cache', lambda _db, pools: stored.append(pools))
+
+    tasks.generate_pool_cache_task()
+    assert stored == []
+    assert fake_redis.store['task_running|generate_pool_cache_task'] == b'other-job'
+
+    del fake_redis.store['task_running|generate_pool_cache_task']
+    tasks.generate_pool_cache_task()
+    assert stored == [['pool']]
+    assert 'task_running|generate_pool_cache_task' not in fake_redis.store
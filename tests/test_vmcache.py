@@ -0,0 +1,64 @@
+from proxstar import app
+from proxstar import user as user_mod
+from proxstar.events import publish
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        self.store[key] = value
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def publish(self, channel, message):
+        return None
+
+    def incr(self, key):
+        return None
+
+    def execute(self):
+        return []
+
+
+class FakePool:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get(self):
+        self.calls.append('get')
+        return {'members': [{'vmid': 101, 'name': 'web'}, {'vmid': 100, 'name': 'db'}]}
+
+
+class FakeProxmox:
+    def __init__(self):
+        self.calls = []
+
+    def pools(self, _pool_id):
+        return FakePool(self.calls)
+
+
+def test_vms_are_cached_until_an_event(monkeypatch):
+    fake_redis = FakeRedis()
+    proxmox = FakeProxmox()
+    monkeypatch.setattr(user_mod, 'redis_conn', fake_redis)
+    monkeypatch.setattr(user_mod, 'connect_proxmox', lambda: proxmox)
+
+    with app.app_context():
+        first = user_mod.User('alice').vms
+        second = user_mod.User('alice').vms
+        assert first == second == [{'vmid': 100, 'name': 'db'}, {'vmid': 101, 'name': 'web'}]
+        assert proxmox.calls == ['get']
+
+        publish(fake_redis, ['alice'], 'vm', {'vmid': 100})
+        third = user_mod.User('alice').vms
+    assert third == first
+    assert proxmox.calls == ['get', 'get']
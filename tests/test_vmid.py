@@ -0,0 +1,38 @@
+import pytest
+
+from proxstar import vmid as vmid_mod
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def set(self, key, value, nx=False, ex=None):  # pylint: disable=unused-argument
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        return True
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+def test_reserve_vmid_skips_used_and_reserved():
+    redis = FakeRedis()
+    used = {100, 101}
+    assert vmid_mod.reserve_vmid(redis, used, 100, 110, 60) == 102
+    # A concurrent job with the same cluster snapshot gets the next ID
+    assert vmid_mod.reserve_vmid(redis, used, 100, 110, 60) == 103
+
+
+def test_release_vmid_makes_id_available_again():
+    redis = FakeRedis()
+    vmid = vmid_mod.reserve_vmid(redis, set(), 200, 201, 60)
+    vmid_mod.release_vmid(redis, vmid)
+    assert vmid_mod.reserve_vmid(redis, set(), 200, 201, 60) == vmid
+
+
+def test_reserve_vmid_raises_when_range_exhausted():
+    redis = FakeRedis()
+    with pytest.raises(RuntimeError):
+        vmid_mod.reserve_vmid(redis, {300, 301}, 300, 301, 60)
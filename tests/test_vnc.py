@@ -0,0 +1,102 @@
+from proxstar import vnc
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+        self.ttls = {}
+        self.zsets = {}
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def execute(self):
+        return []
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        self.store[key] = value.encode('utf-8')
+        self.ttls[key] = ex
+
+    def exists(self, key):
+        return int(key in self.store)
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += int(self.store.pop(key, None) is not None)
+            removed += int(self.zsets.pop(key, None) is not None)
+        return removed
+
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.zsets.get(key, {}).pop(member, None)
+
+    def zrange(self, key, _start, _end):
+        return [member.encode('utf-8') for member in self.zsets.get(key, {})]
+
+    def zrangebyscore(self, key, _low, high):
+        zset = self.zsets.get(key, {})
+        return [member.encode('utf-8') for member, score in zset.items() if score <= high]
+
+
+def test_add_vnc_target_stores_token_with_ttl():
+    redis = FakeRedis()
+    token = vnc.add_vnc_target(redis, 100, 'alice', 'node1.example.com', '5900', 60)
+    assert vnc.get_vnc_target(redis, token) == {
+        'host': 'node1.example.com',
+        'port': 5900,
+        'user': 'alice',
+        'vmid': 100,
+    }
+    assert list(redis.zsets['vnc_tokens|100']) == [token]
+    assert redis.ttls[f'vnc_target:{token}'] == 60
+
+
+def test_revoke_vm_console_deletes_every_token():
+    redis = FakeRedis()
+    first = vnc.add_vnc_target(redis, 100, 'alice', 'node1', 5900, 60)
+    second = vnc.add_vnc_target(redis, 100, 'bob', 'node1', 5901, 60)
+    other = vnc.add_vnc_target(redis, 101, 'alice', 'node1', 5902, 60)
+    assert vnc.revoke_vm_console(redis, 100) is True
+    assert vnc.get_vnc_target(redis, first) is None
+    assert vnc.get_vnc_target(redis, second) is None
+    assert vnc.get_vnc_target(redis, other) is not None
+    assert list(redis.zsets['vnc_token_expiry']) == [f'101|{other}']
+    assert vnc.revoke_vm_console(redis, 100) is False
+    assert vnc.delete_vnc_target(redis, first) is False
+
+
+def test_console_session_reused_until_released_or_revoked():
+    redis = FakeRedis()
+    token = vnc.add_vnc_target(redis, 100, 'alice', 'node1', 5900, 60)
+    session = {'host': 'proxy', 'port': '443', 'token': token, 'password': 'ticket'}
+    vnc.cache_console_session(redis, 100, 'alice', session, 10)
+    assert vnc.get_console_session(redis, 100, 'alice') == session
+    assert vnc.get_console_session(redis, 100, 'bob') is None
+
+    vnc.release_console_session(redis, 100, 'alice')
+    assert vnc.get_console_session(redis, 100, 'alice') is None
+
+    vnc.cache_console_session(redis, 100, 'alice', session, 10)
+    vnc.revoke_vm_console(redis, 100)
+    assert vnc.get_console_session(redis, 100, 'alice') is None
+
+
+def test_sweep_vnc_tokens_only_drops_expired_entries():
+    redis = FakeRedis()
+    expired = vnc.add_vnc_target(redis, 100, 'alice', 'node1', 5900, 60)
+    live = vnc.add_vnc_target(redis, 100, 'alice', 'node1', 5901, 600)
+    now = redis.zsets['vnc_token_expiry'][f'100|{expired}'] + 1
+    assert vnc.sweep_vnc_tokens(redis, now) == 1
+    assert list(redis.zsets['vnc_tokens|100']) == [live]
+    assert list(redis.zsets['vnc_token_expiry']) == [f'100|{live}']
+    assert vnc.sweep_vnc_tokens(redis, now) == 0
@@ -0,0 +1,106 @@
+import asyncio
+import base64
+import os
+import struct
+
+from proxstar import vncproxy
+
+
+class FakeRedis:
+    def __init__(self, targets):
+        self.targets = targets
+
+
+def make_proxy(monkeypatch, targets, user_limit=2):
+    observed = []
+    monkeypatch.setattr(vncproxy, 'get_vnc_target', lambda redis, token: redis.targets.get(token))
+    monkeypatch.setattr(vncproxy, 'release_console_session', lambda *_args: None)
+    monkeypatch.setattr(
+        vncproxy,
+        'observe_quietly',
+        lambda _redis, metric, seconds, labels: observed.append((metric, labels)),
+    )
+    return vncproxy.VNCProxy(FakeRedis(targets), user_limit), observed
+
+
+def masked_frame(opcode, payload):
+    mask = os.urandom(4)
+    return (
+        struct.pack('!BB', 0x80 | opcode, 0x80 | len(payload))
+        + mask
+        + vncproxy.unmask(payload, mask)
+    )
+
+
+async def open_console(port, token):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    key = base64.b64encode(os.urandom(16)).decode('ascii')
+    writer.write(
+        (
+            f'GET /path?token={token} HTTP/1.1\r\nHost: localhost\r\n'
+            'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Protocol: binary\r\n\r\n'
+        ).encode('ascii')
+    )
+    status = (await reader.readuntil(b'\r\n\r\n')).split(b'\r\n')[0]
+    return reader, writer, status, key
+
+
+def test_accept_key_matches_rfc_example():
+    assert vncproxy.accept_key('dGhlIHNhbXBsZSBub25jZQ==') == 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+def test_unmask_round_trips():
+    payload = os.urandom(1001)
+    mask = os.urandom(4)
+    masked = vncproxy.unmask(payload, mask)
+    assert masked != payload
+    assert vncproxy.unmask(masked, mask) == payload
+
+
+def test_proxies_console_and_enforces_user_limit(monkeypatch):
+    async def scenario():
+        received = asyncio.Queue()
+
+        async def vnc_server(reader, writer):
+            writer.write(b'RFB 003.008\n')
+            await writer.drain()
+            await received.put(await reader.readexactly(12))
+            writer.close()
+
+        upstream = await asyncio.start_server(vnc_server, '127.0.0.1', 0)
+        upstream_port = upstream.sockets[0].getsockname()[1]
+        target = {'host': '127.0.0.1', 'port': upstream_port, 'user': 'alice', 'vmid': 100}
+        proxy, observed = make_proxy(monkeypatch, {'good': target}, user_limit=1)
+        server = await asyncio.start_server(proxy.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        _, _, status, _ = await open_console(port, 'bad')
+        assert status == b'HTTP/1.1 403 Forbidden'
+
+        reader, writer, status, _ = await open_console(port, 'good')
+        assert status == b'HTTP/1.1 101 Switching Protocols'
+        assert await reader.readexactly(2) == bytes([0x82, 12])
+        assert await reader.readexactly(12) == b'RFB 003.008\n'
+
+        _, _, status, _ = await open_console(port, 'good')
+        assert status == b'HTTP/1.1 429 Too Many Requests'
+
+        writer.write(masked_frame(vncproxy.OP_BINARY, b'RFB 003.008\n'))
+        assert await received.get() == b'RFB 003.008\n'
+        # The VNC server hung up, so the proxy closes the websocket
+        assert (await reader.readexactly(4))[0] == 0x88
+        writer.close()
+        while proxy.connections:
+            await asyncio.sleep(0.01)
+
+        server.close()
+        upstream.close()
+        return proxy, observed
+
+    proxy, observed = asyncio.run(scenario())
+    assert not proxy.connections
+    metrics = [metric for metric, _ in observed]
+    assert metrics[0] == vncproxy.CONSOLE_CONNECT_METRIC
+    assert vncproxy.CONSOLE_SESSION_METRIC in metrics
+    assert {'node': '127.0.0.1', 'direction': 'to_vm'} in [labels for _, labels in observed]
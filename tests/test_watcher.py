@@ -0,0 +1,119 @@
+import json
+
+from proxstar import watcher
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.strings = {}
+        self.stream = []
+        self.published = []
+        self.sets = {}
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def execute(self):
+        return []
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def hset(self, key, mapping):
+        self.hashes[key] = {str(k).encode(): v.encode() for k, v in mapping.items()}
+
+    def rename(self, src, dst):
+        self.hashes[dst] = self.hashes.pop(src)
+
+    def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    def set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        self.strings[key] = value
+
+    def exists(self, key):
+        return int(key in self.strings)
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):  # pylint: disable=unused-argument
+        self.stream.append(json.loads(fields['event']))
+
+    def incr(self, key):
+        self.strings[key] = self.strings.get(key, 0) + 1
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def srem(self, key, *members):
+        self.sets.setdefault(key, set()).difference_update(members)
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)['data']['event']))
+
+
+class FakeResources:
+    def __init__(self, vms):
+        self.vms = vms
+
+    def get(self, type):  # pylint: disable=redefined-builtin,unused-argument
+        return self.vms
+
+
+class FakeProxmox:
+    def __init__(self, vms):
+        self.cluster = type('Cluster', (), {'resources': FakeResources(vms)})()
+
+
+CONFIG = {'WATCHER_STALE_SECONDS': 30, 'WATCHER_EVENT_STREAM_LENGTH': 100}
+
+
+def vm(vmid, status='running', node='a', pool='alice'):
+    return {'vmid': vmid, 'name': f'vm{vmid}', 'node': node, 'status': status, 'pool': pool}
+
+
+def test_diff_snapshots_reports_each_change():
+    previous = {1: vm(1), 2: vm(2), 3: vm(3)}
+    current = {1: vm(1, status='stopped', node='b'), 2: vm(2, pool='bob'), 4: vm(4)}
+    previous = {k: watcher._snapshot_entry(v) for k, v in previous.items()}
+    current = {k: watcher._snapshot_entry(v) for k, v in current.items()}
+    events = [
+        (event, changed['vmid']) for event, changed, _ in watcher.diff_snapshots(previous, current)
+    ]
+    assert events == [
+        ('status changed', 1),
+        ('migrated', 1),
+        ('pool changed', 2),
+        ('created', 4),
+        ('deleted', 3),
+    ]
+
+
+def test_watch_once_stores_snapshot_and_publishes_changes():
+    redis = FakeRedis()
+    assert watcher.get_cluster_snapshot(redis) is None
+
+    snapshot = watcher.watch_once(redis, FakeProxmox([vm(1)]), None, CONFIG)
+    assert not redis.published
+    assert watcher.get_cluster_snapshot(redis)[1]['status'] == 'running'
+
+    # A restarted watcher picks up from the snapshot in Redis
+    watcher.watch_once(redis, FakeProxmox([vm(1, pool='bob')]), None, CONFIG)
+    assert sorted(redis.published) == [
+        ('events|rtp', 'pool changed'),
+        ('events|user|alice', 'pool changed'),
+        ('events|user|bob', 'pool changed'),
+    ]
+    assert redis.stream[0]['previous'] == {'status': 'running', 'node': 'a', 'pool': 'alice'}
+    assert snapshot[1]['pool'] == 'alice'
+
+
+def test_watch_once_updates_hostname_index():
+    redis = FakeRedis()
+    snapshot = watcher.watch_once(redis, FakeProxmox([vm(1), vm(2)]), None, CONFIG)
+    snapshot = watcher.watch_once(redis, FakeProxmox([vm(2), vm(3)]), snapshot, CONFIG)
+    assert redis.sets['hostnames'] == {'vm3'}
+    redis.sets['hostnames'].add('vm1')
+    # vm1's name reused by a new VM in the same poll stays taken
+    reused = dict(vm(4), name='vm1')
+    watcher.watch_once(redis, FakeProxmox([vm(3), reused]), snapshot, CONFIG)
+    assert redis.sets['hostnames'] == {'vm1', 'vm3'}